@@ -0,0 +1,130 @@
+from typing import Any, Dict, Optional
+
+from werkzeug.exceptions import BadRequest
+
+from .models import ShortURL
+from .forms import LoginForm, ShortURLForm
+from .redirects import purge_proxy_cache
+from .core.db import session, read_from_replica
+from .core.app import Response
+from .core.decorators import token_required
+from .core.locals import current_app, request, current_user
+from .core.utils import jsonify, url_for
+
+
+def _get_json() -> Dict[str, Any]:
+	rv = request.get_json(silent=True)
+	return rv if isinstance(rv, dict) else {}
+
+
+def _make_error_response(message: str, /, status: int) -> Response:
+	return jsonify({'error': message}, status)
+
+
+def _serialize_short_url(short_url: ShortURL, /) -> Dict[str, Any]:
+	return {
+		'slug': short_url.slug,
+		'full_url': short_url.full_url,
+		'short_url': request.url_root[:-1]
+			+ url_for("follow", slug=short_url.slug),
+		'created_at': short_url.created_at,
+		'redirect_status': short_url.redirect_status,
+		'redirect_max_age': short_url.redirect_max_age,
+	}
+
+
+def _get_own_short_url(slug: str, /) -> Optional[ShortURL]:
+	"""Returns the short URL if the current user owns it or is staff."""
+
+	rv = ShortURL.query.filter_by(slug=slug).first()
+	if rv is None or (
+		rv.owner_id != current_user.get_id() and not current_user.is_staff
+	):
+		return None
+	return rv
+
+
+def create_token() -> Response:
+	form = LoginForm(data=_get_json(), meta={'csrf': False})
+	if not form.validate():
+		return _make_error_response("Invalid username or password.", 401)
+	# Saves the password if `check_password` rehashed it.
+	session.commit()
+
+	token = current_app.login_manager.generate_token(form.requested_user)
+	return jsonify({'token': token}, 201)
+
+
+@token_required
+def list_short_urls() -> Response:
+	max_per_page = current_app.config.get("API_MAX_PER_PAGE", 100)
+	per_page = request.args.get("limit", max_per_page, type=int)
+	if not 0 < per_page <= max_per_page:
+		return _make_error_response(
+			f"Limit must be from 1 to {max_per_page}.", 400,
+		)
+
+	try:
+		with read_from_replica():
+			current_page = ShortURL.query \
+				.filter_by(owner_id=current_user.get_id()) \
+				.paginate(per_page, keyset=(ShortURL.created_at, ShortURL.id))
+	except BadRequest:
+		return _make_error_response("Invalid cursor.", 400)
+
+	return jsonify({
+		'items': [_serialize_short_url(o) for o in current_page.items],
+		'next_cursor': current_page.next_cursor,
+	})
+
+
+@token_required
+def create_short_url() -> Response:
+	form = ShortURLForm(data=_get_json(), meta={'csrf': False})
+	if not form.validate():
+		return jsonify({'errors': form.errors}, 400)
+
+	new_short_url = form.populate()
+	if form.is_duplicate:
+		return jsonify(_serialize_short_url(new_short_url))
+	session.commit()
+	ShortURL.forget(new_short_url.slug, current_user.get_id())
+
+	return jsonify(_serialize_short_url(new_short_url), 201)
+
+
+@token_required
+def resolve_short_url(slug: str) -> Response:
+	short_url_redirect = ShortURL.get_redirect(slug)
+	if short_url_redirect is None:
+		return _make_error_response("Short URL not found.", 404)
+	return jsonify({'slug': slug, 'full_url': short_url_redirect.full_url})
+
+
+@token_required
+def delete_short_url(slug: str) -> Response:
+	short_url = _get_own_short_url(slug)
+	if short_url is None:
+		return _make_error_response("Short URL not found.", 404)
+
+	owner_id = short_url.owner_id
+	session.delete(short_url)
+	session.commit()
+	ShortURL.forget(slug, owner_id)
+	purge_proxy_cache(slug)
+
+	return current_app.make_response("", 204)
+
+
+@token_required
+def get_short_url_stats(slug: str) -> Response:
+	short_url = _get_own_short_url(slug)
+	if short_url is None:
+		return _make_error_response("Short URL not found.", 404)
+
+	return jsonify({
+		**_serialize_short_url(short_url),
+		'clicks': short_url.clicks,
+		'unique_visitors': short_url.unique_visitors,
+		'updated_at': short_url.updated_at,
+	})
@@ -1,12 +1,17 @@
 import os
+from typing import Optional
 from pathlib import Path
 
 from dotenv import load_dotenv
 from werkzeug.exceptions import NotFound, MethodNotAllowed
 
-from . import views
+from . import api, views
 from .models import User
+from .slugs import slug_filter, slug_allocator
+from .clicks import click_counter, click_recorder
 from .core.app import Application
+from .core.db import read_from_replica
+from .core.passwords import password_policy
 
 
 _base_dir = Path(__file__).resolve().parent
@@ -25,19 +30,150 @@ def _get_postgresql_database_uri() -> str:
 
 config = {
 	'SECRET_KEY': os.environ['SECRET_KEY'],
+	# Comma separated previous secret keys. Session cookies signed with them
+	# are still loaded and signed again with `SECRET_KEY`, and CSRF tokens
+	# are still verified for an hour after `SECRET_KEY` is changed.
+	'SECRET_KEY_FALLBACKS': [
+		key for key in os.environ.get("SECRET_KEY_FALLBACKS", "").split(",")
+		if key
+	],
+	# "hmac" or "serializer", see `core.csrf.CSRF_SIGNERS`.
+	'CSRF_SIGNER': "hmac",
 	'DATABASE_URI': _get_postgresql_database_uri(),
+	# Per worker process. Connections idle longer than `DATABASE_POOL_RECYCLE`
+	# seconds are reopened and every checkout is pinged, so that connections
+	# closed by the server or a proxy are not handed to requests.
+	'DATABASE_POOL_SIZE': int(os.environ.get("DATABASE_POOL_SIZE", 5)),
+	'DATABASE_MAX_OVERFLOW': int(os.environ.get("DATABASE_MAX_OVERFLOW", 10)),
+	'DATABASE_POOL_TIMEOUT': 30,
+	'DATABASE_POOL_RECYCLE': 1800,
+	'DATABASE_POOL_PRE_PING': True,
+	# Comma separated URIs of read-only replicas of `DATABASE_URI`.
+	'DATABASE_REPLICA_URIS': [
+		uri for uri in os.environ.get("DATABASE_REPLICA_URIS", "").split(",")
+		if uri
+	],
+	'DATABASE_REPLICA_RETRY_INTERVAL': 30.0,
+	# Seconds during which the client that wrote reads from the primary.
+	'DATABASE_REPLICA_STICKINESS': 5.0,
 
 	'BASE_DIR': _base_dir,
 	'STATIC_DIR': _base_dir.joinpath("static"),
 	'TEMPLATES_DIR': _templates_dir,
 	'TEMPLATES_CACHE_DIR': _templates_dir.joinpath("_cache"),
+	# Set `TEMPLATES_CHECK_MTIME=1` in development to reload edited
+	# templates without restarting.
+	'TEMPLATES_CHECK_MTIME': os.environ.get("TEMPLATES_CHECK_MTIME") == "1",
+	'TEMPLATES_PRECOMPILE': True,
+	'TEMPLATES_FRAGMENT_CACHE_TTL': 3600,
+
+	# "memory", "file" (`CACHE_URI` is a directory) or "redis"
+	# (`CACHE_URI` is a redis:// URI).
+	'CACHE_BACKEND': os.environ.get("CACHE_BACKEND", "memory"),
+	'CACHE_URI': os.environ.get("CACHE_URI"),
+	'CACHE_KEY_PREFIX': "url-shortener:",
+	'CACHE_MAX_SIZE': 10000,
+	'CACHE_DEFAULT_TTL': 300,
 
 	'SHORT_URLS_PER_PAGE': 5,
+	'SHORT_URLS_CACHE_TTL': 300,
+	'SHORT_URLS_NEGATIVE_CACHE_TTL': 30,
+	'SHORT_URLS_COUNT_CACHE_TTL': 60,
+	'SHORT_URLS_BULK_CHUNK_SIZE': 1000,
+	'SHORT_URLS_BULK_MAX_ROWS': 100000,
+	# Return the existing short URL when the user shortens the same URL
+	# again, comparing them after `models.normalize_full_url`.
+	'SHORT_URLS_DEDUPLICATE': False,
+	# The purge server of the caching proxy that serves redirects, e.g.
+	# "http://nginx:8081". Deleted short URLs are purged from its cache.
+	'SHORT_URLS_PURGE_URL': os.environ.get("SHORT_URLS_PURGE_URL"),
+	'SHORT_URLS_PURGE_TIMEOUT': 1.0,
+
+	'API_MAX_PER_PAGE': 100,
+
+	# Endpoint: [(limit, "ip" or "user"), ...], see `core.ratelimit`.
+	'RATE_LIMITS': {
+		'follow': [("100/second", "ip")],
+		'create': [("30/minute", "user"), ("1000/day", "user")],
+		'bulk_create': [("10/hour", "user")],
+		'login': [("20/minute", "ip")],
+		'register': [("20/hour", "ip")],
+		'create_token': [("10/minute", "ip")],
+		# The API user is loaded from the token after the check.
+		'create_short_url': [("60/minute", "ip")],
+	},
+	# "memory" limits each worker separately, "redis"
+	# (`RATE_LIMIT_STORAGE_URI` is a redis:// URI) limits all together.
+	'RATE_LIMIT_STORAGE': os.environ.get("RATE_LIMIT_STORAGE", "memory"),
+	'RATE_LIMIT_STORAGE_URI': os.environ.get("RATE_LIMIT_STORAGE_URI"),
+	'RATE_LIMIT_MAX_SIZE': 100000,
+
+	# Served at /metrics in the Prometheus format. The workers share their
+	# metrics through `METRICS_DIR`.
+	'METRICS_ENABLED': True,
+	'METRICS_DIR': os.environ.get("METRICS_DIR", "/tmp/url-shortener-metrics"),
+	'METRICS_WRITE_INTERVAL': 10.0,
+	# Set `PROFILER_ENABLED=1` to log stacks of requests that run longer
+	# than `PROFILER_SLOW_REQUEST_THRESHOLD` seconds and, with
+	# a `PROFILER_SAMPLE_RATE`, dump cProfile profiles of slow ones into
+	# `PROFILER_DIR`.
+	'PROFILER_ENABLED': os.environ.get("PROFILER_ENABLED") == "1",
+	'PROFILER_DIR': os.environ.get("PROFILER_DIR", "/tmp/url-shortener-prof"),
+	'PROFILER_SAMPLE_RATE': float(os.environ.get("PROFILER_SAMPLE_RATE", 0)),
+	'PROFILER_SLOW_REQUEST_THRESHOLD': 1.0,
+	'PROFILER_STACK_SAMPLE_INTERVAL': 1.0,
+
+	# Seconds for which a worker keeps users and the session keeps
+	# a snapshot of its user, so that most requests do not load the user.
+	'USER_CACHE_TTL': 30.0,
+	'USER_SNAPSHOT_MAX_AGE': 300.0,
+
+	# "scrypt", "pbkdf2" or "argon2", which requires the `argon2-cffi`
+	# package. Hashes of other methods or options are replaced on login.
+	'PASSWORD_HASH_METHOD': "scrypt",
+	# About 50 ms and 16 MiB per hash.
+	'PASSWORD_HASH_OPTIONS': {'n': 2 ** 14, 'r': 8, 'p': 1},
+	# Hashes computed at once per worker process and logins that may wait
+	# for them, the rest get 503. Together they are the request threads
+	# logins may hold, keep them well below the `--threads` of gunicorn in
+	# supervisor.conf (12), so that redirects are still served.
+	'PASSWORD_HASH_WORKERS': 2,
+	'PASSWORD_HASH_QUEUE_SIZE': 2,
+
+	'SLUG_MIN_LENGTH': 5,
+	'SLUG_MAX_OCCUPANCY': 0.01,
+	'SLUG_USE_SEQUENCE': False,
+	# Slugs created by other workers are loaded at most once a second, so
+	# for up to a second they may be answered with 404 by this worker.
+	'SLUG_FILTER_FALSE_POSITIVE_RATE': 0.01,
+	'SLUG_FILTER_SYNC_INTERVAL': 1.0,
+	# Ids that are re-read on every sync, must exceed the number of rows
+	# inserted concurrently, e.g. by bulk uploads.
+	'SLUG_FILTER_SYNC_OVERLAP': 2000,
+	'SLUG_FILTER_REBUILD_INTERVAL': 3600.0,
+
+	'CLICKS_FLUSH_INTERVAL': 5.0,
+	'CLICKS_FLUSH_THRESHOLD': 1000,
+	# Failed writes in a row after which the pending clicks are dropped.
+	'CLICKS_FLUSH_MAX_ATTEMPTS': 5,
+	# Clicks waiting to be written. The oldest are dropped when the
+	# database falls behind.
+	'CLICK_EVENTS_BUFFER_SIZE': 100000,
+	# The path of a MaxMind GeoIP2 or GeoLite2 country database, which
+	# requires the `geoip2` package.
+	'CLICK_EVENTS_GEOIP_DATABASE': os.environ.get(
+		"CLICK_EVENTS_GEOIP_DATABASE",
+	),
 }
 
 
+def _load_user(id: int) -> Optional[User]:
+	with read_from_replica():
+		return User.query.get(id)
+
+
 def create_app() -> Application:
-	app = Application(config, lambda id: User.query.get(id),
+	app = Application(config, _load_user,
   					login_view_endpoint=views.login.__name__)
 
 	app.add_url_rule(
@@ -78,9 +214,19 @@ def create_app() -> Application:
 		views.create,
 		methods=("GET", "POST"),
 	)
+	app.add_url_rule(
+		"/s/bulk/",
+		views.bulk_create,
+		methods=("GET", "POST"),
+	)
 	app.add_url_rule(
 		"/s/<string:slug>/",
 		views.follow,
+		async_view=views.async_follow,
+	)
+	app.add_url_rule(
+		"/s/<string:slug>/stats/",
+		views.stats,
 	)
 	app.add_url_rule(
 		"/s/<string:slug>/delete/",
@@ -88,6 +234,54 @@ def create_app() -> Application:
 		methods=("GET", "POST"),
 	)
 
+	# Redirects skip the session, CSRF and other request machinery.
+	app.add_lightweight_rule(
+		"/s/<string:slug>/",
+		views.lightweight_follow,
+		endpoint=views.follow.__name__,
+	)
+
+	password_policy.init_app(app)
+	slug_filter.init_app(app)
+	slug_allocator.init_app(app)
+	click_counter.init_app(app)
+	click_recorder.init_app(app)
+
+	# The API is authenticated by tokens instead of the session cookie,
+	# so it is not exposed to CSRF.
+	app.add_url_rule(
+		"/api/tokens/",
+		app.csrf_protect.exempt(api.create_token),
+		methods=("POST",),
+	)
+	app.add_url_rule(
+		"/api/short-urls/",
+		api.list_short_urls,
+	)
+	app.add_url_rule(
+		"/api/short-urls/",
+		app.csrf_protect.exempt(api.create_short_url),
+		methods=("POST",),
+	)
+	app.add_url_rule(
+		"/api/short-urls/<string:slug>/",
+		api.resolve_short_url,
+	)
+	app.add_url_rule(
+		"/api/short-urls/<string:slug>/",
+		app.csrf_protect.exempt(api.delete_short_url),
+		methods=("DELETE",),
+	)
+	app.add_url_rule(
+		"/api/short-urls/<string:slug>/stats/",
+		api.get_short_url_stats,
+	)
+
+	app.add_url_rule(
+		"/metrics",
+		views.metrics,
+	)
+
 	app.add_exception_handler(
 		NotFound,
 		views.notfound_handler,
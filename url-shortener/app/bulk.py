@@ -0,0 +1,245 @@
+import io
+import csv
+import json
+from itertools import islice
+from typing import IO, Any, Dict, List, Tuple, Callable, Iterator, \
+	Optional, NamedTuple
+
+from werkzeug.datastructures import FileStorage
+
+from .models import ShortURL, hash_full_url
+from .forms import FullURLForm
+from .slugs import slug_allocator
+from .core.db import session
+
+
+class BulkRow(NamedTuple):
+	number: int
+	full_url: str
+	slug: Optional[str] = None
+	error: Optional[str] = None
+
+
+class BulkFormatError(ValueError):
+	pass
+
+
+def _read_csv_full_urls(stream: IO[bytes], /) -> Iterator[str]:
+	"""Yields the first column of every row, skipping the optional
+	`full_url` header. The file is decoded and parsed while the response is
+	streamed, so format errors are raised as `BulkFormatError` by the
+	iterator, see `create_short_urls`."""
+
+	reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig"))
+	try:
+		for i, row in enumerate(reader):
+			if not row or (i == 0 and row[0].strip() == "full_url"):
+				continue
+			yield row[0].strip()
+	except UnicodeDecodeError as exc:
+		raise BulkFormatError(
+			"The file is not in UTF-8, the rest of it is skipped.",
+		) from exc
+	except csv.Error as exc:
+		raise BulkFormatError(
+			f"Invalid CSV ({exc}), the rest of the file is skipped.",
+		) from exc
+
+
+def _get_json_full_url(item: Any, /) -> str:
+	if isinstance(item, dict):
+		item = item.get("full_url")
+	return item if isinstance(item, str) else ""
+
+
+def _read_json_full_urls(stream: IO[bytes], /) -> Iterator[str]:
+	"""Accepts a list of strings or of `{"full_url": ...}` objects. Unlike
+	CSV, it is parsed at once, so format errors are raised before the
+	response is started."""
+
+	try:
+		data = json.load(stream)
+	except ValueError as exc:
+		raise BulkFormatError("Invalid JSON.") from exc
+	if not isinstance(data, list):
+		raise BulkFormatError("JSON must be a list.")
+
+	return map(_get_json_full_url, data)
+
+
+def read_full_urls(file: FileStorage, /) -> Iterator[str]:
+	"""Reads full URLs from an uploaded CSV or JSON file. The format is
+	detected by the file extension, then by the content type."""
+
+	filename = (file.filename or "").lower()
+	if filename.endswith(".json") or file.mimetype == "application/json":
+		return _read_json_full_urls(file.stream)
+	return _read_csv_full_urls(file.stream)
+
+
+def _validate_rows(
+	numbered_full_urls: List[Tuple[int, str]],
+	/,
+) -> Tuple[List[BulkRow], List[BulkRow]]:
+	valid_rows, invalid_rows = [], []
+
+	for number, full_url in numbered_full_urls:
+		form = FullURLForm(data={'full_url': full_url})
+		if form.validate():
+			valid_rows.append(BulkRow(number, full_url))
+		else:
+			invalid_rows.append(
+				BulkRow(number, full_url, error=form.full_url.errors[0]),
+			)
+
+	return valid_rows, invalid_rows
+
+
+def create_short_urls(
+	owner_id: int,
+	full_urls: Iterator[str],
+	/,
+	*,
+	chunk_size: int = 1000,
+	max_rows: Optional[int] = None,
+	deduplicate: bool = False,
+) -> Iterator[BulkRow]:
+	"""Validates full URLs with `fields.FullURLField` rules and creates
+	short URLs in chunks: every chunk is inserted with one multi-row
+	`INSERT` and committed. Yields the result of every row in the input
+	order, so it can be streamed to the client while the rest of the input
+	is processed.
+
+	Rows after `max_rows` are reported as errors and not inserted. With
+	`deduplicate`, rows of URLs that the owner has already shortened or
+	that repeat in the input get the existing slugs. A `BulkFormatError`
+	of `full_urls` ends the results with a row of its message, as the
+	response has already started."""
+
+	numbered_full_urls = enumerate(full_urls, start=1)
+
+	try:
+		yield from _create_chunks(
+			owner_id, numbered_full_urls, chunk_size, max_rows, deduplicate,
+		)
+	finally:
+		ShortURL.forget_count_by_owner(owner_id)
+
+
+def _create_chunks(
+	owner_id: int,
+	numbered_full_urls: Iterator[Tuple[int, str]],
+	chunk_size: int,
+	max_rows: Optional[int],
+	deduplicate: bool,
+	/,
+) -> Iterator[BulkRow]:
+	last_number = 0
+	format_error: Optional[BulkFormatError] = None
+
+	while format_error is None:
+		chunk: List[Tuple[int, str]] = []
+		try:
+			for numbered_full_url in islice(numbered_full_urls, chunk_size):
+				chunk.append(numbered_full_url)
+		except BulkFormatError as exc:
+			format_error = exc
+		if not chunk:
+			break
+		last_number = chunk[-1][0]
+
+		if max_rows is not None and chunk[-1][0] > max_rows:
+			rejected_chunk = [row for row in chunk if row[0] > max_rows]
+			chunk = chunk[:len(chunk) - len(rejected_chunk)]
+		else:
+			rejected_chunk = []
+
+		valid_rows, invalid_rows = _validate_rows(chunk)
+		if valid_rows:
+			if deduplicate:
+				valid_rows = _insert_unique_rows(owner_id, valid_rows)
+			else:
+				valid_rows = _insert_rows(owner_id, valid_rows)
+
+		yield from sorted(valid_rows + invalid_rows, key=lambda r: r.number)
+		for number, full_url in rejected_chunk:
+			yield BulkRow(number, full_url, error="Too many rows.")
+
+	if format_error is not None:
+		yield BulkRow(last_number + 1, "", error=str(format_error))
+
+
+def _insert_rows(owner_id: int, rows: List[BulkRow], /) -> List[BulkRow]:
+	db_rows: List[Dict[str, Any]] = [
+		{'owner_id': owner_id, 'full_url': row.full_url} for row in rows
+	]
+	slug_allocator.insert_many(db_rows)
+	session.commit()
+
+	return [
+		row._replace(slug=db_row['slug'])
+		for row, db_row in zip(rows, db_rows)
+	]
+
+
+def _insert_unique_rows(owner_id: int, rows: List[BulkRow],
+ 						/) -> List[BulkRow]:
+	"""Inserts only the rows of full URLs that the owner doesn't have yet,
+	each once, and gives the rest the slugs of existing short URLs, which
+	are looked up with one query."""
+
+	full_url_hashes = [hash_full_url(row.full_url) for row in rows]
+	slugs = ShortURL.get_slugs_by_full_url_hashes(owner_id, full_url_hashes)
+
+	db_rows: List[Dict[str, Any]] = []
+	for row, full_url_hash in zip(rows, full_url_hashes):
+		if full_url_hash not in slugs:
+			# Marks the hash as taken by this row until its slug is known.
+			slugs[full_url_hash] = ""
+			db_rows.append({
+				'owner_id': owner_id,
+				'full_url': row.full_url,
+				'full_url_hash': full_url_hash,
+			})
+	if db_rows:
+		slug_allocator.insert_many(db_rows)
+		session.commit()
+		slugs.update(
+			(db_row['full_url_hash'], db_row['slug']) for db_row in db_rows
+		)
+
+	return [
+		row._replace(slug=slugs[full_url_hash])
+		for row, full_url_hash in zip(rows, full_url_hashes)
+	]
+
+
+def write_csv(
+	rows: Iterator[BulkRow],
+	/,
+	make_short_url: Callable[[str], str],
+	*,
+	buffer_size: int = 64 * 1024,
+) -> Iterator[str]:
+	"""Formats results as CSV, yielding about `buffer_size` characters at
+	a time to keep the number of writes to the socket low."""
+
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	writer.writerow(("line", "full_url", "slug", "short_url", "error"))
+
+	for row in rows:
+		writer.writerow((
+			row.number,
+			row.full_url,
+			row.slug or "",
+			"" if row.slug is None else make_short_url(row.slug),
+			row.error or "",
+		))
+
+		if buffer.tell() >= buffer_size:
+			yield buffer.getvalue()
+			buffer.seek(0)
+			buffer.truncate()
+
+	yield buffer.getvalue()
@@ -0,0 +1,382 @@
+import re
+import time
+from functools import lru_cache
+from urllib.parse import urlsplit
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Set, Dict, List, Type, Tuple, Callable, Optional
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import sqlite, postgresql
+
+from .models import ShortURL, ClickEvent, ClickRollup, VisitorSketch, \
+	REFERRER_MAX_LENGTH, ROLLUP_RESOLUTIONS, ROLLUP_VALUE_MAX_LENGTH
+from .core.app import Application
+from .core.batching import BatchCounter, BatchBuffer
+from .core.hyperloglog import HyperLogLog
+
+
+class ClickCounter(BatchCounter):
+	"""Counts clicks of short URLs in memory and adds them to the database
+	in batches of `UPDATE shorturl SET clicks = clicks + :n` statements,
+	so that `views.follow` doesn't need a write transaction and concurrent
+	clicks are not lost."""
+
+	thread_name = "click-counter"
+
+	def __init__(self) -> None:
+		super().__init__()
+		self.engine: Optional[sa.engine.Engine] = None
+
+	def init_app(self, app: Application, /) -> None:
+		assert app.database_manager is not None, "No database configured."
+
+		self.engine = app.database_manager.engine
+		self.interval = app.config.get("CLICKS_FLUSH_INTERVAL", self.interval)
+		self.threshold \
+			= app.config.get("CLICKS_FLUSH_THRESHOLD", self.threshold)
+		self.max_attempts \
+			= app.config.get("CLICKS_FLUSH_MAX_ATTEMPTS", self.max_attempts)
+
+	def _write(self, batch: Dict[str, int], /) -> None:  # type: ignore
+		assert self.engine is not None, "`init_app` was not called."
+
+		table = ShortURL.__table__  # type: ignore
+		statement = table.update() \
+			.where(table.c.slug == sa.bindparam("_slug")) \
+			.values(clicks=table.c.clicks + sa.bindparam("_n"))
+
+		# Rows are updated in the order of slugs, in which
+		# `ClickRecorder._merge_visitors` locks them too, so that concurrent
+		# transactions don't deadlock.
+		with self.engine.begin() as connection:
+			connection.execute(statement, [
+				{'_slug': slug, '_n': n} for slug, n in sorted(batch.items())
+			])
+
+
+click_counter = ClickCounter()
+
+
+_USER_AGENT_FAMILIES = (
+	("Bot", re.compile(r"bot|crawl|spider|slurp|preview|externalhit", re.I)),
+	("Edge", re.compile(r"Edg(e|A|iOS)?/")),
+	("Opera", re.compile(r"OPR/|Opera")),
+	("Samsung Internet", re.compile(r"SamsungBrowser/")),
+	("Chrome", re.compile(r"Chrome/|CriOS/")),
+	("Firefox", re.compile(r"Firefox/|FxiOS/")),
+	("Safari", re.compile(r"Safari/")),
+	("Internet Explorer", re.compile(r"MSIE |Trident/")),
+	("curl", re.compile(r"^curl/")),
+)
+
+
+@lru_cache(maxsize=1024)
+def get_user_agent_family(user_agent: Optional[str], /) -> str:
+	"""Returns the browser of the `User-Agent` header. The patterns are
+	checked in order, as e.g. Chrome also claims to be Safari."""
+
+	if not user_agent:
+		return "Unknown"
+	for family, pattern in _USER_AGENT_FAMILIES:
+		if pattern.search(user_agent):
+			return family
+	return "Other"
+
+
+def get_referrer_host(referrer: Optional[str], /) -> str:
+	if not referrer:
+		return ""
+	try:
+		return urlsplit(referrer).hostname or ""
+	except ValueError:
+		return ""
+
+
+class CountryLookup:
+	"""Looks up ISO country codes of IP addresses in a local MaxMind GeoIP2
+	or GeoLite2 country database.
+
+	Requires the optional `geoip2` package.
+
+	:param path: The path of the `.mmdb` file.
+	"""
+
+	def __init__(self, path: str, /) -> None:
+		try:
+			import geoip2.errors
+			import geoip2.database
+		except ImportError as exc:
+			raise RuntimeError(
+				"Install the `geoip2` package to look up countries.",
+			) from exc
+
+		self._reader = geoip2.database.Reader(path)
+		self._not_found_error: Type[Exception] \
+			= geoip2.errors.AddressNotFoundError
+
+	def __call__(self, ip: Optional[str], /) -> Optional[str]:
+		if not ip:
+			return None
+		try:
+			return self._reader.country(ip).country.iso_code
+		except (ValueError, self._not_found_error):
+			return None
+
+
+class ClickRecorder(BatchBuffer):
+	"""Records clicks of short URLs into a ring buffer and writes them in
+	batches to the append-only `ClickEvent` table, adding them to the
+	`ClickRollup` buckets of every resolution in the same transaction.
+	Stats are read from the rollups, not from the events.
+
+	Only the raw request headers are buffered. The user agent and the
+	country are found when the batch is written, outside of requests, and
+	IP addresses are not stored."""
+
+	thread_name = "click-recorder"
+
+	# Seconds after which rollups are deleted. Daily ones are kept.
+	rollup_max_ages = {'minute': 2 * 24 * 60 * 60, 'hour': 90 * 24 * 60 * 60}
+	prune_interval = 60 * 60
+
+	# `INSERT ... ON CONFLICT DO UPDATE` of the supported databases.
+	insert_functions: Dict[str, Callable[..., Any]] = {
+		'postgresql': postgresql.insert,
+		'sqlite': sqlite.insert,
+	}
+
+	def __init__(self) -> None:
+		super().__init__()
+		self.engine: Optional[sa.engine.Engine] = None
+		self.country_lookup: Optional[CountryLookup] = None
+		self._pruned_at: Optional[float] = None
+
+	def init_app(self, app: Application, /) -> None:
+		assert app.database_manager is not None, "No database configured."
+
+		config = app.config
+		self.engine = app.database_manager.engine
+		self.capacity = config.get("CLICK_EVENTS_BUFFER_SIZE", self.capacity)
+		self.interval = config.get("CLICKS_FLUSH_INTERVAL", self.interval)
+		self.threshold = config.get("CLICKS_FLUSH_THRESHOLD", self.threshold)
+		self.max_attempts = config.get(
+			"CLICKS_FLUSH_MAX_ATTEMPTS", self.max_attempts,
+		)
+		self.rollup_max_ages = config.get(
+			"CLICK_ROLLUP_MAX_AGES", self.rollup_max_ages,
+		)
+
+		geoip_database = config.get("CLICK_EVENTS_GEOIP_DATABASE")
+		if geoip_database:
+			self.country_lookup = CountryLookup(geoip_database)
+
+	def record(self, slug: str, environ: Dict[str, Any], /) -> None:
+		self.append((
+			time.time(),
+			slug,
+			environ.get("HTTP_REFERER"),
+			environ.get("HTTP_USER_AGENT"),
+			environ.get("HTTP_X_REAL_IP") or environ.get("REMOTE_ADDR"),
+		))
+
+	def _lookup_country(self, ip: Optional[str], /) -> Optional[str]:
+		return None if self.country_lookup is None else self.country_lookup(ip)
+
+	@staticmethod
+	def _get_short_url_ids(connection: sa.engine.Connection,
+ 						slugs: Set[str], /) -> Dict[str, int]:
+		table = ShortURL.__table__  # type: ignore
+		statement = sa.select(table.c.slug, table.c.id) \
+			.where(table.c.slug.in_(slugs))
+		return dict(connection.execute(statement).all())
+
+	def _upsert_rollups(self, connection: sa.engine.Connection,
+ 						counts: Counter[Tuple[Any, ...]], /) -> None:
+		table = ClickRollup.__table__  # type: ignore
+		insert = self.insert_functions[connection.dialect.name](table)
+		statement = insert.on_conflict_do_update(
+			index_elements=(
+				"short_url_id", "resolution", "bucket", "dimension", "value",
+			),
+			set_={'clicks': table.c.clicks + insert.excluded.clicks},
+		)
+
+		# Sorted, so that workers lock the rows in the same order.
+		connection.execute(statement, [
+			{
+				'short_url_id': short_url_id,
+				'resolution': resolution,
+				'bucket': bucket,
+				'dimension': dimension,
+				'value': value,
+				'clicks': clicks,
+			}
+			for (short_url_id, resolution, bucket, dimension, value), clicks
+			in sorted(counts.items())
+		])
+
+	@staticmethod
+	def _merge_visitors(connection: sa.engine.Connection,
+ 						sketches: Dict[int, HyperLogLog], /) -> None:
+		"""Merges the sketches into the stored ones. Rows are locked, so
+		that concurrent merges of other workers are not lost, in the order
+		of slugs, like in `ClickCounter._write`, so that they don't
+		deadlock."""
+
+		table = ShortURL.__table__  # type: ignore
+		rows = connection.execute(
+			sa.select(table.c.id, table.c.visitors_sketch)
+				.where(table.c.id.in_(sketches))
+				.order_by(table.c.slug)
+				.with_for_update(),
+		).all()
+
+		params = []
+		for short_url_id, data in rows:
+			sketch = sketches[short_url_id]
+			if data is not None:
+				sketch.merge(HyperLogLog.from_bytes(data))
+			params.append({
+				'_id': short_url_id,
+				'visitors_sketch': sketch.to_bytes(),
+				'unique_visitors': round(sketch.count()),
+			})
+		connection.execute(
+			table.update().where(table.c.id == sa.bindparam("_id")), params,
+		)
+
+	def _merge_daily_visitors(
+		self,
+		connection: sa.engine.Connection,
+		sketches: Dict[Tuple[int, datetime], HyperLogLog],
+		/,
+	) -> None:
+		"""Like `_merge_visitors`. Missing rows are inserted empty first,
+		so that there is a row to lock. Rows are inserted and locked in the
+		order of their keys."""
+
+		table = VisitorSketch.__table__  # type: ignore
+		empty_sketch = HyperLogLog().to_bytes()
+		insert = self.insert_functions[connection.dialect.name](table) \
+			.on_conflict_do_nothing(index_elements=("short_url_id", "bucket"))
+		connection.execute(insert, [
+			{
+				'short_url_id': short_url_id,
+				'bucket': bucket,
+				'registers': empty_sketch,
+				'unique_visitors': 0,
+			}
+			for short_url_id, bucket in sorted(sketches)
+		])
+
+		statement = sa.select(
+			table.c.id, table.c.short_url_id, table.c.bucket, table.c.registers,
+		).where(
+			table.c.short_url_id.in_({k[0] for k in sketches}),
+			table.c.bucket.in_({k[1] for k in sketches}),
+		).order_by(table.c.short_url_id, table.c.bucket)
+		rows = connection.execute(statement.with_for_update()).all()
+
+		params = []
+		for id, short_url_id, bucket, data in rows:
+			sketch = sketches.get((short_url_id, bucket))
+			if sketch is None:
+				continue
+			sketch.merge(HyperLogLog.from_bytes(data))
+			params.append({
+				'_id': id,
+				'registers': sketch.to_bytes(),
+				'unique_visitors': round(sketch.count()),
+			})
+		connection.execute(
+			table.update().where(table.c.id == sa.bindparam("_id")), params,
+		)
+
+	def _prune_rollups(self, connection: sa.engine.Connection, /) -> None:
+		now = time.time()
+		if (
+			self._pruned_at is not None
+			and now - self._pruned_at < self.prune_interval
+		):
+			return
+
+		table = ClickRollup.__table__  # type: ignore
+		for resolution, max_age in self.rollup_max_ages.items():
+			connection.execute(table.delete().where(
+				table.c.resolution == resolution,
+				table.c.bucket < _to_datetime(now - max_age),
+			))
+		self._pruned_at = now
+
+	def _write(self, batch: List[Tuple[Any, ...]], /) -> None:  # type: ignore
+		assert self.engine is not None, "`init_app` was not called."
+
+		with self.engine.begin() as connection:
+			short_url_ids = self._get_short_url_ids(
+				connection, {slug for _, slug, *_ in batch},
+			)
+
+			events: List[Dict[str, Any]] = []
+			counts: Counter[Tuple[Any, ...]] = Counter()
+			sketches: Dict[int, HyperLogLog] = {}
+			daily_sketches: Dict[Tuple[int, datetime], HyperLogLog] = {}
+			for clicked_at, slug, referrer, user_agent, ip in batch:
+				# Deleted while the click was buffered.
+				short_url_id = short_url_ids.get(slug)
+				if short_url_id is None:
+					continue
+
+				user_agent_family = get_user_agent_family(user_agent)
+				country = self._lookup_country(ip)
+				events.append({
+					'short_url_id': short_url_id,
+					'created_at': _to_datetime(clicked_at),
+					'referrer': (referrer or "")[:REFERRER_MAX_LENGTH] or None,
+					'user_agent_family': user_agent_family,
+					'country': country,
+				})
+
+				buckets = {
+					resolution: _to_datetime(clicked_at - clicked_at % seconds)
+					for resolution, seconds in ROLLUP_RESOLUTIONS.items()
+				}
+				for resolution, bucket in buckets.items():
+					counts[short_url_id, resolution, bucket, "", ""] += 1
+				for dimension, value in (
+					("referrer", get_referrer_host(referrer)),
+					("browser", user_agent_family),
+					("country", country or ""),
+				):
+					if value:
+						# Hosts come from the client and may be longer.
+						value = value[:ROLLUP_VALUE_MAX_LENGTH]
+						counts[
+							short_url_id, "day", buckets['day'], dimension, value,
+						] += 1
+
+				# Only the registers of sketches are stored, not visitors.
+				visitor = "%s %s" % (ip, user_agent)
+				sketches.setdefault(short_url_id, HyperLogLog()).add(visitor)
+				daily_sketches.setdefault(
+					(short_url_id, buckets['day']), HyperLogLog(),
+				).add(visitor)
+
+			if events:
+				connection.execute(
+					ClickEvent.__table__.insert(),  # type: ignore
+					events,
+				)
+				self._upsert_rollups(connection, counts)
+				self._merge_visitors(connection, sketches)
+				self._merge_daily_visitors(connection, daily_sketches)
+			self._prune_rollups(connection)
+
+
+def _to_datetime(timestamp: float, /) -> datetime:
+	"""Naive UTC, like the other columns."""
+	return datetime.fromtimestamp(timestamp, timezone.utc) \
+		.replace(tzinfo=None)
+
+
+click_recorder = ClickRecorder()
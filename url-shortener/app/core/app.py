@@ -1,34 +1,54 @@
 from __future__ import annotations
 
+import time
+import asyncio
+import logging
 from functools import wraps
 from collections.abc import Mapping
-from typing import Any, Dict, List, Type, Union, Tuple, Optional, Callable, \
-	Iterator, TypeAlias, TYPE_CHECKING
+from typing import Any, Set, Dict, List, Type, Union, Tuple, Optional, \
+	Callable, Iterator, Awaitable, TypeAlias, TYPE_CHECKING
 if TYPE_CHECKING:
 	from sys import _OptExcInfo
 
 from werkzeug.routing import Map, Rule
 from werkzeug.wrappers import Response
+from werkzeug.wsgi import ClosingIterator, get_path_info
 from werkzeug.exceptions import HTTPException
 from werkzeug.middleware.shared_data import SharedDataMiddleware
-from mako.lookup import TemplateLookup
 
+from .asgi import ScopeType, ReceiveType, SendType, read_body, \
+	make_environ, run_wsgi_app, handle_lifespan, send_werkzeug_response
 from .csrf import CSRFProtect
+from .ratelimit import RateLimiter
+from .metrics import RequestMetrics, timed
+from .profiling import ProfilerMiddleware
+from .templating import TemplateLookup
+from .cache import create_cache
 from .wrappers import Request
 from .db import DatabaseManager
 from .auth import LoginManager, UserLoaderType
-from .locals import local, local_manager, request, url_adapter
+from .locals import local, local_manager, request, url_adapter, \
+	start_context
 
 
 ViewType: TypeAlias = Callable[..., Union[str, Response]]
+AsyncViewType: TypeAlias = Callable[..., Awaitable[Union[str, Response]]]
+LightweightViewType: TypeAlias = Callable[..., Optional[Response]]
 BeforeRequestFuncType: TypeAlias = Callable[[], Optional[Union[str, Response]]]
+BeforeLightweightRequestFuncType: TypeAlias = Callable[
+	[Dict[str, Any], str], Optional[Response],
+]
+TeardownRequestFuncType: TypeAlias = Callable[[], None]
 ExceptionHandlerType: TypeAlias = Callable[[Exception], Response]
 StartResponseType: TypeAlias = Callable[
-	[str, List[Tuple[str, str]], Optional[_OptExcInfo]],
+	[str, List[Tuple[str, str]], Optional["_OptExcInfo"]],
 	Callable[[bytes], Any],
 ]
 
 
+logger = logging.getLogger(__name__)
+
+
 def setup_method(f: Callable) -> Callable:
 	"""This is to avoid accidental use of methods like `_apply_middlewares`
 	when the application is already processing user requests."""
@@ -47,8 +67,11 @@ class Application:
 	request_class = Request
 	response_class = Response
 	csrf_protect_class = CSRFProtect
+	rate_limiter_class = RateLimiter
 	database_manager_class = DatabaseManager
 	login_manager_class = LoginManager
+	metrics_class = RequestMetrics
+	profiler_middleware_class = ProfilerMiddleware
 
 	datetime_format = "%d.%m.%Y %H:%M:%S"
 	template_imports = set((
@@ -59,6 +82,7 @@ class Application:
 		"from app.core.utils import url_for",
 		"from app.core.utils import strftime",
 		"from app.core.utils import get_flashed_messages",
+		"from app.core.utils import cache_fragment",
 	))
 
 	config_required_fields = frozenset((
@@ -84,29 +108,61 @@ class Application:
 		self.login_view_endpoint = login_view_endpoint
 
 		self._views: Dict[str, ViewType] = {}
+		self._async_views: Dict[str, AsyncViewType] = {}
+		self._lightweight_views: Dict[str, LightweightViewType] = {}
 		self._exception_handlers: \
 			Dict[Type[Exception], ExceptionHandlerType] = {}
 		self._before_request_funcs: List[BeforeRequestFuncType] = []
+		self._before_lightweight_request_funcs: \
+			List[BeforeLightweightRequestFuncType] = []
+		self._teardown_request_funcs: List[TeardownRequestFuncType] = []
 		self._got_first_request = False
 
 		self.url_map = Map()
+		self.lightweight_url_map = Map()
+		self._static_paths: Set[str] = set()
+		self._lightweight_url_adapter = self.lightweight_url_map.bind("")
 		self.template_lookup = TemplateLookup(
 			directories=[config['TEMPLATES_DIR']],
 			module_directory=config['TEMPLATES_CACHE_DIR'],
 			imports=self.template_imports,
+			# Without checks, edited templates are reloaded only on restart.
+			filesystem_checks=config.get("TEMPLATES_CHECK_MTIME", True),
 		)
+		if config.get("TEMPLATES_PRECOMPILE", False):
+			self.precompile_templates()
 
+		# Before CSRF, so that limited requests are rejected cheaply.
+		self.rate_limiter = self.rate_limiter_class(self)
 		self.csrf_protect = self.csrf_protect_class(self)
-		self.login_manager = self.login_manager_class(user_loader)
+		self.login_manager = self.login_manager_class.from_config(
+			config, user_loader,
+		)
+		self.cache = create_cache(config)
+		self.metrics = (
+			None if not config.get("METRICS_ENABLED", False)
+			else self.metrics_class.from_config(config)
+		)
 
-		database_uri = config.get("DATABASE_URI")
-		self.database_manager = (None if database_uri is None else
- 								self.database_manager_class(database_uri))
+		self.database_manager = (
+			None if config.get("DATABASE_URI") is None
+			else self.database_manager_class.from_config(config)
+		)
+		if self.database_manager is not None:
+			self.run_teardown_request(self.database_manager.remove_session)
+			if self.metrics is not None:
+				for engine in self.database_manager.get_engines():
+					self.metrics.instrument_engine(engine)
+				self.metrics.watch_pools(self.database_manager)
 
 		self._apply_middlewares()
 
 	def __call__(self, environ: Dict[str, Any],
  				start_response: StartResponseType) -> Iterator[bytes]:
+		if self._lightweight_views:
+			rv = self.dispatch_lightweight_request(environ, start_response)
+			if rv is not None:
+				return rv
 		return self.wsgi_app(environ, start_response)
 
 	@classmethod
@@ -127,15 +183,29 @@ class Application:
 		self.wsgi_app = local_manager.make_middleware(  # type: ignore
 			self.wsgi_app,
 		)
+		if self.config.get("PROFILER_ENABLED", False):
+			self.wsgi_app = self.profiler_middleware_class \
+				.from_config(self.config, self.wsgi_app)  # type: ignore
 		self.wsgi_app = SharedDataMiddleware(self.wsgi_app, {  # type: ignore
 			self.static_root: str(self.config['STATIC_DIR']),
 		})
 
+	@setup_method
+	def precompile_templates(self) -> None:
+		"""Compiles templates into `TEMPLATES_CACHE_DIR` and loads them, so
+		that the first requests of a worker do not compile them. Templates
+		whose compiled modules are up to date are only loaded."""
+
+		for uri in self.template_lookup.get_template_uris():
+			self.template_lookup.get_template(uri)
+
 	def _set_locals(self, environ: Dict[str, Any]) -> None:
+		start_context()
 		local.current_app = self
 		local.request = self.request_class(environ)
 		local.url_adapter = self.url_map.bind_to_environ(environ)
 		local.d = {}
+		local.timings = {}
 
 	def run_before_request_funcs(self) -> Optional[Union[str, Response]]:
 		for f in self._before_request_funcs:
@@ -144,9 +214,86 @@ class Application:
 				return rv
 		return None
 
+	def run_before_lightweight_request_funcs(
+		self,
+		environ: Dict[str, Any],
+		endpoint: str,
+		/,
+	) -> Optional[Response]:
+		for f in self._before_lightweight_request_funcs:
+			rv = f(environ, endpoint)
+			if rv is not None:
+				return rv
+		return None
+
 	def run_current_view(self) -> Union[str, Response]:
-		endpoint, values = url_adapter.match()
-		return self._views[endpoint](**values)
+		return self._views[request.endpoint](**request.view_args)
+
+	def run_teardown_request_funcs(self) -> None:
+		"""Runs after the response is sent, even if it failed. Errors
+		are logged, so that all functions are run."""
+
+		for f in self._teardown_request_funcs:
+			try:
+				f()
+			except Exception:
+				logger.exception("Teardown function %r failed.", f)
+
+	def dispatch_lightweight_request(
+		self,
+		environ: Dict[str, Any],
+		start_response: StartResponseType,
+	) -> Optional[Iterator[bytes]]:
+		"""Serves the request with a lightweight view, skipping middlewares,
+		`Request`, before request functions and the session cookie, but not
+		lightweight before request functions. Returns `None` if there is no
+		such view or it returned `None`, then the request is served by
+		`wsgi_app`."""
+
+		path = get_path_info(environ)
+		# Like in `url_map`, rules without variables win, e.g. "/s/create/"
+		# over "/s/<slug>/".
+		if path in self._static_paths:
+			return None
+		try:
+			endpoint, values = self._lightweight_url_adapter.match(
+				path, environ['REQUEST_METHOD'],
+			)
+		except HTTPException:
+			return None
+
+		self._got_first_request = True
+		started_at = time.perf_counter()
+		start_context()
+		local.current_app = self
+		local.timings = {}
+		try:
+			response = self.run_before_lightweight_request_funcs(
+				environ, endpoint,
+			)
+			if response is None:
+				with timed("view"):
+					response = self._lightweight_views[endpoint](
+						environ, **values,
+					)
+			if response is None:
+				self.run_teardown_request_funcs()
+				return None
+			app_iter = response(environ, start_response)
+			self._observe_request(endpoint, environ['REQUEST_METHOD'],
+  								response.status_code, started_at)
+		except BaseException:
+			self.run_teardown_request_funcs()
+			raise
+		return ClosingIterator(app_iter, self.run_teardown_request_funcs)
+
+	def _observe_request(self, endpoint: Optional[str], method: str,
+  						status: int, started_at: float, /) -> None:
+		if self.metrics is None:
+			return
+		timings = local.timings
+		timings['total'] = time.perf_counter() - started_at
+		self.metrics.observe(endpoint, method, status, timings)
 
 	def handle_exception(self, exc: Exception, /) -> Union[str, Response]:
 		handler = self._exception_handlers.get(exc.__class__)
@@ -163,14 +310,18 @@ class Application:
 		elif not isinstance(response, self.response_class):
 			raise TypeError("The function didn't return a valid response.")
 
-		request.session.save_cookie(response)
+		with timed("session"):
+			request.save_session(response)
 		return response
 
 	def dispatch_request(self) -> Response:
 		try:
-			response = self.run_before_request_funcs()
+			request.endpoint, request.view_args = url_adapter.match()
+			with timed("before_request"):
+				response = self.run_before_request_funcs()
 			if response is None:
-				response = self.run_current_view()
+				with timed("view"):
+					response = self.run_current_view()
 		except Exception as exc:
 			response = self.handle_exception(exc)
 
@@ -182,10 +333,88 @@ class Application:
 		start_response: StartResponseType,
 	) -> Iterator[bytes]:
 		self._got_first_request = True
+		started_at = time.perf_counter()
 		self._set_locals(environ)
 
-		response = self.dispatch_request()
-		return response(environ, start_response)
+		try:
+			response = self.dispatch_request()
+			app_iter = response(environ, start_response)
+		except BaseException:
+			self._observe_request(request.endpoint, request.method, 500,
+  								started_at)
+			self.run_teardown_request_funcs()
+			raise
+		self._observe_request(request.endpoint, request.method,
+  							response.status_code, started_at)
+		# Streamed responses may still use the database while iterated.
+		return ClosingIterator(app_iter, self.run_teardown_request_funcs)
+
+	def _match_async_view(
+		self,
+		environ: Dict[str, Any],
+		/,
+	) -> Optional[AsyncViewType]:
+		if not self._async_views:
+			return None
+		try:
+			endpoint, _ = self.url_map.bind_to_environ(environ).match()
+		except HTTPException:
+			return None
+		return self._async_views.get(endpoint)
+
+	async def dispatch_request_async(self, view: AsyncViewType, /) -> Response:
+		"""Like `dispatch_request`, but awaits the async view. The rest may
+		block, e.g. the rate limiter may call Redis and exception handlers
+		may render templates that query the database, so it's run in
+		threads."""
+
+		try:
+			request.endpoint, request.view_args = url_adapter.match()
+			with timed("before_request"):
+				response = await asyncio.to_thread(
+					self.run_before_request_funcs,
+				)
+			if response is None:
+				with timed("view"):
+					response = await view(**request.view_args)
+		except Exception as exc:
+			response = await asyncio.to_thread(self.handle_exception, exc)
+
+		return await asyncio.to_thread(self.finalize_request, response)
+
+	async def asgi_app(
+		self,
+		scope: ScopeType,
+		receive: ReceiveType,
+		send: SendType,
+	) -> None:
+		"""The ASGI entry point. Endpoints that have an async view (see
+		`add_url_rule`) are served on the event loop, the rest, including
+		static files, by `wsgi_app` in threads."""
+
+		if scope['type'] == "lifespan":
+			await handle_lifespan(receive, send)
+			return
+		elif scope['type'] != "http":
+			raise ValueError(f"Unsupported scope type \"{scope['type']}\".")
+
+		environ = make_environ(scope, await read_body(receive))
+		view = self._match_async_view(environ)
+		if view is None:
+			await run_wsgi_app(self, environ, send)
+			return
+
+		self._got_first_request = True
+		started_at = time.perf_counter()
+		self._set_locals(environ)
+		try:
+			response = await self.dispatch_request_async(view)
+			self._observe_request(request.endpoint, request.method,
+  								response.status_code, started_at)
+			await send_werkzeug_response(send, response, environ)
+		finally:
+			self.run_teardown_request_funcs()
+			local_manager.cleanup()
 
 	@setup_method
 	def add_url_rule(
@@ -194,10 +423,44 @@ class Application:
 		view: ViewType,
 		*,
 		methods: Tuple[str, ...] = ("GET",),
+		async_view: Optional[AsyncViewType] = None,
 	) -> None:
+		"""`async_view` replaces `view` when the application is served
+		with `asgi_app`. It must not block the event loop."""
+
 		endpoint = view.__name__
-		self.url_map.add(Rule(rule, endpoint=endpoint, methods=methods))
+		rule_obj = Rule(rule, endpoint=endpoint, methods=methods)
+		self.url_map.add(rule_obj)
+		if not rule_obj.arguments:
+			self._static_paths.add(rule)
 		self._views[endpoint] = view
+		if async_view is not None:
+			self._async_views[endpoint] = async_view
+
+	@setup_method
+	def add_lightweight_rule(
+		self,
+		rule: str,
+		view: LightweightViewType,
+		*,
+		endpoint: Optional[str] = None,
+		methods: Tuple[str, ...] = ("GET",),
+	) -> None:
+		"""Adds the rule that is matched before all others and is served
+		by `dispatch_lightweight_request`. Only `current_app` is available to
+		the view, not `request`, `current_user` or the session, so the view
+		gets the WSGI environ before the URL values. The view returns `None`
+		to let `wsgi_app` serve the request, e.g. to render an error page.
+		Use `add_url_rule` for the same rule too, so that `url_for` works
+		and there is a fallback, and pass its endpoint as `endpoint`, so
+		that e.g. rate limits of the endpoint apply to both."""
+
+		if endpoint is None:
+			endpoint = view.__name__
+		self.lightweight_url_map.add(
+			Rule(rule, endpoint=endpoint, methods=methods),
+		)
+		self._lightweight_views[endpoint] = view
 
 	@setup_method
 	def add_exception_handler(
@@ -210,3 +473,17 @@ class Application:
 	@setup_method
 	def run_before_request(self, f: BeforeRequestFuncType, /) -> None:
 		self._before_request_funcs.append(f)
+
+	@setup_method
+	def run_before_lightweight_request(
+		self,
+		f: BeforeLightweightRequestFuncType,
+		/,
+	) -> None:
+		"""`f` gets the WSGI environ and the endpoint of the lightweight
+		view and may return a response instead of the view."""
+		self._before_lightweight_request_funcs.append(f)
+
+	@setup_method
+	def run_teardown_request(self, f: TeardownRequestFuncType, /) -> None:
+		self._teardown_request_funcs.append(f)
@@ -0,0 +1,159 @@
+import sys
+import asyncio
+import contextvars
+from tempfile import SpooledTemporaryFile
+from typing import IO, Any, Dict, List, Tuple, Callable, Awaitable, \
+	TypeAlias
+
+from werkzeug.wrappers import Response
+
+
+ScopeType: TypeAlias = Dict[str, Any]
+ReceiveType: TypeAlias = Callable[[], Awaitable[Dict[str, Any]]]
+SendType: TypeAlias = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+async def read_body(receive: ReceiveType, /,
+ 					max_memory_size: int = 1024 * 1024) -> IO[bytes]:
+	"""Reads the request body into a file that is kept in memory until
+	it exceeds `max_memory_size`."""
+
+	rv = SpooledTemporaryFile(max_memory_size)
+	while True:
+		message = await receive()
+		if message['type'] == "http.disconnect":
+			break
+		rv.write(message.get("body", b""))
+		if not message.get("more_body", False):
+			break
+	rv.seek(0)
+	return rv
+
+
+def make_environ(scope: ScopeType, body: IO[bytes], /) -> Dict[str, Any]:
+	"""Translates ASGI HTTP connection scope to WSGI environ."""
+
+	# WSGI strings are bytes decoded as latin-1.
+	raw_path = scope.get("raw_path") or scope['path'].encode()
+	path = raw_path.split(b"?", 1)[0].decode("latin-1")
+	root_path = scope.get("root_path", "").encode().decode("latin-1")
+	if root_path and path.startswith(root_path):
+		path = path[len(root_path):]
+	server_name, server_port = scope.get("server") or ("localhost", 80)
+
+	environ = {
+		'REQUEST_METHOD': scope['method'],
+		'SCRIPT_NAME': root_path,
+		'PATH_INFO': path,
+		'QUERY_STRING': scope.get("query_string", b"").decode("latin-1"),
+		'SERVER_NAME': server_name,
+		'SERVER_PORT': str(server_port),
+		'SERVER_PROTOCOL': "HTTP/" + scope.get("http_version", "1.1"),
+		'wsgi.version': (1, 0),
+		'wsgi.url_scheme': scope.get("scheme", "http"),
+		'wsgi.input': body,
+		'wsgi.errors': sys.stderr,
+		'wsgi.multithread': True,
+		'wsgi.multiprocess': True,
+		'wsgi.run_once': False,
+	}
+	if scope.get("client"):
+		environ['REMOTE_ADDR'], environ['REMOTE_PORT'] \
+			= scope['client'][0], str(scope['client'][1])
+
+	for raw_name, raw_value in scope['headers']:
+		name = raw_name.decode("latin-1").upper().replace("-", "_")
+		value = raw_value.decode("latin-1")
+		if name not in {"CONTENT_TYPE", "CONTENT_LENGTH"}:
+			name = "HTTP_" + name
+		if name in environ:
+			value = environ[name] + "," + value
+		environ[name] = value
+
+	return environ
+
+
+def _make_start_message(status: int,
+  						headers: List[Tuple[str, str]], /) -> Dict[str, Any]:
+	return {
+		'type': "http.response.start",
+		'status': status,
+		'headers': [
+			(name.lower().encode("latin-1"), value.encode("latin-1"))
+			for name, value in headers
+		],
+	}
+
+
+def _make_body_message(chunk: bytes, /,
+ 					more_body: bool = True) -> Dict[str, Any]:
+	return {'type': "http.response.body", 'body': chunk,
+			'more_body': more_body}
+
+
+async def send_werkzeug_response(send: SendType, response: Response,
+ 								environ: Dict[str, Any], /) -> None:
+	"""Sends the response whose body doesn't block, e.g. a redirect."""
+
+	app_iter, status, headers = response.get_wsgi_response(environ)
+	try:
+		await send(_make_start_message(
+			int(status.split(None, 1)[0]), headers,
+		))
+		for chunk in app_iter:
+			if chunk:
+				await send(_make_body_message(chunk))
+		await send(_make_body_message(b"", more_body=False))
+	finally:
+		if hasattr(app_iter, "close"):
+			app_iter.close()
+
+
+async def run_wsgi_app(
+	wsgi_app: Callable,
+	environ: Dict[str, Any],
+	send: SendType,
+	/,
+) -> None:
+	"""Runs the WSGI application in the default executor, so that blocking
+	views and streamed bodies don't block the event loop. All the calls
+	share one context, so the locals set by the application are kept while
+	the body is iterated."""
+
+	loop = asyncio.get_running_loop()
+	context = contextvars.copy_context()
+
+	def run_in_context(f: Callable, *args: Any) -> Awaitable[Any]:
+		return loop.run_in_executor(None, context.run, f, *args)
+
+	started: List[Any] = []
+
+	def start_response(status: str, headers: List[Tuple[str, str]],
+  						exc_info: Any = None) -> Callable[[bytes], None]:
+		started[:] = [int(status.split(None, 1)[0]), headers]
+		return lambda data: None
+
+	app_iter = await run_in_context(wsgi_app, environ, start_response)
+	try:
+		iterator = iter(app_iter)
+		# `start_response` may be called when the first chunk is produced.
+		chunk = await run_in_context(next, iterator, b"")
+		await send(_make_start_message(*started))
+		while chunk is not None:
+			if chunk:
+				await send(_make_body_message(chunk))
+			chunk = await run_in_context(next, iterator, None)
+		await send(_make_body_message(b"", more_body=False))
+	finally:
+		if hasattr(app_iter, "close"):
+			await run_in_context(app_iter.close)
+
+
+async def handle_lifespan(receive: ReceiveType, send: SendType, /) -> None:
+	while True:
+		message = await receive()
+		if message['type'] == "lifespan.startup":
+			await send({'type': "lifespan.startup.complete"})
+		elif message['type'] == "lifespan.shutdown":
+			await send({'type': "lifespan.shutdown.complete"})
+			return
@@ -1,13 +1,27 @@
-from typing import Union, Callable, Optional
+from __future__ import annotations
 
-from .locals import request
+import time
+from collections.abc import Mapping
+from typing import Any, Dict, Tuple, Union, Callable, Optional
+
+from itsdangerous import BadData, URLSafeTimedSerializer
+
+from .cache import LRUCache
+from .locals import current_app, request
 
 
 class UserMixin:
+	# Attributes that are copied to `UserSnapshot`, besides the id.
+	snapshot_fields: Tuple[str, ...] = ()
+
 	@property
 	def is_authenticated(self) -> bool:
 		return True
 
+	@property
+	def is_active(self) -> bool:
+		return True
+
 	def get_id(self) -> int:
 		try:
 			return self.id  # type: ignore
@@ -16,10 +30,59 @@ class UserMixin:
 				"No `id` attribute. Please, override `get_id`.",
 			) from exc
 
+	def get_version(self) -> Any:
+		"""Must change when any of `snapshot_fields` changes."""
+		return None
+
+	def make_snapshot(self) -> Dict[str, Any]:
+		rv = {name: getattr(self, name) for name in self.snapshot_fields}
+		rv.update(id=self.get_id(), version=self.get_version())
+		return rv
+
 
 UserLoaderType = Callable[[int], Optional[UserMixin]]
 
 
+class UserSnapshot(UserMixin):
+	"""Stands for the user, so that requests that only need
+	`snapshot_fields` do not load the user. Any other attribute is taken
+	from the user that is loaded on the first access, see `load`."""
+
+	def __init__(self, data: Dict[str, Any], /,
+ 				user_loader: UserLoaderType) -> None:
+		self._data = data
+		self._user_loader = user_loader
+		self._user: Optional[UserMixin] = None
+
+	def __repr__(self) -> str:
+		return "<UserSnapshot id=%d>" % self.get_id()
+
+	def __getattr__(self, name: str) -> Any:
+		data = self.__dict__.get("_data", {})
+		if name in data:
+			return data[name]
+		return getattr(self.load(), name)
+
+	@property
+	def is_active(self) -> bool:
+		return self._data.get("is_active", True)
+
+	def get_id(self) -> int:
+		return self._data['id']
+
+	def get_version(self) -> Any:
+		return self._data['version']
+
+	def load(self) -> UserMixin:
+		"""Returns the loaded user, e.g. to change it."""
+
+		if self._user is None:
+			self._user = self._user_loader(self.get_id())
+			if self._user is None:
+				raise LookupError("The user no longer exists.")
+		return self._user
+
+
 class AnonymousUser:
 	@property
 	def is_authenticated(self) -> bool:
@@ -37,31 +100,178 @@ class LoginManager:
 	Accordingly, to avoid loading the user from the session into `get_user`
 	every time, we put the original user or `AnonymousUser` object into
 	`request._user`.
+
+	Most requests do not load the user at all. `get_user` returns
+	a `UserSnapshot` made from a process cache that keeps snapshots for
+	`cache_ttl` seconds, or from the snapshot in the session, which is
+	signed together with the session cookie. The session snapshot is
+	trusted for `snapshot_max_age` seconds, unless `invalidate_user` was
+	called for a newer version of the user. Both are disabled by zero.
 	"""
 
 	anonymous_user_class = AnonymousUser
+	user_snapshot_class = UserSnapshot
 
-	def __init__(self, user_loader: UserLoaderType) -> None:
+	token_salt = "auth-token"
+	token_max_age = 30 * 24 * 3600
+
+	def __init__(
+		self,
+		user_loader: UserLoaderType,
+		*,
+		cache_ttl: float = 0.0,
+		cache_max_size: int = 10000,
+		snapshot_max_age: float = 0.0,
+	) -> None:
 		self.user_loader = user_loader
+		self.snapshot_max_age = snapshot_max_age
+		self.user_cache = (
+			None if not cache_ttl
+			else LRUCache(cache_max_size, ttl=cache_ttl)
+		)
+		self._token_serializer: Optional[URLSafeTimedSerializer] = None
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /,
+ 					user_loader: UserLoaderType) -> LoginManager:
+		return cls(
+			user_loader,
+			cache_ttl=config.get("USER_CACHE_TTL", 0.0),
+			cache_max_size=config.get("USER_CACHE_MAX_SIZE", 10000),
+			snapshot_max_age=config.get("USER_SNAPSHOT_MAX_AGE", 0.0),
+		)
 
 	@classmethod
 	def _update_request_with_user(cls, user: Optional[UserMixin], /) -> None:
 		request._user = cls.anonymous_user_class() if user is None else user
 
+	@staticmethod
+	def _get_version_key(user_id: int, /) -> str:
+		return "user-version:%d" % user_id
+
+	def _is_snapshot_valid(self, data: Dict[str, Any], /) -> bool:
+		if time.time() - data['_made_at'] > self.snapshot_max_age:
+			return False
+
+		version = current_app.cache.get(self._get_version_key(data['id']))
+		return version is None or version == data['version']
+
+	def _cache_user(self, user: UserMixin, /) -> Dict[str, Any]:
+		data = user.make_snapshot()
+		if self.user_cache is not None:
+			self.user_cache.set(str(user.get_id()), data)
+		return data
+
+	def _load_snapshot(self, user_id: int, /) -> Optional[UserMixin]:
+		"""Returns the user from the process cache, from the session or,
+		if neither is valid, from the loader. Inactive users are treated
+		as anonymous."""
+
+		data = None
+		if self.user_cache is not None:
+			data = self.user_cache.get(str(user_id))
+		if data is None and self.snapshot_max_age:
+			data = request.session.get("_user")
+			if data is not None and (
+				data['id'] != user_id or not self._is_snapshot_valid(data)
+			):
+				data = None
+
+		if data is not None:
+			user: UserMixin = self.user_snapshot_class(data, self.user_loader)
+		else:
+			loaded_user = self.user_loader(user_id)
+			if loaded_user is None:
+				return None
+			user = loaded_user
+			data = self._cache_user(user)
+			if self.snapshot_max_age:
+				request.session['_user'] = {**data, '_made_at': time.time()}
+
+		return user if user.is_active else None
+
 	def _load_user(self) -> None:
 		user_id = request.session.get("_user_id")
-		user = None if user_id is None else self.user_loader(user_id)
+		user = None if user_id is None else self._load_snapshot(user_id)
 		self._update_request_with_user(user)
 
 	def login_user(self, user: UserMixin, /) -> None:
 		request.session['_user_id'] = user.get_id()
+		data = self._cache_user(user)
+		if self.snapshot_max_age:
+			request.session['_user'] = {**data, '_made_at': time.time()}
 		self._update_request_with_user(user)
 
 	def logout_user(self) -> None:
-		del request.session['_user_id']
+		user_id = request.session.pop("_user_id")
+		request.session.pop("_user", None)
+		if self.user_cache is not None:
+			self.user_cache.delete(str(user_id))
 		self._update_request_with_user(None)
 
+	def invalidate_user(self, user: UserMixin, /) -> None:
+		"""Must be called after any of `snapshot_fields` of the user is
+		changed. The snapshot is removed from the process cache, and other
+		sessions reload the user if `current_app.cache` is shared between
+		workers. Other processes may keep the snapshot for `cache_ttl`."""
+
+		if self.user_cache is not None:
+			self.user_cache.delete(str(user.get_id()))
+		if self.snapshot_max_age:
+			current_app.cache.set(
+				self._get_version_key(user.get_id()),
+				user.get_version(),
+				self.snapshot_max_age,
+			)
+
+	def get_full_user(self) -> Union[UserMixin, AnonymousUser]:
+		"""Like `get_user`, but loads the user if it is a snapshot."""
+
+		user = self.get_user()
+		return user.load() if isinstance(user, UserSnapshot) else user
+
 	def get_user(self) -> Union[UserMixin, AnonymousUser]:
 		if not hasattr(request, "_user"):
 			self._load_user()
 		return request._user
+
+	def _get_token_serializer(self) -> URLSafeTimedSerializer:
+		if self._token_serializer is None:
+			self._token_serializer = URLSafeTimedSerializer(
+				current_app.config['SECRET_KEY'],
+				salt=self.token_salt,
+			)
+		return self._token_serializer
+
+	def generate_token(self, user: UserMixin, /) -> str:
+		"""Generates a signed token for clients that can't keep the session
+		cookie, e.g. API clients. See `load_user_from_token`."""
+
+		return self._get_token_serializer().dumps(user.get_id())
+
+	def load_user_from_token(self, token: str, /) -> bool:
+		"""Authenticates the current request by the token without touching
+		the session. Returns `False` if the token is invalid, expired or
+		its user no longer exists or is not active."""
+
+		try:
+			user_id = self._get_token_serializer().loads(
+				token, max_age=self.token_max_age,
+			)
+		except BadData:
+			return False
+
+		user = None
+		if self.user_cache is not None:
+			data = self.user_cache.get(str(user_id))
+			if data is not None:
+				user = self.user_snapshot_class(data, self.user_loader)
+		if user is None:
+			user = self.user_loader(user_id)
+			if user is not None:
+				self._cache_user(user)
+		if user is None or not user.is_active:
+			return False
+
+		self._update_request_with_user(user)
+		return True
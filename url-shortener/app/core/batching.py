@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import atexit
+import logging
+from collections import Counter, deque
+from threading import Event, Lock, Thread
+from typing import Any, Dict, List, Deque, Hashable, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundFlusher:
+	"""Base class for objects that accumulate data in memory and write it
+	in batches from a background thread. The batch is written every
+	`interval` seconds, as soon as `threshold` pending items are collected
+	and once more at interpreter exit, so that nothing is lost when
+	the gunicorn worker is stopped.
+
+	A batch that fails to be written is put back and retried with the
+	next one. After `max_attempts` failures in a row it is dropped, so
+	that an item the database rejects doesn't stop all later writes.
+
+	The thread is started lazily on the first `_notify`, which keeps it
+	out of processes that never handle requests (e.g. alembic) and makes
+	it safe to create the object before the worker is forked.
+
+	Subclasses must implement `_drain`, `_write` and `_restore`, and may
+	count dropped items in `_discard`.
+	"""
+
+	thread_name = "background-flusher"
+
+	def __init__(self, *, interval: float = 1.0, threshold: int = 1000,
+ 				max_attempts: int = 5) -> None:
+		self.interval = interval
+		self.threshold = threshold
+		self.max_attempts = max_attempts
+		self._failed_attempts = 0
+
+		self._lock = Lock()
+		self._flush_lock = Lock()
+		self._wakeup = Event()
+		self._thread: Optional[Thread] = None
+
+	def _drain(self) -> Any:
+		"""Takes all pending items under `self._lock`."""
+		raise NotImplementedError
+
+	def _write(self, batch: Any, /) -> None:
+		raise NotImplementedError
+
+	def _restore(self, batch: Any, /) -> None:
+		"""Puts the batch back after a failed `_write`."""
+		raise NotImplementedError
+
+	def _discard(self, batch: Any, /) -> None:
+		"""Called with the batch dropped after `max_attempts` failures."""
+
+	def _start(self) -> None:
+		with self._lock:
+			if self._thread is not None:
+				return
+
+			self._thread = Thread(
+				target=self._run,
+				name=self.thread_name,
+				daemon=True,
+			)
+			self._thread.start()
+		atexit.register(self.flush)
+
+	def _run(self) -> None:
+		while True:
+			self._wakeup.wait(self.interval)
+			self._wakeup.clear()
+			self.flush()
+
+	def _notify(self, pending_count: int, /) -> None:
+		if self._thread is None:
+			self._start()
+		if pending_count >= self.threshold:
+			self._wakeup.set()
+
+	def flush(self) -> None:
+		with self._flush_lock:
+			batch = self._drain()
+			if not batch:
+				return
+
+			try:
+				self._write(batch)
+			except Exception:
+				self._failed_attempts += 1
+				if self._failed_attempts < self.max_attempts:
+					logger.exception("Failed to write the batch, will retry.")
+					self._restore(batch)
+					return
+				logger.exception(
+					"Failed to write the batch %d times, dropped it.",
+					self._failed_attempts,
+				)
+				self._discard(batch)
+			self._failed_attempts = 0
+
+
+class BatchCounter(BackgroundFlusher):
+	"""Sums increments per key in memory and passes them to `_write` as
+	a `{key: increment}` dictionary."""
+
+	thread_name = "batch-counter"
+
+	def __init__(self, **kwargs: Any) -> None:
+		super().__init__(**kwargs)
+		self._counts: Counter[Hashable] = Counter()
+
+	def incr(self, key: Hashable, /, n: int = 1) -> None:
+		with self._lock:
+			self._counts[key] += n
+			pending_count = len(self._counts)
+		self._notify(pending_count)
+
+	def _drain(self) -> Dict[Hashable, int]:
+		with self._lock:
+			rv, self._counts = self._counts, Counter()
+		return rv
+
+	def _restore(self, batch: Dict[Hashable, int], /) -> None:
+		with self._lock:
+			self._counts.update(batch)
+
+
+class BatchBuffer(BackgroundFlusher):
+	"""Keeps items in a ring buffer and passes them to `_write` as a list
+	in the order they were appended. When writes fall behind and the
+	buffer holds `capacity` items, the oldest ones are dropped and counted
+	in `dropped`, so that the memory of the worker stays bounded."""
+
+	thread_name = "batch-buffer"
+
+	def __init__(self, *, capacity: int = 100000, **kwargs: Any) -> None:
+		super().__init__(**kwargs)
+		self.capacity = capacity
+		self.dropped = 0
+		self._items: Deque[Any] = deque()
+
+	def append(self, item: Any, /) -> None:
+		with self._lock:
+			if len(self._items) >= self.capacity:
+				self._items.popleft()
+				self.dropped += 1
+			self._items.append(item)
+			pending_count = len(self._items)
+		self._notify(pending_count)
+
+	def _drain(self) -> List[Any]:
+		with self._lock:
+			rv = list(self._items)
+			self._items.clear()
+		return rv
+
+	def _restore(self, batch: List[Any], /) -> None:
+		with self._lock:
+			self._items.extendleft(reversed(batch))
+			while len(self._items) > self.capacity:
+				self._items.popleft()
+				self.dropped += 1
+
+	def _discard(self, batch: List[Any], /) -> None:
+		with self._lock:
+			self.dropped += len(batch)
@@ -0,0 +1,54 @@
+import math
+from hashlib import blake2b
+from typing import Iterator
+
+
+class BloomFilter:
+	"""A set of strings that answers "maybe present" or "definitely absent"
+	in about `1.44 * log2(1 / false_positive_rate)` bits per value, i.e.
+	1.2 bytes per value at 1%. Values can't be removed. Once more than
+	`capacity` values are added, the false positive rate grows, so the
+	filter should be rebuilt larger.
+
+	:param capacity: The expected number of values.
+	:param false_positive_rate: The rate of "maybe present" answers for
+		absent values at `capacity`.
+	"""
+
+	def __init__(self, capacity: int, /,
+ 				false_positive_rate: float = 0.01) -> None:
+		if capacity < 1:
+			raise ValueError("The capacity must be positive.")
+		if not 0 < false_positive_rate < 1:
+			raise ValueError("The false positive rate must be from 0 to 1.")
+
+		self.capacity = capacity
+		self.count = 0
+		self.size = math.ceil(
+			-capacity * math.log(false_positive_rate) / math.log(2) ** 2,
+		)
+		self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+		self.bits = bytearray((self.size + 7) // 8)
+
+	def __contains__(self, value: str) -> bool:
+		bits = self.bits
+		return all(
+			bits[position >> 3] & (1 << (position & 7))
+			for position in self._get_positions(value)
+		)
+
+	def _get_positions(self, value: str, /) -> Iterator[int]:
+		# Double hashing, the positions are `h1 + i * h2`.
+		digest = blake2b(value.encode(), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], "little")
+		h2 = int.from_bytes(digest[8:], "little") | 1
+		return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+	@property
+	def is_full(self) -> bool:
+		return self.count >= self.capacity
+
+	def add(self, value: str, /) -> None:
+		for position in self._get_positions(value):
+			self.bits[position >> 3] |= 1 << (position & 7)
+		self.count += 1
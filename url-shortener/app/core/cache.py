@@ -0,0 +1,384 @@
+from __future__ import annotations
+
+import os
+import time
+import pickle
+import logging
+import tempfile
+from hashlib import sha1
+from pathlib import Path
+from threading import Lock
+from dataclasses import dataclass
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Dict, List, Type, Tuple, Optional
+
+
+MISSING = object()
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheStats:
+	hits: int = 0
+	misses: int = 0
+	evictions: int = 0
+	expirations: int = 0
+
+	@property
+	def hit_ratio(self) -> float:
+		total = self.hits + self.misses
+		return self.hits / total if total else 0.0
+
+
+class BaseCache:
+	"""The interface of all cache backends. Keys are strings and are
+	prefixed with `key_prefix`, so that several applications can share
+	one storage. `None` is a valid value to cache, so use `default` to
+	distinguish a miss from a cached `None`:
+
+		rv = cache.get(key, MISSING)
+		if rv is MISSING:
+			...
+
+	Backends implement `_get`, `_set`, `_delete` and `_clear`, which work
+	with already prefixed keys. `_get` returns `MISSING` on a miss.
+
+	:param ttl: Default time to live of entries in seconds. `None` means
+		that entries live as long as the backend keeps them.
+	:param key_prefix: The prefix of all keys.
+	"""
+
+	def __init__(self, *, ttl: Optional[float] = None,
+ 				key_prefix: str = "") -> None:
+		self.ttl = ttl
+		self.key_prefix = key_prefix
+		self.stats = CacheStats()
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> BaseCache:
+		return cls(
+			ttl=config.get("CACHE_DEFAULT_TTL"),
+			key_prefix=config.get("CACHE_KEY_PREFIX", ""),
+		)
+
+	def _get(self, key: str, /) -> Any:
+		raise NotImplementedError
+
+	def _set(self, key: str, value: Any, ttl: Optional[float], /) -> None:
+		raise NotImplementedError
+
+	def _delete(self, key: str, /) -> None:
+		raise NotImplementedError
+
+	def _clear(self) -> None:
+		raise NotImplementedError
+
+	def get(self, key: str, default: Any = None) -> Any:
+		rv = self._get(self.key_prefix + key)
+		if rv is MISSING:
+			self.stats.misses += 1
+			return default
+
+		self.stats.hits += 1
+		return rv
+
+	def set(self, key: str, value: Any, /,
+ 			ttl: Optional[float] = None) -> None:
+		self._set(self.key_prefix + key, value,
+  				self.ttl if ttl is None else ttl)
+
+	def delete(self, key: str, /) -> None:
+		self._delete(self.key_prefix + key)
+
+	def clear(self) -> None:
+		"""Removes all keys with `key_prefix`."""
+		self._clear()
+
+	def namespace(self, name: str, /,
+  				ttl: Optional[float] = None) -> Namespace:
+		return Namespace(self, name, ttl)
+
+
+class Namespace:
+	"""A view of the cache in which all keys are prefixed with
+	`"<name>:"` and that has its own default time to live."""
+
+	def __init__(self, cache: BaseCache, name: str, /,
+ 				ttl: Optional[float] = None) -> None:
+		self.cache = cache
+		self.name = name
+		self.ttl = ttl
+
+	def _make_key(self, key: str, /) -> str:
+		return "%s:%s" % (self.name, key)
+
+	def get(self, key: str, default: Any = None) -> Any:
+		return self.cache.get(self._make_key(key), default)
+
+	def set(self, key: str, value: Any, /,
+ 			ttl: Optional[float] = None) -> None:
+		self.cache.set(self._make_key(key), value,
+  					self.ttl if ttl is None else ttl)
+
+	def delete(self, key: str, /) -> None:
+		self.cache.delete(self._make_key(key))
+
+
+class LRUCache(BaseCache):
+	"""Thread-safe in-process cache bounded both by the number of entries
+	and by their age. When the cache is full, the least recently used entry
+	is evicted. Expired entries are removed lazily when they are accessed.
+
+	Every gunicorn worker has its own copy, so use it when the data can be
+	a little stale, or in development and tests.
+
+	:param max_size: Maximum number of entries.
+	"""
+
+	def __init__(self, max_size: int = 1024, **kwargs: Any) -> None:
+		if max_size < 1:
+			raise ValueError("The cache must hold at least one entry.")
+		super().__init__(**kwargs)
+
+		self.max_size = max_size
+
+		self._lock = Lock()
+		self._entries: OrderedDict[str, Tuple[Any, Optional[float]]] \
+			= OrderedDict()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> BaseCache:
+		return cls(
+			config.get("CACHE_MAX_SIZE", 1024),
+			ttl=config.get("CACHE_DEFAULT_TTL"),
+			key_prefix=config.get("CACHE_KEY_PREFIX", ""),
+		)
+
+	def _get(self, key: str, /) -> Any:
+		with self._lock:
+			try:
+				value, expires_at = self._entries[key]
+			except KeyError:
+				return MISSING
+
+			if expires_at is not None and expires_at <= time.monotonic():
+				del self._entries[key]
+				self.stats.expirations += 1
+				return MISSING
+
+			self._entries.move_to_end(key)
+			return value
+
+	def _set(self, key: str, value: Any, ttl: Optional[float], /) -> None:
+		expires_at = None if ttl is None else time.monotonic() + ttl
+
+		with self._lock:
+			self._entries[key] = (value, expires_at)
+			self._entries.move_to_end(key)
+
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+				self.stats.evictions += 1
+
+	def _delete(self, key: str, /) -> None:
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def _clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+
+
+class FileCache(BaseCache):
+	"""Stores pickled entries as files in `directory`. All workers on
+	the same host share it, which makes it a local stand-in for
+	`RedisCache` that needs no network.
+
+	Every `prune_every` writes, if there are more than `max_size` files,
+	expired and then the oldest entries are removed.
+	"""
+
+	file_suffix = ".cache"
+	prune_every = 100
+
+	def __init__(self, directory: os.PathLike, max_size: int = 10000,
+ 				**kwargs: Any) -> None:
+		super().__init__(**kwargs)
+
+		self.directory = Path(directory)
+		self.directory.mkdir(parents=True, exist_ok=True)
+		self.max_size = max_size
+		self._sets_count = 0
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> BaseCache:
+		return cls(
+			config['CACHE_URI'],
+			config.get("CACHE_MAX_SIZE", 10000),
+			ttl=config.get("CACHE_DEFAULT_TTL"),
+			key_prefix=config.get("CACHE_KEY_PREFIX", ""),
+		)
+
+	def _get_path(self, key: str, /) -> Path:
+		name = sha1(key.encode()).hexdigest() + self.file_suffix
+		return self.directory.joinpath(name)
+
+	def _get_paths(self) -> List[Path]:
+		return list(self.directory.glob("*" + self.file_suffix))
+
+	def _prune(self) -> None:
+		paths = self._get_paths()
+		if len(paths) <= self.max_size:
+			return
+
+		now = time.time()
+		alive_entries = []
+		for path in paths:
+			try:
+				with path.open("rb") as f:
+					expires_at = pickle.load(f)
+				mtime = path.stat().st_mtime
+			except (OSError, EOFError, pickle.UnpicklingError):
+				continue
+
+			if expires_at is not None and expires_at <= now:
+				path.unlink(missing_ok=True)
+				self.stats.expirations += 1
+			else:
+				alive_entries.append((mtime, path))
+
+		alive_entries.sort()
+		for _, path in alive_entries[:len(alive_entries) - self.max_size]:
+			path.unlink(missing_ok=True)
+			self.stats.evictions += 1
+
+	def _get(self, key: str, /) -> Any:
+		path = self._get_path(key)
+
+		try:
+			with path.open("rb") as f:
+				expires_at = pickle.load(f)
+				if expires_at is None or expires_at > time.time():
+					return pickle.load(f)
+		except FileNotFoundError:
+			return MISSING
+		except (OSError, EOFError, pickle.UnpicklingError):
+			pass
+
+		path.unlink(missing_ok=True)
+		self.stats.expirations += 1
+		return MISSING
+
+	def _set(self, key: str, value: Any, ttl: Optional[float], /) -> None:
+		expires_at = None if ttl is None else time.time() + ttl
+
+		fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+		try:
+			with os.fdopen(fd, "wb") as f:
+				pickle.dump(expires_at, f, pickle.HIGHEST_PROTOCOL)
+				pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp_path, self._get_path(key))
+		except BaseException:
+			os.unlink(tmp_path)
+			raise
+
+		self._sets_count += 1
+		if self._sets_count % self.prune_every == 0:
+			self._prune()
+
+	def _delete(self, key: str, /) -> None:
+		self._get_path(key).unlink(missing_ok=True)
+
+	def _clear(self) -> None:
+		"""Removes all files, since the keys can't be recovered from
+		file names to filter them by `key_prefix`."""
+
+		for path in self._get_paths():
+			path.unlink(missing_ok=True)
+
+
+class RedisCache(BaseCache):
+	"""Stores pickled entries in Redis or in any server that speaks its
+	protocol, so that all workers and hosts share one cache.
+
+	Requires the optional `redis` package. When the server is unavailable,
+	reads are misses and writes are skipped, so the application keeps
+	working from the database.
+
+	:param uri: The `redis://` URI of the server.
+	"""
+
+	def __init__(self, uri: str, /, **kwargs: Any) -> None:
+		try:
+			import redis
+		except ImportError as exc:
+			raise RuntimeError(
+				"Install the `redis` package to use `RedisCache`.",
+			) from exc
+		super().__init__(**kwargs)
+
+		self.client = redis.Redis.from_url(uri)
+		self._errors: Tuple[Type[Exception], ...] = (redis.RedisError,)
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> BaseCache:
+		return cls(
+			config['CACHE_URI'],
+			ttl=config.get("CACHE_DEFAULT_TTL"),
+			key_prefix=config.get("CACHE_KEY_PREFIX", ""),
+		)
+
+	def _get(self, key: str, /) -> Any:
+		try:
+			rv = self.client.get(key)
+		except self._errors:
+			logger.warning("Failed to read the cache.", exc_info=True)
+			return MISSING
+		return MISSING if rv is None else pickle.loads(rv)
+
+	def _set(self, key: str, value: Any, ttl: Optional[float], /) -> None:
+		data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+		try:
+			self.client.set(
+				key, data, px=None if ttl is None else int(ttl * 1000),
+			)
+		except self._errors:
+			logger.warning("Failed to write the cache.", exc_info=True)
+
+	def _delete(self, key: str, /) -> None:
+		try:
+			self.client.delete(key)
+		except self._errors:
+			logger.warning("Failed to delete from the cache.", exc_info=True)
+
+	def _clear(self) -> None:
+		try:
+			keys = list(self.client.scan_iter(match=self.key_prefix + "*"))
+			if keys:
+				self.client.delete(*keys)
+		except self._errors:
+			logger.warning("Failed to clear the cache.", exc_info=True)
+
+
+CACHE_BACKENDS: Dict[str, Type[BaseCache]] = {
+	'memory': LRUCache,
+	'file': FileCache,
+	'redis': RedisCache,
+}
+
+
+def create_cache(config: Mapping[str, Any], /) -> BaseCache:
+	"""Creates the cache backend named by `config['CACHE_BACKEND']`, which
+	is one of `CACHE_BACKENDS` keys and defaults to `"memory"`."""
+
+	backend = config.get("CACHE_BACKEND", "memory")
+	try:
+		cache_class = CACHE_BACKENDS[backend]
+	except KeyError as exc:
+		raise ValueError(f"Unknown cache backend \"{backend}\".") from exc
+	return cache_class.from_config(config)
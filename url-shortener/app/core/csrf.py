@@ -1,8 +1,13 @@
 from __future__ import annotations
 
-import os
-from hashlib import sha1
+import hmac
+import time
+import base64
+import secrets
+from hashlib import sha256
 from urllib.parse import urlparse
+from collections.abc import Mapping
+from typing import Any, Set, Dict, Type, Callable, Sequence
 
 from werkzeug.security import safe_str_cmp
 from werkzeug.exceptions import BadRequest
@@ -18,24 +23,157 @@ CSRF_FIELD_NAME = "csrf_token"
 CSRF_REQUEST_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
 
 
+class BaseCSRFSigner:
+	"""Signs the random token of the session for forms and verifies the
+	signed tokens. Tokens are signed with the first of `secret_keys` and
+	verified with any of them, so that the secret key can be rotated
+	without rejecting the forms that are already open: put the new key
+	first and remove the old one after `max_age` seconds.
+
+	Signers implement `sign` and `verify`. They are built once per
+	application, so the keys are derived only once.
+	"""
+
+	def __init__(self, secret_keys: Sequence[str], /,
+ 				max_age: int = CSRF_MAX_AGE) -> None:
+		if not secret_keys:
+			raise ValueError("No secret keys.")
+		self.secret_keys = list(secret_keys)
+		self.max_age = max_age
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> BaseCSRFSigner:
+		return cls(
+			[config['SECRET_KEY'], *config.get("SECRET_KEY_FALLBACKS", ())],
+			config.get("CSRF_MAX_AGE", CSRF_MAX_AGE),
+		)
+
+	def sign(self, session_token: str, /) -> str:
+		raise NotImplementedError
+
+	def verify(self, token: str, session_token: str, /) -> None:
+		"""Raises `ValidationError` if the token is not a valid signature of
+		the session token."""
+		raise NotImplementedError
+
+
+class SerializerCSRFSigner(BaseCSRFSigner):
+	"""Signs with `itsdangerous`, so the tokens are the JSON encoded
+	session token with a timestamp and a signature."""
+
+	def __init__(self, *args: Any, **kwargs: Any) -> None:
+		super().__init__(*args, **kwargs)
+		self.serializers = [
+			URLSafeTimedSerializer(secret_key, salt=CSRF_SALT)
+			for secret_key in self.secret_keys
+		]
+
+	def sign(self, session_token: str, /) -> str:
+		return self.serializers[0].dumps(session_token)
+
+	def verify(self, token: str, session_token: str, /) -> None:
+		for serializer in self.serializers:
+			try:
+				raw_token = serializer.loads(token, max_age=self.max_age)
+			except SignatureExpired as exc:
+				raise ValidationError("The CSRF token has expired.") from exc
+			except BadData:
+				continue
+
+			if not safe_str_cmp(session_token, raw_token):
+				raise ValidationError("The CSRF tokens do not match.")
+			return
+		raise ValidationError("The CSRF token is invalid.")
+
+
+class HMACCSRFSigner(BaseCSRFSigner):
+	"""Signs the session token and the time with HMAC-SHA256 of keys that
+	are derived from the secret keys. The token is only the hex time and
+	the signature, which takes no serialization and is shorter than the
+	tokens of `SerializerCSRFSigner`. Tokens of other sessions are
+	invalid, as the session token is not in the token."""
+
+	def __init__(self, *args: Any, **kwargs: Any) -> None:
+		super().__init__(*args, **kwargs)
+		# Copied for every signature, so that the keys are not hashed
+		# again.
+		self._macs = [
+			hmac.new(
+				hmac.new(secret_key.encode(), CSRF_SALT.encode(), sha256)
+				.digest(),
+				digestmod=sha256,
+			)
+			for secret_key in self.secret_keys
+		]
+
+	@staticmethod
+	def _get_signature(mac: hmac.HMAC, session_token: str,
+  					timestamp: str, /) -> str:
+		mac = mac.copy()
+		mac.update(b"%s.%s" % (session_token.encode(), timestamp.encode()))
+		return base64.urlsafe_b64encode(mac.digest()).rstrip(b"=").decode()
+
+	def sign(self, session_token: str, /) -> str:
+		timestamp = "%x" % int(time.time())
+		return "%s.%s" % (
+			timestamp, self._get_signature(self._macs[0], session_token,
+  										timestamp),
+		)
+
+	def verify(self, token: str, session_token: str, /) -> None:
+		timestamp, _, signature = token.partition(".")
+		try:
+			signed_at = int(timestamp, 16)
+		except ValueError as exc:
+			raise ValidationError("The CSRF token is invalid.") from exc
+
+		for mac in self._macs:
+			if hmac.compare_digest(
+				signature, self._get_signature(mac, session_token, timestamp),
+			):
+				break
+		else:
+			raise ValidationError("The CSRF token is invalid.")
+
+		if time.time() - signed_at > self.max_age:
+			raise ValidationError("The CSRF token has expired.")
+
+
+CSRF_SIGNERS: Dict[str, Type[BaseCSRFSigner]] = {
+	'serializer': SerializerCSRFSigner,
+	'hmac': HMACCSRFSigner,
+}
+
+
+def create_csrf_signer(config: Mapping[str, Any], /) -> BaseCSRFSigner:
+	"""Creates the signer named by `config['CSRF_SIGNER']`, which is one
+	of `CSRF_SIGNERS` keys and defaults to `"serializer"`."""
+
+	signer = config.get("CSRF_SIGNER", "serializer")
+	try:
+		signer_class = CSRF_SIGNERS[signer]
+	except KeyError as exc:
+		raise ValueError(f"Unknown CSRF signer \"{signer}\".") from exc
+	return signer_class.from_config(config)
+
+
 def generate_csrf_token() -> str:
 	"""First it generates a raw token by placing it in
 	the `request.session` object, then signs the raw token
 	for placement in the form and puts it in the local `d`
 	dictionary."""
 
-	if CSRF_FIELD_NAME not in d:
-		serializer = URLSafeTimedSerializer(
-			current_app.config['SECRET_KEY'],
-			salt=CSRF_SALT,
-		)
-
-		if CSRF_FIELD_NAME not in request.session:
-			request.session[CSRF_FIELD_NAME] = sha1(os.urandom(64)).hexdigest()
+	rv = d.get(CSRF_FIELD_NAME)
+	if rv is None:
+		session = request.session
+		session_token = session.get(CSRF_FIELD_NAME)
+		if session_token is None:
+			session_token = session[CSRF_FIELD_NAME] = secrets.token_hex(20)
 
-		d[CSRF_FIELD_NAME] = serializer.dumps(request.session[CSRF_FIELD_NAME])
+		rv = d[CSRF_FIELD_NAME] \
+			= current_app.csrf_protect.signer.sign(session_token)
 
-	return d[CSRF_FIELD_NAME]
+	return rv
 
 
 def validate_csrf_token(token: str, /) -> None:
@@ -44,21 +182,10 @@ def validate_csrf_token(token: str, /) -> None:
 	elif CSRF_FIELD_NAME not in request.session:
 		raise ValidationError("The CSRF session token is missing.")
 
-	serializer = URLSafeTimedSerializer(
-		current_app.config['SECRET_KEY'],
-		salt=CSRF_SALT,
+	current_app.csrf_protect.signer.verify(
+		token, request.session[CSRF_FIELD_NAME],
 	)
 
-	try:
-		raw_token = serializer.loads(token, max_age=CSRF_MAX_AGE)
-	except SignatureExpired as exc:
-		raise ValidationError("The CSRF token has expired.") from exc
-	except BadData as exc:
-		raise ValidationError("The CSRF token is invalid.") from exc
-
-	if not safe_str_cmp(request.session[CSRF_FIELD_NAME], raw_token):
-		raise ValidationError("The CSRF tokens do not match.")
-
 
 class CSRFError(BadRequest):
 	description = "CSRF validation failed."
@@ -74,8 +201,17 @@ class CSRFProtect:
 	"""
 
 	def __init__(self, app, /) -> None:
+		self.signer = create_csrf_signer(app.config)
+		self._exempt_endpoints: Set[str] = set()
 		app.run_before_request(self.protect)
 
+	def exempt(self, view: Callable, /) -> Callable:
+		"""Disables the check for the view, e.g. for API views that are
+		authenticated by a token instead of the session cookie."""
+
+		self._exempt_endpoints.add(view.__name__)
+		return view
+
 	@staticmethod
 	def _check_same_origin() -> bool:
 		host = urlparse("https://%s/" % request.host)
@@ -88,7 +224,10 @@ class CSRFProtect:
 		)
 
 	def protect(self) -> None:
-		if request.method not in CSRF_REQUEST_METHODS:
+		if (
+			request.method not in CSRF_REQUEST_METHODS
+			or request.endpoint in self._exempt_endpoints
+		):
 			return
 
 		try:
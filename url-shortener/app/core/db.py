@@ -1,14 +1,29 @@
 from __future__ import annotations
 
+import json
+import time
+import base64
+import logging
+import binascii
 from math import ceil
-from typing import List
-from dataclasses import dataclass
+from threading import Lock
+from collections.abc import Mapping
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Union, Iterator, Optional, Sequence, \
+	AsyncIterator, ContextManager, TYPE_CHECKING
+from dataclasses import dataclass, replace
 
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declared_attr, as_declarative
 from werkzeug.exceptions import abort
+if TYPE_CHECKING:
+	from sqlalchemy.ext.asyncio import AsyncEngine, AsyncConnection
 
-from .locals import request
+from .locals import request, get_context_id
+
+
+logger = logging.getLogger(__name__)
 
 
 class Query(sa.orm.Query):
@@ -24,9 +39,23 @@ class Query(sa.orm.Query):
 			abort(404)
 		return rv
 
-	def paginate(self, per_page: int) -> Pagination:
+	def paginate(
+		self,
+		per_page: int,
+		*,
+		count: Optional[int] = None,
+		keyset: Optional[Sequence[sa.Column]] = None,
+	) -> Union[Pagination, KeysetPagination]:
+		"""Returns the page from `?page` parameter using `OFFSET`. Pass
+		`count` if the number of objects is already known (e.g. cached) to
+		avoid `SELECT COUNT(*)`.
+
+		If `keyset` columns are passed, see `_paginate_by_keyset`."""
+
 		if per_page < 1:
 			raise ValueError("There must be at least one object per page.")
+		if keyset is not None:
+			return self._paginate_by_keyset(per_page, keyset, count)
 
 		current_page_number \
 			= request.args.get("page", 1, type=int) if request else 1
@@ -40,15 +69,214 @@ class Query(sa.orm.Query):
 		if not items and current_page_number > 1:
 			abort(404)
 
-		pages_count = ceil(self.count() / per_page)
+		if count is None:
+			count = self.count()
+		pages_count = ceil(count / per_page)
 		return Pagination(current_page_number, pages_count, items)
 
+	def _paginate_by_keyset(
+		self,
+		per_page: int,
+		columns: Sequence[sa.Column],
+		count: Optional[int],
+		/,
+	) -> KeysetPagination:
+		"""Returns the page that follows the `?cursor` parameter or precedes
+		the `?before` parameter, ordered by `columns` in descending order.
+		It needs neither `OFFSET` nor `COUNT(*)`, so a deep page costs as
+		much as the first one if there is an index on `columns`. The columns
+		must be unique together and not nullable, e.g. `(created_at, id)`.
+
+		Page numbers can't be derived from a cursor, so `?page` is trusted
+		and is only used for display, like `count`, which may be cached
+		and therefore approximate."""
+
+		cursor = request.args.get("cursor") if request else None
+		before = request.args.get("before") if request else None
+		current_page_number = 1
+		if cursor or before:
+			current_page_number \
+				= max(request.args.get("page", 2, type=int), 1)
+
+		key = sa.tuple_(*columns)
+		query = self
+		if before:
+			query = query \
+				.filter(key > sa.tuple_(*decode_cursor(before, columns))) \
+				.order_by(*(column.asc() for column in columns))
+		else:
+			if cursor:
+				values = decode_cursor(cursor, columns)
+				query = query.filter(key < sa.tuple_(*values))
+			query = query.order_by(*(column.desc() for column in columns))
+
+		items = query.limit(per_page + 1).all()
+		has_more = len(items) > per_page
+		items = items[:per_page]
+
+		if before:
+			items.reverse()
+			has_previous_page, has_next_page = has_more, True
+		else:
+			has_previous_page, has_next_page = bool(cursor), has_more
+		# Trusted `?page` may be wrong if objects were added or deleted.
+		if not has_previous_page:
+			current_page_number = 1
+
+		def make_cursor(obj: Model, /) -> str:
+			return encode_cursor([getattr(obj, c.key) for c in columns])
+
+		pages_count = None
+		if count is not None:
+			pages_count = max(
+				ceil(count / per_page),
+				current_page_number + int(has_next_page),
+			)
+
+		return KeysetPagination(
+			items,
+			current_page_number,
+			pages_count,
+			make_cursor(items[-1]) if has_next_page and items else None,
+			make_cursor(items[0]) if has_previous_page and items else None,
+		)
+
+
+class ReplicaSet:
+	"""Replica engines that are used in turn. A replica that failed to
+	connect is skipped for `retry_interval` seconds."""
+
+	def __init__(self, engines: Sequence[sa.engine.Engine], /,
+ 				retry_interval: float = 30.0) -> None:
+		self.engines = list(engines)
+		self.retry_interval = retry_interval
+
+		self._lock = Lock()
+		self._next_index = 0
+		self._down_until: Dict[sa.engine.Engine, float] = {}
+
+	def __bool__(self) -> bool:
+		return bool(self.engines)
+
+	def iter_healthy(self) -> Iterator[sa.engine.Engine]:
+		"""Yields healthy replicas starting from the next one in turn."""
+
+		with self._lock:
+			start = self._next_index
+			self._next_index = (start + 1) % len(self.engines)
+
+		for i in range(len(self.engines)):
+			engine = self.engines[(start + i) % len(self.engines)]
+			if self._down_until.get(engine, 0.0) <= time.monotonic():
+				yield engine
+
+	def mark_down(self, engine: sa.engine.Engine, /) -> None:
+		self._down_until[engine] = time.monotonic() + self.retry_interval
+
+
+class RoutingSession(sa.orm.Session):
+	"""Uses the primary database, except for reads inside `using_replica`
+	blocks, which go to one of `replicas`. If no replica can be connected
+	to, the primary is used.
+
+	The replica is chosen on the first read and kept until the session is
+	closed, so that reads of one request see one state of the data.
+
+	Once the session has written something, all its reads go to the
+	primary, so that they see the writes. Since replicas lag behind, the
+	next requests of the client that committed a write also use the primary
+	for `replica_stickiness` seconds."""
+
+	def __init__(
+		self,
+		*args: Any,
+		replicas: Optional[ReplicaSet] = None,
+		replica_stickiness: float = 0.0,
+		**kwargs: Any,
+	) -> None:
+		super().__init__(*args, **kwargs)
+		self.replicas = replicas
+		self.replica_stickiness = replica_stickiness
+
+		self._replica_depth = 0
+		self._has_written = False
+		self._replica: Optional[sa.engine.Engine] = None
+
+	@contextmanager
+	def using_replica(self) -> Iterator[None]:
+		self._replica_depth += 1
+		try:
+			yield
+		finally:
+			self._replica_depth -= 1
+
+	def _is_sticky(self) -> bool:
+		return (
+			bool(request)
+			and request.session_cookie_name in request.cookies
+			and request.session.get("_primary_until", 0.0) > time.time()
+		)
+
+	def _connect_replica(self) -> Optional[sa.engine.Engine]:
+		assert self.replicas
+		for engine in self.replicas.iter_healthy():
+			try:
+				self.connection(bind_arguments={'bind': engine})
+			except sa.exc.DBAPIError:
+				logger.warning("Replica %r is down.", engine.url, exc_info=True)
+				self.replicas.mark_down(engine)
+				continue
+			return engine
+		return None
+
+	def get_bind(
+		self,
+		mapper: Any = None,
+		clause: Any = None,
+		**kwargs: Any,
+	) -> Union[sa.engine.Engine, sa.engine.Connection]:
+		if self._flushing or getattr(clause, "is_dml", False):
+			self._has_written = True
+		elif (
+			self._replica_depth and self.replicas
+			and not self._has_written and not self._is_sticky()
+		):
+			if self._replica is None:
+				self._replica = self._connect_replica()
+			if self._replica is not None:
+				return self._replica
+		return super().get_bind(mapper, clause, **kwargs)
+
+	def close(self) -> None:
+		super().close()
+		self._has_written = False
+		self._replica = None
+
+	def commit(self) -> None:
+		super().commit()
+		# Only for clients that use the session, e.g. not for API clients.
+		if (
+			self._has_written and self.replica_stickiness
+			and request and request.is_session_loaded
+		):
+			request.session['_primary_until'] \
+				= time.time() + self.replica_stickiness
+
 
 session = sa.orm.scoped_session(
-	sa.orm.sessionmaker(query_cls=Query),
+	sa.orm.sessionmaker(class_=RoutingSession, query_cls=Query),
+	# Not thread-local, since an async request may use several threads.
+	scopefunc=get_context_id,
 )
 
 
+def read_from_replica() -> ContextManager[None]:
+	"""Routes reads of the current session to a replica inside the `with`
+	block. Use it for reads that can be a little stale."""
+
+	return session().using_replica()
+
+
 @as_declarative()
 class Model:
 	id = sa.Column(sa.Integer, primary_key=True)
@@ -65,16 +293,248 @@ class Model:
 		return '<%s id=%d>' % (self.__class__.__name__, self.id)
 
 
+@dataclass
+class PoolWaitStats:
+	checkouts: int = 0
+	timeouts: int = 0
+	total_wait_time: float = 0.0
+	max_wait_time: float = 0.0
+
+
+class TimedQueuePool(sa.pool.QueuePool):
+	"""`QueuePool` that measures how long checkouts wait for a free
+	connection (including opening a new one when overflowing)."""
+
+	def __init__(self, *args: Any, **kwargs: Any) -> None:
+		super().__init__(*args, **kwargs)
+		self.wait_stats = PoolWaitStats()
+		self._wait_stats_lock = Lock()
+
+	def _do_get(self) -> Any:
+		started_at = time.perf_counter()
+		try:
+			return super()._do_get()
+		except sa.exc.TimeoutError:
+			with self._wait_stats_lock:
+				self.wait_stats.timeouts += 1
+			raise
+		finally:
+			wait_time = time.perf_counter() - started_at
+			with self._wait_stats_lock:
+				self.wait_stats.checkouts += 1
+				self.wait_stats.total_wait_time += wait_time
+				self.wait_stats.max_wait_time \
+					= max(self.wait_stats.max_wait_time, wait_time)
+
+	def recreate(self) -> TimedQueuePool:
+		# Keep the stats when the pool is recreated after `dispose`.
+		rv = super().recreate()
+		rv.wait_stats = self.wait_stats
+		return rv
+
+
+@dataclass
+class PoolStats:
+	size: Optional[int]
+	checked_in: Optional[int]
+	checked_out: Optional[int]
+	overflow: Optional[int]
+	wait: Optional[PoolWaitStats]
+
+
 class DatabaseManager:
 	"""The main goal is to create a database engine and bind it to
 	the session and metadata of the base model. `.create_tables` and
-	`.drop_tables` are also here because they depend on the engine."""
+	`.drop_tables` are also here because they depend on the engine.
+
+	`engine_options` are passed to `sa.create_engine` for the primary and
+	for every replica, see `RoutingSession`. Except for SQLite, the pool is
+	`TimedQueuePool`, see `get_pool_stats`. SQLite uses its own pools that
+	can't be sized, so sizing options are ignored for it.
+
+	If the driver of `async_drivers` for the backend is installed, there are
+	also async engines for `connect_async`."""
 
-	def __init__(self, uri: str, /) -> None:
-		self.engine = sa.create_engine(uri)
-		session.configure(bind=self.engine)
+	sizing_options = ("pool_size", "max_overflow", "pool_timeout")
+	async_drivers = {'postgresql': "asyncpg"}
+
+	def __init__(
+		self,
+		uri: str,
+		/,
+		replica_uris: Sequence[str] = (),
+		*,
+		replica_retry_interval: float = 30.0,
+		replica_stickiness: float = 5.0,
+		**engine_options: Any,
+	) -> None:
+		self.engine = self._create_engine(uri, engine_options)
+		self.replicas = ReplicaSet(
+			[self._create_engine(u, engine_options) for u in replica_uris],
+			replica_retry_interval,
+		)
+		self.async_engine = self._create_async_engine(uri, engine_options)
+		self.async_replicas = ReplicaSet(
+			[] if self.async_engine is None else [
+				self._create_async_engine(u, engine_options)
+				for u in replica_uris
+			],
+			replica_retry_interval,
+		)
+
+		session.configure(
+			bind=self.engine,
+			replicas=self.replicas,
+			replica_stickiness=replica_stickiness,
+		)
 		Model.metadata.bind = self.engine  # type: ignore
 
+	@classmethod
+	def _create_engine(cls, uri: str,
+  					engine_options: Dict[str, Any], /) -> sa.engine.Engine:
+		engine_options = dict(engine_options)
+		if sa.engine.make_url(uri).get_backend_name() == "sqlite":
+			for option in cls.sizing_options:
+				engine_options.pop(option, None)
+			# The session of an async request may be used by several threads.
+			engine_options['connect_args'] = {
+				'check_same_thread': False,
+				**engine_options.get("connect_args", {}),
+			}
+		else:
+			engine_options.setdefault("poolclass", TimedQueuePool)
+		return sa.create_engine(uri, **engine_options)
+
+	@classmethod
+	def _create_async_engine(cls, uri: str, engine_options: Dict[str, Any],
+ 							/) -> Optional[AsyncEngine]:
+		url = sa.engine.make_url(uri)
+		driver = cls.async_drivers.get(url.get_backend_name())
+		if driver is None:
+			return None
+
+		try:
+			from sqlalchemy.ext.asyncio import create_async_engine
+			return create_async_engine(
+				url.set(drivername=f"{url.get_backend_name()}+{driver}"),
+				**engine_options,
+			)
+		except ImportError:
+			logger.info("No async driver for %r.", url, exc_info=True)
+			return None
+
+	@asynccontextmanager
+	async def connect_async(
+		self,
+		*,
+		read_only: bool = False,
+	) -> AsyncIterator[AsyncConnection]:
+		"""Connects with the async engine of the primary, or of a replica if
+		`read_only`, falling back to the primary like `RoutingSession`."""
+
+		if self.async_engine is None:
+			raise RuntimeError("No async driver is installed.")
+
+		engines: List[AsyncEngine] = [self.async_engine]
+		if read_only:
+			engines[:0] = self.async_replicas.iter_healthy()
+
+		for engine in engines:
+			try:
+				connection = await engine.connect()
+			# asyncpg doesn't wrap errors of connecting.
+			except (sa.exc.DBAPIError, OSError):
+				if engine is self.async_engine:
+					raise
+				logger.warning("Replica %r is down.", engine.url, exc_info=True)
+				self.async_replicas.mark_down(engine)
+				continue
+
+			try:
+				yield connection
+			finally:
+				await connection.close()
+			return
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> DatabaseManager:
+		"""Takes pool options from `DATABASE_POOL_SIZE`,
+		`DATABASE_MAX_OVERFLOW`, `DATABASE_POOL_TIMEOUT`,
+		`DATABASE_POOL_RECYCLE` and `DATABASE_POOL_PRE_PING` and replicas
+		from `DATABASE_REPLICA_URIS`, `DATABASE_REPLICA_RETRY_INTERVAL` and
+		`DATABASE_REPLICA_STICKINESS`."""
+
+		options: Dict[str, Any] = {}
+		for option in (
+			*cls.sizing_options, "pool_recycle", "pool_pre_ping",
+			"replica_retry_interval", "replica_stickiness",
+		):
+			value = config.get("DATABASE_" + option.upper())
+			if value is not None:
+				options[option] = value
+
+		return cls(
+			config['DATABASE_URI'],
+			config.get("DATABASE_REPLICA_URIS", ()),
+			**options,
+		)
+
+	@staticmethod
+	def remove_session() -> None:
+		"""Closes the session of the current thread, returning its connection
+		to the pool and clearing its identity map. Called at the end of every
+		request."""
+
+		session.remove()
+
+	def get_named_engines(self) -> Dict[str, sa.engine.Engine]:
+		"""Returns the engines of `get_engines` by names: "primary",
+		"replica1", ... and "async-primary", "async-replica1", ..."""
+
+		rv = {'primary': self.engine}
+		for i, engine in enumerate(self.replicas.engines, start=1):
+			rv[f"replica{i}"] = engine
+		if self.async_engine is not None:
+			rv['async-primary'] = self.async_engine.sync_engine
+			for i, async_engine in enumerate(self.async_replicas.engines,
+ 											start=1):
+				rv[f"async-replica{i}"] = async_engine.sync_engine
+		return rv
+
+	def get_engines(self) -> List[sa.engine.Engine]:
+		"""Returns the engines of the primary and of replicas, including
+		the sync engines of async engines."""
+
+		return list(self.get_named_engines().values())
+
+	def get_pool_stats(
+		self,
+		engine: Optional[sa.engine.Engine] = None,
+		/,
+	) -> PoolStats:
+		"""Returns stats of the primary pool or of the `engine` pool."""
+
+		pool = (engine or self.engine).pool
+		if not isinstance(pool, sa.pool.QueuePool):
+			return PoolStats(None, None, None, None, None)
+
+		wait_stats = getattr(pool, "wait_stats", None)
+		return PoolStats(
+			pool.size(),
+			pool.checkedin(),
+			pool.checkedout(),
+			pool.overflow(),
+			None if wait_stats is None else replace(wait_stats),
+		)
+
+	def get_all_pool_stats(self) -> Dict[str, PoolStats]:
+		"""Returns stats of every pool by names of `get_named_engines`."""
+
+		return {
+			name: self.get_pool_stats(engine)
+			for name, engine in self.get_named_engines().items()
+		}
+
 	def create_tables(self) -> None:
 		Model.metadata.create_all()  # type: ignore
 
@@ -82,6 +542,61 @@ class DatabaseManager:
 		Model.metadata.drop_all()  # type: ignore
 
 
+def encode_cursor(values: Sequence[Any], /) -> str:
+	data = json.dumps([
+		value.isoformat() if isinstance(value, datetime) else value
+		for value in values
+	], separators=(",", ":"))
+	return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns: Sequence[sa.Column], /) -> List[Any]:
+	"""Decodes the cursor made by `encode_cursor` from the values of
+	`columns`. Aborts with 400 if the cursor was tampered with."""
+
+	try:
+		data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+		values = json.loads(data)
+		if not isinstance(values, list) or len(values) != len(columns):
+			raise ValueError
+		return [
+			datetime.fromisoformat(value)
+			if column.type.python_type is datetime
+			else column.type.python_type(value)
+			for value, column in zip(values, columns)
+		]
+	except (binascii.Error, ValueError, TypeError):
+		abort(400)
+
+
+@dataclass
+class KeysetPagination:
+	items: List[Model]
+	current_page_number: int
+	# Approximate, `None` if unknown.
+	pages_count: Optional[int]
+	next_cursor: Optional[str]
+	previous_cursor: Optional[str]
+
+	@property
+	def has_next_page(self) -> bool:
+		return self.next_cursor is not None
+
+	@property
+	def has_previous_page(self) -> bool:
+		return self.previous_cursor is not None
+
+	@property
+	def next_page_number(self) -> int:
+		assert self.has_next_page
+		return self.current_page_number + 1
+
+	@property
+	def previous_page_number(self) -> int:
+		assert self.has_previous_page
+		return max(self.current_page_number - 1, 1)
+
+
 @dataclass
 class Pagination:
 	current_page_number: int
@@ -5,7 +5,8 @@ from werkzeug.exceptions import abort
 
 from .app import ViewType, Response
 from .locals import request, current_app, current_user
-from .utils import flash, url_for, make_next_param, make_condition_decorator
+from .utils import flash, jsonify, url_for, make_next_param, \
+	make_condition_decorator
 
 
 def _unauthorized_handler() -> Response:
@@ -23,3 +24,23 @@ def login_required(f: ViewType) -> Callable:
 		f, lambda: current_user.is_authenticated,
 		_unauthorized_handler, return_otherwise=True,
 	)
+
+
+def _token_unauthorized_handler() -> Response:
+	return jsonify({'error': "Invalid or missing token."}, 401)
+
+
+def _load_user_from_authorization_header() -> bool:
+	scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+	return (scheme.lower() == "bearer"
+			and current_app.login_manager.load_user_from_token(token))
+
+
+def token_required(f: ViewType) -> Callable:
+	"""Authenticates the request by the `Authorization: Bearer <token>`
+	header instead of the session, see `LoginManager.generate_token`."""
+
+	return make_condition_decorator(
+		f, _load_user_from_authorization_header,
+		_token_unauthorized_handler, return_otherwise=True,
+	)
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import math
+import zlib
+from hashlib import blake2b
+from typing import Union, Optional
+
+
+class HyperLogLog:
+	"""Estimates the number of distinct values in constant memory: `2 **
+	precision` one byte registers, with the standard error of about `1.04
+	/ sqrt(2 ** precision)`, 1.6% by default. Sketches of the same
+	precision are merged by taking the maximum of every register, so the
+	sketches of several workers or days give the estimate of their union.
+
+	Serialized sketches are compressed, as the registers of sketches of few
+	values are mostly zero.
+	"""
+
+	def __init__(self, precision: int = 12, /,
+ 				registers: Optional[bytes] = None) -> None:
+		if not 4 <= precision <= 16:
+			raise ValueError("The precision must be from 4 to 16.")
+		self.precision = precision
+		self.registers = bytearray(
+			registers if registers is not None else 1 << precision,
+		)
+		if len(self.registers) != 1 << precision:
+			raise ValueError("The registers don't match the precision.")
+
+	@staticmethod
+	def hash(value: Union[str, bytes], /) -> int:
+		if isinstance(value, str):
+			value = value.encode()
+		return int.from_bytes(blake2b(value, digest_size=8).digest(), "big")
+
+	def add(self, value: Union[str, bytes], /) -> None:
+		value_hash = self.hash(value)
+		bits = 64 - self.precision
+		index = value_hash >> bits
+		# The position of the leftmost 1 bit of the rest of the hash.
+		rank = bits - (value_hash & ((1 << bits) - 1)).bit_length() + 1
+		if rank > self.registers[index]:
+			self.registers[index] = rank
+
+	def merge(self, other: HyperLogLog, /) -> None:
+		if other.precision != self.precision:
+			raise ValueError("Sketches of different precisions.")
+		self.registers = bytearray(map(max, self.registers, other.registers))
+
+	def count(self) -> float:
+		m = len(self.registers)
+		alpha = 0.7213 / (1 + 1.079 / m)
+		estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+		# Linear counting is more accurate for small cardinalities.
+		zeros = self.registers.count(0)
+		if estimate <= 2.5 * m and zeros:
+			return m * math.log(m / zeros)
+		return estimate
+
+	def to_bytes(self) -> bytes:
+		return zlib.compress(bytes(self.registers))
+
+	@classmethod
+	def from_bytes(cls, data: bytes, /) -> HyperLogLog:
+		registers = zlib.decompress(data)
+		return cls(len(registers).bit_length() - 1, registers)
@@ -1,7 +1,67 @@
-from werkzeug.local import Local, LocalProxy, LocalManager
+from itertools import count
+from threading import get_ident
+from contextvars import ContextVar
+from typing import Any, Dict, Hashable
 
+from werkzeug.local import LocalProxy, LocalManager
 
-local = Local()
+
+class ContextLocal:
+	"""Like `werkzeug.local.Local`, but the values are stored in a context
+	variable, so they are isolated both between threads and between
+	asyncio tasks that serve concurrent requests."""
+
+	def __init__(self) -> None:
+		object.__setattr__(self, "_storage", ContextVar("local_storage"))
+
+	def __call__(self, name: str, /) -> LocalProxy:
+		return LocalProxy(self, name)
+
+	def __release_local__(self) -> None:
+		self._storage.set({})
+
+	def __getattr__(self, name: str) -> Any:
+		try:
+			return self._storage.get({})[name]
+		except KeyError:
+			raise AttributeError(name) from None
+
+	def __setattr__(self, name: str, value: Any) -> None:
+		# Copied, so that the context this one was copied from keeps
+		# its values.
+		values: Dict[str, Any] = self._storage.get({}).copy()
+		values[name] = value
+		self._storage.set(values)
+
+	def __delattr__(self, name: str) -> None:
+		values: Dict[str, Any] = self._storage.get({}).copy()
+		try:
+			del values[name]
+		except KeyError:
+			raise AttributeError(name) from None
+		self._storage.set(values)
+
+
+_context_ids = count(1)
+_context_id: ContextVar[int] = ContextVar("context_id", default=0)
+
+
+def start_context() -> None:
+	"""Gives the current context a new id, see `get_context_id`. Called at
+	the start of every request."""
+
+	_context_id.set(next(_context_ids))
+
+
+def get_context_id() -> Hashable:
+	"""Identifies the current request, so that state like the database
+	session is not shared between requests served by one thread or by
+	concurrent asyncio tasks. Outside of requests, identifies the thread."""
+
+	return _context_id.get() or ("thread", get_ident())
+
+
+local = ContextLocal()
 local_manager = LocalManager([local])
 
 current_app = local("current_app")
@@ -0,0 +1,431 @@
+from __future__ import annotations
+
+import os
+import json
+import stat
+import time
+import secrets
+import tempfile
+from pathlib import Path
+from dataclasses import asdict
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Mapping
+from typing import Any, Dict, List, Tuple, Optional, Sequence, \
+	TYPE_CHECKING
+
+import sqlalchemy as sa
+if TYPE_CHECKING:
+	from .db import DatabaseManager
+
+from .db import PoolStats, PoolWaitStats
+from .batching import BackgroundFlusher
+from .locals import local
+
+
+LATENCY_BUCKETS = (
+	0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+	0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+POOL_METRICS_HELP = {
+	'size': "Connections kept open by the pool of the worker.",
+	'checked_out': "Connections in use.",
+	'overflow': "Connections opened beyond the size, negative if fewer"
+		" than the size are open.",
+	'max_wait_seconds': "The longest wait for a connection.",
+	'checkouts_total': "Connections taken from the pool.",
+	'timeouts_total': "Waits for a connection that timed out.",
+	'wait_seconds_total': "Time spent waiting for connections.",
+}
+
+_RequestKey = Tuple[str, str, int]
+_PhaseKey = Tuple[str, str]
+# Requests, histograms, pool stats by pool names and the time of writing.
+_Snapshot = Tuple[
+	Dict[_RequestKey, int], Dict[_PhaseKey, "Histogram"],
+	Dict[str, PoolStats], float,
+]
+# Pool stats and the time of writing by workers.
+_WorkerPools = Dict[str, Tuple[Dict[str, PoolStats], float]]
+
+
+class Histogram:
+	"""Counts observed values in `buckets`, the upper bounds sorted in
+	ascending order, and one more bucket for larger values. Unlike
+	Prometheus buckets, the counts aren't cumulative."""
+
+	__slots__ = ("buckets", "counts", "sum")
+
+	def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS,
+ 				/) -> None:
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+
+	@property
+	def count(self) -> int:
+		return sum(self.counts)
+
+	def observe(self, value: float, /) -> None:
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+
+	def merge(self, other: Histogram, /) -> None:
+		if other.buckets != self.buckets:
+			raise ValueError("Histograms of different buckets.")
+		self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+		self.sum += other.sum
+
+	def copy(self) -> Histogram:
+		rv = Histogram(self.buckets)
+		rv.counts = list(self.counts)
+		rv.sum = self.sum
+		return rv
+
+
+class timed:
+	"""Adds the time spent in the block to the `phase` timing of the current
+	request, if it's measured:
+
+		with timed("template"):
+			...
+
+	Time of nested or repeated blocks of one phase is summed."""
+
+	__slots__ = ("phase", "started_at")
+
+	def __init__(self, phase: str, /) -> None:
+		self.phase = phase
+
+	def __enter__(self) -> None:
+		self.started_at = time.perf_counter()
+
+	def __exit__(self, *exc_info: Any) -> None:
+		add_timing(self.phase, time.perf_counter() - self.started_at)
+
+
+def add_timing(phase: str, seconds: float, /) -> None:
+	timings: Optional[Dict[str, float]] = getattr(local, "timings", None)
+	if timings is not None:
+		timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+def _before_cursor_execute(conn: sa.engine.Connection, *args: Any) -> None:
+	# Overwritten by the next query if this one fails.
+	conn.info['query_started_at'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn: sa.engine.Connection, *args: Any) -> None:
+	started_at = conn.info.pop("query_started_at", None)
+	if started_at is not None:
+		add_timing("database", time.perf_counter() - started_at)
+
+
+def _dump_snapshot(snapshot: _Snapshot, /) -> Dict[str, Any]:
+	requests, histograms, pools, written_at = snapshot
+	return {
+		'requests': [[*key, count] for key, count in requests.items()],
+		'histograms': [
+			[*key, histogram.buckets, histogram.counts, histogram.sum]
+			for key, histogram in histograms.items()
+		],
+		'pools': {name: asdict(stats) for name, stats in pools.items()},
+		'written_at': written_at,
+	}
+
+
+def _load_snapshot(data: Dict[str, Any], /) -> _Snapshot:
+	requests = {
+		(endpoint, method, status): count
+		for endpoint, method, status, count in data['requests']
+	}
+
+	histograms = {}
+	for endpoint, phase, buckets, counts, sum_ in data['histograms']:
+		histogram = histograms[(endpoint, phase)] = Histogram(buckets)
+		if len(counts) != len(histogram.counts):
+			raise ValueError("Invalid histogram.")
+		histogram.counts = counts
+		histogram.sum = sum_
+
+	pools = {}
+	for name, stats in data['pools'].items():
+		wait = stats.pop("wait")
+		pools[name] = PoolStats(
+			**stats, wait=None if wait is None else PoolWaitStats(**wait),
+		)
+	return requests, histograms, pools, data['written_at']
+
+
+def _escape_label(value: str, /) -> str:
+	return value.replace("\\", r"\\").replace("\"", r"\"") \
+		.replace("\n", r"\n")
+
+
+def _format_labels(labels: Mapping[str, Any], /) -> str:
+	return "{%s}" % ",".join(
+		"%s=\"%s\"" % (name, _escape_label(str(value)))
+		for name, value in labels.items()
+	)
+
+
+class RequestMetrics(BackgroundFlusher):
+	"""Collects the number of requests by endpoint, method and status and
+	latency histograms by endpoint and phase. The phases are "total",
+	"before_request", "view", "session" and whatever is measured with
+	`timed` during the request, e.g. "database" for queries of instrumented
+	engines (see `instrument_engine`) and "template". Phases nest, e.g.
+	"view" includes "database" and "template".
+
+	Every worker process collects its own metrics. With `directory`, each
+	one writes its metrics there every `interval` seconds, and `render`
+	sums the metrics of all of them, so that any worker can be scraped.
+	Metrics of stopped workers are kept, so counters don't decrease. The
+	directory is made accessible to the user of the app only, and one
+	owned by another user is refused, as the workers trust its files.
+
+	With `watch_pools`, the state of connection pools is reported too, by
+	worker, except for workers that haven't written their metrics for two
+	intervals, as they are likely stopped.
+
+	:param directory: The directory shared by the workers.
+	:param buckets: The upper bounds of the latency buckets in seconds.
+	"""
+
+	thread_name = "request-metrics"
+	file_suffix = ".metrics"
+
+	def __init__(
+		self,
+		directory: Optional[os.PathLike] = None,
+		/,
+		buckets: Sequence[float] = LATENCY_BUCKETS,
+		**kwargs: Any,
+	) -> None:
+		super().__init__(**kwargs)
+		self.buckets = tuple(buckets)
+		self.directory = None if directory is None else Path(directory)
+		if self.directory is not None:
+			self._make_directory()
+
+		self._requests: Counter[_RequestKey] = Counter()
+		self._histograms: Dict[_PhaseKey, Histogram] = {}
+		self._database_manager: Optional[DatabaseManager] = None
+		self._file_pid: Optional[int] = None
+		self._file_name = ""
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> RequestMetrics:
+		return cls(
+			config.get("METRICS_DIR"),
+			interval=config.get("METRICS_WRITE_INTERVAL", 10.0),
+		)
+
+	@staticmethod
+	def instrument_engine(engine: sa.engine.Engine, /) -> None:
+		"""Measures queries of the engine as the "database" phase."""
+
+		sa.event.listen(engine, "before_cursor_execute",
+  						_before_cursor_execute)
+		sa.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+	def watch_pools(self, database_manager: DatabaseManager, /) -> None:
+		"""Reports stats of the pools of `database_manager` engines."""
+		self._database_manager = database_manager
+
+	def observe(
+		self,
+		endpoint: Optional[str],
+		method: str,
+		status: int,
+		timings: Mapping[str, float],
+		/,
+	) -> None:
+		endpoint = endpoint or "unmatched"
+		with self._lock:
+			self._requests[(endpoint, method, status)] += 1
+			for phase, seconds in timings.items():
+				histogram = self._histograms.get((endpoint, phase))
+				if histogram is None:
+					histogram = self._histograms[(endpoint, phase)] \
+						= Histogram(self.buckets)
+				histogram.observe(seconds)
+		if self.directory is not None:
+			self._notify(0)
+
+	def _make_directory(self) -> None:
+		assert self.directory is not None
+		self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+		st = self.directory.stat()
+		if st.st_uid != os.getuid():
+			raise RuntimeError(
+				f"The metrics directory {self.directory} is owned by another"
+				" user.",
+			)
+		if stat.S_IMODE(st.st_mode) & 0o077:
+			self.directory.chmod(0o700)
+
+	def _get_path(self) -> Path:
+		"""The file of this process. Pids are reused, e.g. by a restarted
+		container, so the name is random too, otherwise a new worker would
+		replace the metrics of a stopped one and counters would decrease."""
+
+		assert self.directory is not None
+		pid = os.getpid()
+		if self._file_pid != pid:
+			self._file_pid = pid
+			self._file_name = "%d-%s%s" % (
+				pid, secrets.token_hex(4), self.file_suffix,
+			)
+		return self.directory.joinpath(self._file_name)
+
+	def _drain(self) -> _Snapshot:
+		pools = (
+			{} if self._database_manager is None
+			else self._database_manager.get_all_pool_stats()
+		)
+		with self._lock:
+			return Counter(self._requests), {
+				key: histogram.copy()
+				for key, histogram in self._histograms.items()
+			}, pools, time.time()
+
+	def _write(self, snapshot: _Snapshot, /) -> None:
+		assert self.directory is not None
+		fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+		try:
+			with os.fdopen(fd, "w") as f:
+				json.dump(_dump_snapshot(snapshot), f)
+			os.replace(tmp_path, self._get_path())
+		except BaseException:
+			os.unlink(tmp_path)
+			raise
+
+	def _restore(self, snapshot: _Snapshot, /) -> None:
+		# The metrics are kept, the next write retries.
+		pass
+
+	def _collect(
+		self,
+	) -> Tuple[Dict[_RequestKey, int], Dict[_PhaseKey, Histogram],
+ 			_WorkerPools]:
+		requests, histograms, pools, written_at = self._drain()
+		own_path = self._get_path() if self.directory is not None \
+			else Path(str(os.getpid()))
+		worker_pools = {own_path.stem: (pools, written_at)}
+		if self.directory is None:
+			return requests, histograms, worker_pools
+
+		for path in self.directory.glob("*" + self.file_suffix):
+			if path == own_path:
+				continue
+			try:
+				with path.open() as f:
+					other_requests, other_histograms, other_pools, \
+						other_written_at = _load_snapshot(json.load(f))
+			except (OSError, ValueError, TypeError, KeyError, AttributeError):
+				continue
+
+			worker_pools[path.stem] = (other_pools, other_written_at)
+			requests.update(other_requests)
+			for key, histogram in other_histograms.items():
+				if key in histograms:
+					histograms[key].merge(histogram)
+				else:
+					histograms[key] = histogram
+		return requests, histograms, worker_pools
+
+	def render(self) -> str:
+		"""Returns the metrics in the Prometheus text format."""
+
+		requests, histograms, worker_pools = self._collect()
+		lines: List[str] = [
+			"# HELP app_requests_total Requests by endpoint, method and"
+			" status.",
+			"# TYPE app_requests_total counter",
+		]
+		for (endpoint, method, status), count in sorted(requests.items()):
+			labels = _format_labels(
+				{'endpoint': endpoint, 'method': method, 'status': status},
+			)
+			lines.append("app_requests_total%s %d" % (labels, count))
+
+		lines += [
+			"# HELP app_request_duration_seconds Request latency by endpoint"
+			" and phase.",
+			"# TYPE app_request_duration_seconds histogram",
+		]
+		name = "app_request_duration_seconds"
+		for (endpoint, phase), histogram in sorted(histograms.items()):
+			labels = {'endpoint': endpoint, 'phase': phase}
+			cumulative_count = 0
+			bounds = [repr(b) for b in histogram.buckets] + ["+Inf"]
+			for bound, count in zip(bounds, histogram.counts):
+				cumulative_count += count
+				lines.append("%s_bucket%s %d" % (
+					name, _format_labels({**labels, 'le': bound}),
+					cumulative_count,
+				))
+			lines.append("%s_sum%s %r" % (
+				name, _format_labels(labels), histogram.sum,
+			))
+			lines.append("%s_count%s %d" % (
+				name, _format_labels(labels), cumulative_count,
+			))
+
+		lines += self._render_pools(worker_pools)
+		return "\n".join(lines) + "\n"
+
+	def _render_pools(self, worker_pools: _WorkerPools, /) -> List[str]:
+		now = time.time()
+		gauges: Dict[str, List[str]] = {
+			'size': [], 'checked_out': [], 'overflow': [],
+			'max_wait_seconds': [],
+		}
+		counters: Dict[str, Counter[str]] = {
+			'checkouts_total': Counter(), 'timeouts_total': Counter(),
+			'wait_seconds_total': Counter(),
+		}
+		for worker, (pools, written_at) in sorted(worker_pools.items()):
+			is_running = now - written_at <= 2 * self.interval
+			for pool, stats in sorted(pools.items()):
+				labels = _format_labels({'worker': worker, 'pool': pool})
+				if is_running and stats.size is not None:
+					gauges['size'].append("%s %d" % (labels, stats.size))
+					gauges['checked_out'].append(
+						"%s %d" % (labels, stats.checked_out),
+					)
+					gauges['overflow'].append(
+						"%s %d" % (labels, stats.overflow),
+					)
+				if stats.wait is None:
+					continue
+				if is_running:
+					gauges['max_wait_seconds'].append(
+						"%s %r" % (labels, stats.wait.max_wait_time),
+					)
+				counters['checkouts_total'][pool] += stats.wait.checkouts
+				counters['timeouts_total'][pool] += stats.wait.timeouts
+				counters['wait_seconds_total'][pool] \
+					+= stats.wait.total_wait_time
+
+		lines = []
+		for name, values in gauges.items():
+			lines += [
+				"# HELP app_db_pool_%s %s" % (name, POOL_METRICS_HELP[name]),
+				"# TYPE app_db_pool_%s gauge" % name,
+			]
+			lines += ["app_db_pool_%s%s" % (name, value) for value in values]
+		for name, totals in counters.items():
+			lines += [
+				"# HELP app_db_pool_%s %s" % (name, POOL_METRICS_HELP[name]),
+				"# TYPE app_db_pool_%s counter" % name,
+			]
+			lines += [
+				"app_db_pool_%s%s %r" % (
+					name, _format_labels({'pool': pool}), total,
+				)
+				for pool, total in sorted(totals.items())
+			]
+		return lines
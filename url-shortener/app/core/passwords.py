@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import hmac
+import hashlib
+import logging
+import secrets
+from threading import Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Type, Callable, Optional, TypeVar
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordHasher:
+	"""Hashes passwords into strings that start with `prefix` and contain
+	the parameters of the hash, so that `needs_rehash` can tell hashes
+	made with other parameters."""
+
+	prefix = ""
+
+	def hash(self, password: str, /) -> str:
+		raise NotImplementedError
+
+	def verify(self, password: str, password_hash: str, /) -> bool:
+		raise NotImplementedError
+
+	def needs_rehash(self, password_hash: str, /) -> bool:
+		raise NotImplementedError
+
+
+class LegacyHasher(PasswordHasher):
+	"""Verifies the other hashes of `werkzeug.security`, e.g. the salted
+	SHA-256 that was used before. They are always rehashed."""
+
+	def hash(self, password: str, /) -> str:
+		raise NotImplementedError("Legacy hashes are only verified.")
+
+	def verify(self, password: str, password_hash: str, /) -> bool:
+		return check_password_hash(password_hash, password)
+
+	def needs_rehash(self, password_hash: str, /) -> bool:
+		return True
+
+
+class PBKDF2Hasher(PasswordHasher):
+	"""PBKDF2-HMAC-SHA256 in the format of `werkzeug.security`."""
+
+	prefix = "pbkdf2:"
+
+	def __init__(self, *, iterations: int = 260000) -> None:
+		self.method = "pbkdf2:sha256:%d" % iterations
+
+	def hash(self, password: str, /) -> str:
+		return generate_password_hash(password, self.method, salt_length=16)
+
+	def verify(self, password: str, password_hash: str, /) -> bool:
+		return check_password_hash(password_hash, password)
+
+	def needs_rehash(self, password_hash: str, /) -> bool:
+		return password_hash.split("$", 1)[0] != self.method
+
+
+class ScryptHasher(PasswordHasher):
+	"""scrypt of `hashlib`, whose cost is `n * r * 128` bytes of memory as
+	well as time, so it is expensive on GPUs too. Hashes look like
+	`scrypt:<n>:<r>:<p>$<salt>$<hex hash>`."""
+
+	prefix = "scrypt:"
+
+	def __init__(self, *, n: int = 2 ** 14, r: int = 8, p: int = 1) -> None:
+		self.n, self.r, self.p = n, r, p
+		self.method = "scrypt:%d:%d:%d" % (n, r, p)
+
+	@staticmethod
+	def _hash(password: str, salt: str, n: int, r: int, p: int, /) -> str:
+		return hashlib.scrypt(
+			password.encode(), salt=salt.encode(), n=n, r=r, p=p,
+			maxmem=n * r * 256, dklen=64,
+		).hex()
+
+	def hash(self, password: str, /) -> str:
+		salt = secrets.token_hex(16)
+		return "%s$%s$%s" % (
+			self.method, salt,
+			self._hash(password, salt, self.n, self.r, self.p),
+		)
+
+	def verify(self, password: str, password_hash: str, /) -> bool:
+		try:
+			method, salt, expected = password_hash.split("$")
+			n, r, p = map(int, method.split(":")[1:])
+		except ValueError:
+			return False
+		return hmac.compare_digest(
+			self._hash(password, salt, n, r, p), expected,
+		)
+
+	def needs_rehash(self, password_hash: str, /) -> bool:
+		return password_hash.split("$", 1)[0] != self.method
+
+
+class Argon2Hasher(PasswordHasher):
+	"""Argon2id, which is the recommended choice if the `argon2-cffi`
+	package is installed.
+
+	Requires the optional `argon2-cffi` package.
+	"""
+
+	prefix = "$argon2"
+
+	def __init__(self, **options: Any) -> None:
+		try:
+			import argon2
+		except ImportError as exc:
+			raise RuntimeError(
+				"Install the `argon2-cffi` package to use `Argon2Hasher`.",
+			) from exc
+
+		self._hasher = argon2.PasswordHasher(**options)
+		self._errors = (argon2.exceptions.VerificationError,
+						argon2.exceptions.InvalidHash)
+
+	def hash(self, password: str, /) -> str:
+		return self._hasher.hash(password)
+
+	def verify(self, password: str, password_hash: str, /) -> bool:
+		try:
+			return self._hasher.verify(password_hash, password)
+		except self._errors:
+			return False
+
+	def needs_rehash(self, password_hash: str, /) -> bool:
+		return self._hasher.check_needs_rehash(password_hash)
+
+
+PASSWORD_HASHERS: Dict[str, Type[PasswordHasher]] = {
+	'pbkdf2': PBKDF2Hasher,
+	'scrypt': ScryptHasher,
+	'argon2': Argon2Hasher,
+}
+
+
+class PasswordHashingBusyError(ServiceUnavailable):
+	description = "Too many logins at once. Please, try again."
+
+
+class PasswordPolicy:
+	"""Hashes new passwords with the hasher of `PASSWORD_HASH_METHOD`,
+	which is one of `PASSWORD_HASHERS` keys and gets
+	`PASSWORD_HASH_OPTIONS`, and verifies hashes of any of them and legacy
+	ones. `needs_rehash` tells hashes that should be replaced on the next
+	login, as their method or cost differs from the current ones.
+
+	Hashing takes tens of milliseconds of CPU by design, so it runs in
+	a pool of `PASSWORD_HASH_WORKERS` threads, which bounds the CPU taken
+	by a burst of logins. The requests that would wait behind more than
+	`PASSWORD_HASH_QUEUE_SIZE` others get 503 at once instead of holding
+	their threads, which serve redirects too.
+
+	Hashers of the other methods are created on the first hash of their
+	method. A hash whose hasher can't be created, e.g. an Argon2 one
+	without `argon2-cffi`, doesn't verify.
+	"""
+
+	def __init__(self) -> None:
+		self.hasher: PasswordHasher = PBKDF2Hasher()
+		self.workers = 2
+		self.queue_size = 2
+		self._legacy_hasher = LegacyHasher()
+		self._other_hashers: Dict[Type[PasswordHasher],
+ 								Optional[PasswordHasher]] = {}
+		self._lock = Lock()
+		self._executor: Optional[ThreadPoolExecutor] = None
+		self._slots = BoundedSemaphore(self.workers + self.queue_size)
+
+	def init_app(self, app, /) -> None:
+		config = app.config
+		method = config.get("PASSWORD_HASH_METHOD", "pbkdf2")
+		try:
+			hasher_class = PASSWORD_HASHERS[method]
+		except KeyError as exc:
+			raise ValueError(
+				f"Unknown password hash method \"{method}\".",
+			) from exc
+		self.hasher = hasher_class(**config.get("PASSWORD_HASH_OPTIONS", {}))
+		self.workers = config.get("PASSWORD_HASH_WORKERS", self.workers)
+		self.queue_size = config.get("PASSWORD_HASH_QUEUE_SIZE",
+  									self.queue_size)
+		self._slots = BoundedSemaphore(self.workers + self.queue_size)
+
+	def _get_hasher(self, password_hash: str, /) -> Optional[PasswordHasher]:
+		if password_hash.startswith(self.hasher.prefix):
+			return self.hasher
+		# Hashes of other methods are verified with their own parameters.
+		for hasher_class in PASSWORD_HASHERS.values():
+			if password_hash.startswith(hasher_class.prefix):
+				return self._get_other_hasher(hasher_class)
+		return self._legacy_hasher
+
+	def _get_other_hasher(self, hasher_class: Type[PasswordHasher],
+ 						/) -> Optional[PasswordHasher]:
+		if hasher_class not in self._other_hashers:
+			try:
+				hasher: Optional[PasswordHasher] = hasher_class()
+			except RuntimeError:
+				logger.warning("Hashes of `%s` can't be verified.",
+ 							hasher_class.__name__, exc_info=True)
+				hasher = None
+			self._other_hashers[hasher_class] = hasher
+		return self._other_hashers[hasher_class]
+
+	def _run(self, f: Callable[..., T], /, *args: Any) -> T:
+		"""Runs `f` in the pool, which is started on the first call, so that
+		it's not forked."""
+
+		if not self._slots.acquire(blocking=False):
+			raise PasswordHashingBusyError(retry_after=1)
+		try:
+			if self._executor is None:
+				with self._lock:
+					if self._executor is None:
+						self._executor = ThreadPoolExecutor(
+							self.workers, thread_name_prefix="password-hasher",
+						)
+			return self._executor.submit(f, *args).result()
+		finally:
+			self._slots.release()
+
+	def hash(self, password: str, /) -> str:
+		return self._run(self.hasher.hash, password)
+
+	def verify(self, password: str, password_hash: str, /) -> bool:
+		hasher = self._get_hasher(password_hash)
+		if hasher is None:
+			return False
+		return self._run(hasher.verify, password, password_hash)
+
+	def needs_rehash(self, password_hash: str, /) -> bool:
+		return self._get_hasher(password_hash) is not self.hasher \
+			or self.hasher.needs_rehash(password_hash)
+
+
+password_policy = PasswordPolicy()
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import os
+import sys
+import time
+import random
+import logging
+import cProfile
+import traceback
+from pathlib import Path
+from collections.abc import Mapping
+from threading import Lock, Thread, get_ident
+from typing import Any, Dict, Tuple, Callable, Iterable, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerMiddleware:
+	"""Finds out where slow requests spend their time, with two opt-in
+	mechanisms:
+
+	- `sample_rate` of requests are run under `cProfile`, and profiles of
+	  those that took `slow_request_threshold` seconds or more are dumped
+	  into `directory` for `pstats` or `snakeviz`.
+	- With `stack_sample_interval`, a thread logs the stack of every
+	  request that has been running for `slow_request_threshold` seconds
+	  or more, every `stack_sample_interval` seconds until it's done.
+	  This costs requests almost nothing, so it can catch every slow one.
+
+	Only the time until the application returns the response is
+	measured, streamed bodies are not.
+	"""
+
+	def __init__(
+		self,
+		app: Callable,
+		/,
+		directory: Optional[os.PathLike] = None,
+		*,
+		sample_rate: float = 0.0,
+		slow_request_threshold: float = 1.0,
+		stack_sample_interval: Optional[float] = None,
+	) -> None:
+		if sample_rate and directory is None:
+			raise ValueError("Profiles require the directory.")
+
+		self.app = app
+		self.directory = None if directory is None else Path(directory)
+		if self.directory is not None:
+			self.directory.mkdir(parents=True, exist_ok=True)
+		self.sample_rate = sample_rate
+		self.slow_request_threshold = slow_request_threshold
+		self.stack_sample_interval = stack_sample_interval
+
+		# Thread ids of running requests to their start and description.
+		self._running: Dict[int, Tuple[float, str]] = {}
+		self._lock = Lock()
+		self._sampler: Optional[Thread] = None
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /,
+ 					app: Callable) -> ProfilerMiddleware:
+		return cls(
+			app,
+			config.get("PROFILER_DIR"),
+			sample_rate=config.get("PROFILER_SAMPLE_RATE", 0.0),
+			slow_request_threshold=config.get(
+				"PROFILER_SLOW_REQUEST_THRESHOLD", 1.0,
+			),
+			stack_sample_interval=config.get("PROFILER_STACK_SAMPLE_INTERVAL"),
+		)
+
+	def __call__(self, environ: Dict[str, Any],
+ 				start_response: Callable) -> Iterable[bytes]:
+		description = "%s %s" % (
+			environ['REQUEST_METHOD'], environ.get("PATH_INFO", ""),
+		)
+		started_at = time.perf_counter()
+		if self.stack_sample_interval is not None:
+			self._start_sampler()
+			self._running[get_ident()] = (started_at, description)
+
+		profile = None
+		if self.sample_rate and random.random() < self.sample_rate:
+			profile = cProfile.Profile()
+		try:
+			if profile is None:
+				return self.app(environ, start_response)
+			profile.enable()
+			try:
+				return self.app(environ, start_response)
+			finally:
+				profile.disable()
+		finally:
+			self._running.pop(get_ident(), None)
+			duration = time.perf_counter() - started_at
+			if profile is not None and duration >= self.slow_request_threshold:
+				self._dump_profile(profile, description, duration)
+
+	def _dump_profile(self, profile: cProfile.Profile, description: str,
+  					duration: float, /) -> None:
+		assert self.directory is not None
+		name = "%d-%d-%s.prof" % (
+			time.time() * 1000, os.getpid(),
+			"".join(c if c.isalnum() else "_" for c in description)[:100],
+		)
+		try:
+			profile.dump_stats(self.directory.joinpath(name))
+		except OSError:
+			logger.warning("Failed to dump the profile.", exc_info=True)
+			return
+		logger.info("Profiled slow request %s (%.3fs) into %s.",
+  					description, duration, name)
+
+	def _start_sampler(self) -> None:
+		if self._sampler is not None:
+			return
+		with self._lock:
+			if self._sampler is not None:
+				return
+			self._sampler = Thread(
+				target=self._sample_stacks,
+				name="stack-sampler",
+				daemon=True,
+			)
+			self._sampler.start()
+
+	def _sample_stacks(self) -> None:
+		assert self.stack_sample_interval is not None
+		while True:
+			time.sleep(self.stack_sample_interval)
+			now = time.perf_counter()
+			frames = sys._current_frames()
+			running = list(self._running.items())
+			for thread_id, (started_at, description) in running:
+				frame = frames.get(thread_id)
+				if (
+					frame is None
+					or now - started_at < self.slow_request_threshold
+				):
+					continue
+				logger.warning(
+					"Slow request %s has been running for %.3fs:\n%s",
+					description, now - started_at,
+					"".join(traceback.format_stack(frame)),
+				)
@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import math
+import time
+import logging
+from threading import Lock
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Dict, List, Type, Tuple, Optional, NamedTuple
+
+from werkzeug.wrappers import Response
+from werkzeug.exceptions import TooManyRequests
+
+from .locals import request, current_user
+
+
+# Set in the environ by the lightweight check, so that the request is not
+# counted again if `wsgi_app` serves it.
+CHECKED_ENVIRON_KEY = "app.rate_limit_checked"
+
+RATE_LIMIT_PERIODS = {
+	'second': 1,
+	'minute': 60,
+	'hour': 3600,
+	'day': 86400,
+}
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimit(NamedTuple):
+	"""A token bucket of `count` tokens that is refilled in `period`
+	seconds, so `count` requests are allowed at once and then one every
+	`period / count` seconds."""
+
+	count: int
+	period: float
+
+	@classmethod
+	def parse(cls, value: str, /) -> RateLimit:
+		"""Parses limits like "10/minute" or "100/second"."""
+
+		count, _, period = value.partition("/")
+		try:
+			rv = cls(int(count), RATE_LIMIT_PERIODS[period.strip()])
+		except (ValueError, KeyError) as exc:
+			raise ValueError(f"Invalid rate limit \"{value}\".") from exc
+		if rv.count < 1:
+			raise ValueError(f"Invalid rate limit \"{value}\".")
+		return rv
+
+	def __str__(self) -> str:
+		return "%d/%g" % self
+
+
+class BaseRateLimitStorage:
+	"""Keeps token buckets. Storages implement `consume`, which takes
+	a token from the bucket of the key and returns 0 or, if the bucket is
+	empty, the seconds until a token is available."""
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> BaseRateLimitStorage:
+		return cls()
+
+	def consume(self, key: str, limit: RateLimit, /) -> float:
+		raise NotImplementedError
+
+
+class MemoryRateLimitStorage(BaseRateLimitStorage):
+	"""Keeps buckets of the worker process, so the limits are per worker.
+	The least recently used buckets are dropped after `max_size`, which
+	at worst lets their clients start over with full buckets.
+
+	:param max_size: The maximum number of buckets.
+	"""
+
+	def __init__(self, max_size: int = 100000, /) -> None:
+		self.max_size = max_size
+		self._lock = Lock()
+		self._buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> BaseRateLimitStorage:
+		return cls(config.get("RATE_LIMIT_MAX_SIZE", 100000))
+
+	def consume(self, key: str, limit: RateLimit, /) -> float:
+		count, period = limit
+		now = time.monotonic()
+		with self._lock:
+			bucket = self._buckets.get(key)
+			if bucket is None:
+				tokens = float(count)
+				if len(self._buckets) >= self.max_size:
+					self._buckets.popitem(last=False)
+			else:
+				tokens, updated_at = bucket
+				tokens = min(count, tokens + (now - updated_at) * count / period)
+				self._buckets.move_to_end(key)
+
+			if tokens < 1:
+				self._buckets[key] = (tokens, now)
+				return (1 - tokens) * period / count
+			self._buckets[key] = (tokens - 1, now)
+			return 0.0
+
+
+# Returns the retry after as a string, as Lua numbers are converted to
+# integers.
+_REDIS_CONSUME_SCRIPT = """
+local count, period = tonumber(ARGV[1]), tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = count
+if bucket[1] then
+	tokens = math.min(
+		count, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * count / period
+	)
+end
+local retry_after = 0
+if tokens < 1 then
+	retry_after = (1 - tokens) * period / count
+else
+	tokens = tokens - 1
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated_at",
+	tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil(period * 1000))
+return tostring(retry_after)
+"""
+
+
+class RedisRateLimitStorage(BaseRateLimitStorage):
+	"""Keeps buckets in Redis, so that all workers and hosts share the
+	limits. A bucket is updated by one script, so concurrent requests
+	can't take the same token. If Redis is unavailable, requests are
+	allowed.
+
+	Requires the optional `redis` package.
+
+	:param uri: The `redis://` URI of the server.
+	:param key_prefix: The prefix of all keys.
+	"""
+
+	def __init__(self, uri: str, /, key_prefix: str = "") -> None:
+		try:
+			import redis
+		except ImportError as exc:
+			raise RuntimeError(
+				"Install the `redis` package to use `RedisRateLimitStorage`.",
+			) from exc
+
+		self.key_prefix = key_prefix
+		self.client = redis.Redis.from_url(uri)
+		self._consume = self.client.register_script(_REDIS_CONSUME_SCRIPT)
+		self._errors: Tuple[Type[Exception], ...] = (redis.RedisError,)
+
+	@classmethod
+	def from_config(cls, config: Mapping[str, Any], /) -> BaseRateLimitStorage:
+		return cls(
+			config['RATE_LIMIT_STORAGE_URI'],
+			key_prefix=config.get("CACHE_KEY_PREFIX", "") + "rate-limit:",
+		)
+
+	def consume(self, key: str, limit: RateLimit, /) -> float:
+		try:
+			rv = self._consume(
+				keys=[self.key_prefix + key], args=[limit.count, limit.period],
+			)
+		except self._errors:
+			logger.warning("Failed to check the rate limit.", exc_info=True)
+			return 0.0
+		return float(rv)
+
+
+RATE_LIMIT_STORAGES: Dict[str, Type[BaseRateLimitStorage]] = {
+	'memory': MemoryRateLimitStorage,
+	'redis': RedisRateLimitStorage,
+}
+
+
+def create_rate_limit_storage(
+	config: Mapping[str, Any],
+	/,
+) -> BaseRateLimitStorage:
+	"""Creates the storage named by `config['RATE_LIMIT_STORAGE']`, which
+	is one of `RATE_LIMIT_STORAGES` keys and defaults to `"memory"`."""
+
+	storage = config.get("RATE_LIMIT_STORAGE", "memory")
+	try:
+		storage_class = RATE_LIMIT_STORAGES[storage]
+	except KeyError as exc:
+		raise ValueError(
+			f"Unknown rate limit storage \"{storage}\".",
+		) from exc
+	return storage_class.from_config(config)
+
+
+def get_remote_addr(environ: Dict[str, Any], /) -> str:
+	"""The address of the client, which the proxy passes in `X-Real-IP`."""
+	return environ.get("HTTP_X_REAL_IP") or environ.get("REMOTE_ADDR") or ""
+
+
+class RateLimiter:
+	"""Limits the requests to the endpoints of `config['RATE_LIMITS']`,
+	which maps endpoints to lists of `(limit, key)` pairs, e.g.:
+
+		'RATE_LIMITS': {
+			'create': [("5/second", "ip"), ("100/hour", "user")],
+		}
+
+	See `RateLimit.parse` for the limits. Keys are "ip", the `X-Real-IP`
+	address, or "user", the id of the authenticated user or the address
+	for anonymous users. A request is limited if any of its limits is
+	exceeded and gets 429 with the `Retry-After` header.
+
+	Lightweight requests are checked too, but they have no session, so
+	they are always limited by the address.
+
+	:param app: `core.app.Application` instance.
+	"""
+
+	def __init__(self, app, /) -> None:
+		self.limits: Dict[str, List[Tuple[RateLimit, str]]] = {}
+		for endpoint, limits in app.config.get("RATE_LIMITS", {}).items():
+			self.limits[endpoint] = [
+				(RateLimit.parse(limit), key) for limit, key in limits
+			]
+			for _, key in limits:
+				if key not in {"ip", "user"}:
+					raise ValueError(f"Unknown rate limit key \"{key}\".")
+		if not self.limits:
+			return
+
+		self.storage = create_rate_limit_storage(app.config)
+		app.run_before_request(self.limit)
+		app.run_before_lightweight_request(self.limit_lightweight)
+
+	def check(
+		self,
+		endpoint: str,
+		environ: Dict[str, Any],
+		/,
+		user_id: Optional[int] = None,
+	) -> float:
+		"""Takes a token from every bucket of the endpoint and returns 0 or
+		the seconds after which the request would be allowed."""
+
+		remote_addr = get_remote_addr(environ)
+		rv = 0.0
+		for limit, key in self.limits[endpoint]:
+			client = (
+				"user:%d" % user_id if key == "user" and user_id is not None
+				else "ip:" + remote_addr
+			)
+			rv = max(rv, self.storage.consume(
+				"%s %s %s" % (endpoint, client, limit), limit,
+			))
+		return rv
+
+	@staticmethod
+	def _make_exception(retry_after: float, /) -> TooManyRequests:
+		return TooManyRequests(retry_after=math.ceil(retry_after))
+
+	def limit(self) -> None:
+		if (
+			request.endpoint not in self.limits
+			or CHECKED_ENVIRON_KEY in request.environ
+		):
+			return
+
+		user_id = None
+		if any(key == "user" for _, key in self.limits[request.endpoint]):
+			user_id = (
+				current_user.get_id() if current_user.is_authenticated
+				else None
+			)
+
+		retry_after = self.check(request.endpoint, request.environ, user_id)
+		if retry_after:
+			raise self._make_exception(retry_after)
+
+	def limit_lightweight(self, environ: Dict[str, Any],
+  						endpoint: str, /) -> Optional[Response]:
+		if endpoint not in self.limits:
+			return None
+
+		environ[CHECKED_ENVIRON_KEY] = True
+		retry_after = self.check(endpoint, environ)
+		if retry_after:
+			return self._make_exception(retry_after).get_response(environ)
+		return None
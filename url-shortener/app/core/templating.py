@@ -0,0 +1,36 @@
+import posixpath
+from pathlib import Path
+from typing import Any, List, Optional
+
+from mako import lookup
+
+
+class TemplateLookup(lookup.TemplateLookup):
+	"""Normalizes URIs, so that a template is compiled and kept in memory
+	once, however it is referenced: `"short-urls/../base.html"` from
+	`<%inherit>` and `"base.html"` from `render_template` are the same
+	template."""
+
+	def adjust_uri(self, uri: str, relativeto: Optional[str]) -> str:
+		return posixpath.normpath(super().adjust_uri(uri, relativeto)) \
+			.lstrip("/")
+
+	def get_template(self, uri: str) -> Any:
+		return super().get_template(posixpath.normpath(uri).lstrip("/"))
+
+	def get_template_uris(self) -> List[str]:
+		"""Returns URIs of all templates in `directories`, skipping the
+		compiled modules if `module_directory` is inside one of them."""
+
+		module_directory = (
+			None if self.module_directory is None
+			else Path(self.module_directory).resolve()
+		)
+
+		rv = []
+		for directory in map(Path, self.directories):
+			for path in sorted(directory.rglob("*.html")):
+				if module_directory in path.resolve().parents:
+					continue
+				rv.append(path.relative_to(directory).as_posix())
+		return rv
@@ -1,9 +1,13 @@
+import json
 from functools import wraps
 from datetime import datetime
 from urllib.parse import urljoin, urlparse, urlunparse
 from typing import Any, List, Tuple, Optional, Callable
 
+from werkzeug.wrappers import Response
+
 from .locals import current_app, request, url_adapter
+from .metrics import timed
 
 
 def is_safe_url(url: str, /) -> bool:
@@ -15,7 +19,36 @@ def is_safe_url(url: str, /) -> bool:
 
 
 def render_template(name: str, /, **context: Any) -> str:
-	return current_app.template_lookup.get_template(name).render(**context)
+	with timed("template"):
+		return current_app.template_lookup.get_template(name) \
+			.render(**context)
+
+
+def cache_fragment(key: str, render: Callable[[], str], /) -> str:
+	"""Returns the rendered fragment from `current_app.cache`, rendering it
+	on a miss. The key must change whenever the fragment would change,
+	e.g. contain the id and the update time of the rendered object."""
+
+	cache = current_app.cache.namespace(
+		"fragment",
+		current_app.config.get("TEMPLATES_FRAGMENT_CACHE_TTL"),
+	)
+	rv = cache.get(key)
+	if rv is None:
+		rv = render()
+		cache.set(key, rv)
+	return rv
+
+
+def _json_default(obj: Any, /) -> Any:
+	if isinstance(obj, datetime):
+		return obj.isoformat()
+	raise TypeError(f"{obj.__class__.__name__} is not JSON serializable.")
+
+
+def jsonify(obj: Any, /, status: int = 200) -> Response:
+	content = json.dumps(obj, default=_json_default, separators=(",", ":"))
+	return current_app.make_response(content, status, "application/json")
 
 
 def url_for(
@@ -1,12 +1,75 @@
+from typing import Any, Dict, Callable, Iterable, Optional
+
 from werkzeug import Request as BaseRequest
+from werkzeug.wrappers import Response
+from werkzeug.wrappers.json import JSONMixin
 from werkzeug.utils import cached_property
 from secure_cookie.cookie import SecureCookie
 
 from .locals import current_app
 
 
-class Request(BaseRequest):
+class Request(JSONMixin, BaseRequest):
+	# Set by `Application.dispatch_request` when the URL is matched.
+	endpoint: Optional[str] = None
+	view_args: Optional[Dict[str, Any]] = None
+
+	session_cookie_name = "session"
+
 	@cached_property
 	def session(self) -> SecureCookie:
-		secret_key = current_app.config['SECRET_KEY']
-		return SecureCookie.load_cookie(self, secret_key=secret_key)
+		"""Loaded on the first access, see `save_session`. A cookie signed
+		with a key of `SECRET_KEY_FALLBACKS` is loaded too and is signed
+		with `SECRET_KEY` again in the response."""
+
+		config = current_app.config
+		session = SecureCookie.load_cookie(
+			self, self.session_cookie_name, secret_key=config['SECRET_KEY'],
+		)
+		data = self.cookies.get(self.session_cookie_name)
+		if session or not data:
+			return session
+
+		for secret_key in config.get("SECRET_KEY_FALLBACKS", ()):
+			previous_session = SecureCookie.unserialize(data, secret_key)
+			if previous_session:
+				session = SecureCookie(
+					previous_session, config['SECRET_KEY'], False,
+				)
+				session.modified = True
+				break
+		return session
+
+	@property
+	def is_session_loaded(self) -> bool:
+		# `cached_property` keeps the value in the instance dictionary.
+		return "session" in self.__dict__
+
+	def save_session(self, response: Response, /) -> None:
+		"""Sets the session cookie only if the session was loaded and
+		modified. So an untouched session costs neither verifying nor
+		signing, and the response has no `Set-Cookie` header and can be
+		cached. The cookie of an emptied session is deleted."""
+
+		if not self.is_session_loaded or not self.session.should_save:
+			return
+
+		if self.session:
+			self.session.save_cookie(response, self.session_cookie_name)
+		else:
+			response.delete_cookie(self.session_cookie_name)
+
+
+class LightweightResponse(Response):
+	"""Skips making the `Location` header absolute, which is a large part
+	of the time of a redirect, so the location must already be absolute.
+	Lightweight views have no `request`, so the response is made
+	conditional to conditional requests when it is called."""
+
+	autocorrect_location_header = False
+
+	def __call__(self, environ: Dict[str, Any],
+ 				start_response: Callable) -> Iterable[bytes]:
+		if "HTTP_IF_NONE_MATCH" in environ and "etag" in self.headers:
+			self.make_conditional(environ)
+		return super().__call__(environ, start_response)
@@ -1,6 +1,6 @@
 from typing import Any
 
-from wtforms import validators, StringField
+from wtforms import validators, StringField, SelectField, IntegerField
 from wtforms import SubmitField as BaseSubmitField
 from wtforms import PasswordField as BasePasswordField
 
@@ -103,6 +103,51 @@ class FullURLField(StringField):
 		super().__init__(**kwargs)
 
 
+class RedirectStatusField(SelectField):
+	default_label = "Redirect"
+	default_render_kw = {'class': "form-control"}
+	default_choices = (
+		(302, "Temporary (302)"),
+		(307, "Temporary, keeping the method (307)"),
+		(301, "Permanent (301)"),
+	)
+
+	def __init__(self, **kwargs: Any) -> None:
+		kwargs.setdefault("label", self.default_label)
+		kwargs.setdefault("render_kw", self.default_render_kw)
+		kwargs.setdefault("choices", self.default_choices)
+		kwargs.setdefault("coerce", int)
+		kwargs.setdefault("default", 302)
+
+		super().__init__(**kwargs)
+
+
+class RedirectMaxAgeField(IntegerField):
+	# A year, the maximum recommended for `Cache-Control`.
+	max_value = 365 * 24 * 60 * 60
+
+	default_label = "Cache the redirect for seconds"
+	default_render_kw = {
+		'class': "form-control",
+		'min': 0, 'max': max_value,
+		'placeholder': "Clicks served from caches are not counted...",
+	}
+
+	validators = (
+		validators.Optional(),
+		validators.NumberRange(min=0, max=max_value, message=(
+			"Seconds must not be less than %(min)d and more than %(max)d."
+		)),
+	)
+
+	def __init__(self, **kwargs: Any) -> None:
+		kwargs.setdefault("label", self.default_label)
+		kwargs.setdefault("render_kw", self.default_render_kw)
+		kwargs.setdefault("default", 0)
+
+		super().__init__(**kwargs)
+
+
 class SubmitField(BaseSubmitField):
 	default_label = ""
 	default_render_kw = {'class': "btn btn-primary", 'value': "Submit"}
@@ -1,12 +1,14 @@
 from typing import Optional
 
-from wtforms.validators import ValidationError
+from wtforms import Form as BaseForm, FileField
+from wtforms.validators import ValidationError, InputRequired
 
 from . import fields
+from .slugs import slug_allocator
 from .models import User, ShortURL
 from .core.db import session
 from .core.forms import Form
-from .core.locals import current_user
+from .core.locals import current_app, current_user
 
 
 class LoginForm(Form):
@@ -63,12 +65,50 @@ class DeactivateForm(Form):
 
 class ShortURLForm(Form):
 	full_url = fields.FullURLField()
+	redirect_status = fields.RedirectStatusField()
+	redirect_max_age = fields.RedirectMaxAgeField()
 	submit = fields.SubmitField()
 
+	# Whether `populate` returned an existing short URL.
+	is_duplicate = False
+
 	def populate(self) -> ShortURL:
+		"""Creates the short URL or, with `SHORT_URLS_DEDUPLICATE`, returns
+		the owner's existing one of the same URL and redirect policy."""
+
+		owner_id = current_user.get_id()
+		redirect_max_age = self.redirect_max_age.data or 0
+		if current_app.config.get("SHORT_URLS_DEDUPLICATE"):
+			existing = ShortURL.find_duplicate(
+				owner_id, self.full_url.data,
+				redirect_status=self.redirect_status.data,
+				redirect_max_age=redirect_max_age,
+			)
+			if existing is not None:
+				self.is_duplicate = True
+				return existing
+
+		# `owner_id` instead of `owner`, so that the cascade doesn't add
+		# the short URL to the session before the slug is assigned.
 		rv = ShortURL(  # type: ignore
-			owner=current_user,
+			owner_id=owner_id,
 			full_url=self.full_url.data,
+			redirect_status=self.redirect_status.data,
+			redirect_max_age=redirect_max_age,
 		)
-		session.add(rv)
+		slug_allocator.assign(rv)
 		return rv
+
+
+class FullURLForm(BaseForm):
+	"""Validates a single full URL without CSRF, e.g. a row of a bulk
+	upload that is already protected by `BulkShortURLForm`."""
+
+	full_url = fields.FullURLField()
+
+
+class BulkShortURLForm(Form):
+	file = FileField("CSV or JSON file", validators=(
+		InputRequired("File is required."),
+	), render_kw={'class': "form-control-file", 'accept': ".csv,.json"})
+	submit = fields.SubmitField()
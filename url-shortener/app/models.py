@@ -1,13 +1,81 @@
-import secrets
+from __future__ import annotations
+
+import asyncio
+import hashlib
+from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit
+from typing import Any, Dict, List, Tuple, Iterable, Optional, NamedTuple
 
 import sqlalchemy as sa
-from werkzeug.security import generate_password_hash, check_password_hash
 
-from .core.db import Model
+from .core.db import Model, session, read_from_replica
 from .core.auth import UserMixin
+from .core.cache import MISSING, Namespace
+from .core.locals import current_app
+from .core.passwords import password_policy
+
+
+SLUG_MAX_LENGTH = 16
+REFERRER_MAX_LENGTH = 500
+ROLLUP_VALUE_MAX_LENGTH = 255
+# Hex digits of `hash_full_url` results.
+FULL_URL_HASH_LENGTH = 32
+DEFAULT_PORTS = {'http': "80", 'https': "443", 'ftp': "21"}
+# Resolutions of `ClickRollup` buckets in seconds.
+ROLLUP_RESOLUTIONS = {'minute': 60, 'hour': 60 * 60, 'day': 24 * 60 * 60}
+
+# Used by `slugs.SlugAllocator` in sequence mode. Its increment is the
+# number of slugs a worker reserves at once.
+slug_sequence = sa.Sequence(
+	"shorturl_slug_seq",
+	start=100,
+	increment=100,
+	metadata=Model.metadata,  # type: ignore
+)
+
+
+def normalize_full_url(full_url: str, /) -> str:
+	"""Lowercases the scheme and the host, removes the default port and
+	the empty query and adds the root path, so that spellings of one URL
+	are equal. The rest is kept, as servers may tell its spellings apart."""
+
+	parts = urlsplit(full_url.strip())
+	scheme = parts.scheme.lower()
+	userinfo, at, host = parts.netloc.rpartition("@")
+	host = host.lower()
+	default_port = DEFAULT_PORTS.get(scheme)
+	if default_port is not None and host.endswith(":" + default_port):
+		host = host[:-len(default_port) - 1]
+	host = host.rstrip(":")
+	return urlunsplit((
+		scheme, userinfo + at + host, parts.path or "/", parts.query,
+		parts.fragment,
+	))
+
+
+def hash_full_url(full_url: str, /) -> str:
+	"""A fixed-size hash of the normalized full URL, which is indexed
+	instead of full URLs of up to 500 characters."""
+
+	return hashlib.blake2b(
+		normalize_full_url(full_url).encode(),
+		digest_size=FULL_URL_HASH_LENGTH // 2,
+	).hexdigest()
+
+
+def _get_full_url_hash_default(context: Any, /) -> str:
+	return hash_full_url(context.get_current_parameters()['full_url'])
+
+
+class Redirect(NamedTuple):
+	full_url: str
+	status: int
+	max_age: int
 
 
 class User(UserMixin, Model):
+	snapshot_fields = ("username", "is_staff", "is_active")
+
 	username \
 		= sa.Column(sa.String(30), unique=True, index=True, nullable=False)
 	password_hash = sa.Column(sa.String(255))
@@ -20,24 +88,322 @@ class User(UserMixin, Model):
 	def get_id(self) -> int:
 		return self.id
 
+	def get_version(self) -> int:
+		if self.updated_at is None:
+			return 0
+		return int(self.updated_at.timestamp() * 1_000_000)
+
 	def set_password(self, password: str, /) -> None:
-		self.password_hash = generate_password_hash(password, "sha256")
+		self.password_hash = password_policy.hash(password)
 
 	def check_password(self, password: str, /) -> bool:
-		if self.password_hash is None:
+		"""Also rehashes the password if its hash is outdated, which must
+		be committed."""
+
+		if (
+			self.password_hash is None
+			or not password_policy.verify(password, self.password_hash)
+		):
 			return False
-		return check_password_hash(self.password_hash, password)
+		if password_policy.needs_rehash(self.password_hash):
+			self.set_password(password)
+		return True
 
 
 class ShortURL(Model):
+	__table_args__ = (
+		# For keyset pagination of the owner's short URLs.
+		sa.Index("ix_shorturl_owner_id_created_at_id",
+ 				"owner_id", "created_at", "id"),
+		# For deduplication of the owner's full URLs.
+		sa.Index("ix_shorturl_owner_id_full_url_hash",
+ 				"owner_id", "full_url_hash"),
+	)
+
 	owner_id = sa.Column(sa.Integer, sa.ForeignKey("user.id"), nullable=False)
 	owner = sa.orm.relationship("User", backref=sa.orm.backref(
 		"short_urls", cascade="all,delete", lazy="dynamic",
 	))
-	full_url = sa.Column(sa.Text, index=True, nullable=False)
+	full_url = sa.Column(sa.Text, nullable=False)
+	# Set from `full_url` on insert, which must not be changed afterwards.
+	full_url_hash = sa.Column(sa.String(FULL_URL_HASH_LENGTH), nullable=False,
+ 							default=_get_full_url_hash_default)
 	clicks = sa.Column(sa.Integer, nullable=False, default=0)
-	slug = sa.Column(sa.String(4), unique=True, index=True,
- 					nullable=False, default=lambda: secrets.token_hex(2))
+	# Seconds for which browsers and the proxy may cache the redirect.
+	# Clicks served from their caches are not counted.
+	redirect_status = sa.Column(sa.SmallInteger, nullable=False, default=302,
+ 								server_default="302")
+	redirect_max_age = sa.Column(sa.Integer, nullable=False, default=0,
+ 								server_default="0")
+	# The `HyperLogLog` of visitors maintained by `clicks.ClickRecorder`
+	# and its estimate. The sketch is deferred, as only the recorder needs
+	# it and it reads the table directly.
+	visitors_sketch = sa.orm.deferred(sa.Column(sa.LargeBinary))
+	unique_visitors = sa.Column(sa.Integer, nullable=False, default=0,
+ 								server_default="0")
+	# Assigned by `slugs.SlugAllocator`.
+	slug = sa.Column(sa.String(SLUG_MAX_LENGTH), unique=True, index=True,
+ 					nullable=False)
 
 	def __repr__(self) -> str:
 		return "<ShortURL slug=\"%s\" clicks=%d>" % (self.slug, self.clicks)
+
+	@staticmethod
+	def _get_cache() -> Namespace:
+		return current_app.cache.namespace(
+			"short-url-redirect",
+			current_app.config.get("SHORT_URLS_CACHE_TTL"),
+		)
+
+	@staticmethod
+	def _get_count_cache() -> Namespace:
+		return current_app.cache.namespace(
+			"short-urls-count",
+			current_app.config.get("SHORT_URLS_COUNT_CACHE_TTL"),
+		)
+
+	@classmethod
+	def _get_redirect_columns(cls) -> Tuple[sa.Column, ...]:
+		return (cls.full_url, cls.redirect_status, cls.redirect_max_age)
+
+	@classmethod
+	def _query_redirect(cls, slug: str, /) -> Optional[Redirect]:
+		row = cls.query.with_entities(*cls._get_redirect_columns()) \
+			.filter_by(slug=slug).first()
+		return None if row is None else Redirect(*row)
+
+	@classmethod
+	def get_redirect(cls, slug: str, /,
+ 					fresh: bool = False) -> Optional[Redirect]:
+		"""Returns the full URL and the redirect policy of the slug using
+		`current_app.cache` in front of the database. Unknown slugs are
+		cached too, but for a shorter time, so that bots iterating over
+		random slugs do not reach the database on every request.
+
+		With `fresh`, the cache, which may be of another worker, and
+		replicas, which lag behind, are bypassed and only the primary is
+		queried. The cache is updated with the result."""
+
+		cache = cls._get_cache()
+		if fresh:
+			rv = cls._query_redirect(slug)
+			cls._cache_redirect(cache, slug, rv)
+			return rv
+
+		rv = cache.get(slug, MISSING)
+		if rv is not MISSING:
+			return rv
+
+		with read_from_replica():
+			rv = cls._query_redirect(slug)
+		# Replicas lag behind, so the slug that was just created may be
+		# missing there. Check the primary before caching it as unknown.
+		if rv is None and session().replicas:
+			rv = cls._query_redirect(slug)
+
+		cls._cache_redirect(cache, slug, rv)
+		return rv
+
+	@classmethod
+	async def get_redirect_async(cls, slug: str, /,
+ 								fresh: bool = False) -> Optional[Redirect]:
+		"""Like `get_redirect`, but doesn't block the event loop on the
+		database. Without an async driver, `get_redirect` is run in
+		a thread."""
+
+		database_manager = current_app.database_manager
+		if database_manager.async_engine is None:
+			return await asyncio.to_thread(cls.get_redirect, slug, fresh)
+
+		cache = cls._get_cache()
+		if not fresh:
+			rv = cache.get(slug, MISSING)
+			if rv is not MISSING:
+				return rv
+
+		statement = sa.select(*cls._get_redirect_columns()) \
+			.filter_by(slug=slug)
+		async with database_manager.connect_async(
+			read_only=not fresh,
+		) as conn:
+			row = (await conn.execute(statement)).first()
+		if row is None and not fresh and database_manager.async_replicas:
+			async with database_manager.connect_async() as conn:
+				row = (await conn.execute(statement)).first()
+
+		rv = None if row is None else Redirect(*row)
+		cls._cache_redirect(cache, slug, rv)
+		return rv
+
+	@staticmethod
+	def _cache_redirect(cache: Namespace, slug: str,
+ 						redirect: Optional[Redirect], /) -> None:
+		ttl = (None if redirect is not None
+			else current_app.config.get("SHORT_URLS_NEGATIVE_CACHE_TTL"))
+		cache.set(slug, redirect, ttl)
+
+	@classmethod
+	def find_duplicate(
+		cls,
+		owner_id: int,
+		full_url: str,
+		/,
+		redirect_status: int = 302,
+		redirect_max_age: int = 0,
+	) -> Optional[ShortURL]:
+		"""Returns the oldest of the owner's short URLs of the same
+		normalized full URL and redirect policy, if any."""
+
+		return cls.query.filter_by(
+			owner_id=owner_id,
+			full_url_hash=hash_full_url(full_url),
+			redirect_status=redirect_status,
+			redirect_max_age=redirect_max_age,
+		).order_by(cls.id).first()
+
+	@classmethod
+	def get_slugs_by_full_url_hashes(cls, owner_id: int,
+ 									full_url_hashes: Iterable[str],
+ 									/) -> Dict[str, str]:
+		"""Like `find_duplicate` with the default redirect policy for many
+		full URLs at once. Returns slugs by hashes of found ones."""
+
+		rows = session.query(cls.full_url_hash, cls.slug).filter(
+			cls.owner_id == owner_id,
+			cls.full_url_hash.in_(set(full_url_hashes)),
+			cls.redirect_status == 302,
+			cls.redirect_max_age == 0,
+		).order_by(cls.id.desc())
+		# The oldest short URLs come last and win.
+		return dict(rows)
+
+	@classmethod
+	def get_count_by_owner(cls, owner_id: int, /) -> int:
+		cache = cls._get_count_cache()
+		rv = cache.get(str(owner_id))
+		if rv is None:
+			rv = cls.query.filter_by(owner_id=owner_id).count()
+			cache.set(str(owner_id), rv)
+		return rv
+
+	@classmethod
+	def forget(cls, slug: str, /, owner_id: int) -> None:
+		"""Removes the slug and the owner's count of short URLs from
+		`current_app.cache`. Must be called when the short URL is created
+		or deleted."""
+
+		cls._get_cache().delete(slug)
+		cls.forget_count_by_owner(owner_id)
+
+	@classmethod
+	def forget_count_by_owner(cls, owner_id: int, /) -> None:
+		cls._get_count_cache().delete(str(owner_id))
+
+
+class ClickEvent(Model):
+	"""A click of a short URL, written by `clicks.ClickRecorder`. The table
+	is append-only, `created_at` is the time of the click."""
+
+	short_url_id = sa.Column(
+		sa.Integer, sa.ForeignKey("shorturl.id", ondelete="CASCADE"),
+		index=True, nullable=False,
+	)
+	referrer = sa.Column(sa.String(REFERRER_MAX_LENGTH))
+	user_agent_family = sa.Column(sa.String(32), nullable=False)
+	# ISO 3166-1 alpha-2 code, if the GeoIP database is configured.
+	country = sa.Column(sa.String(2))
+
+
+class ClickRollup(Model):
+	"""The number of clicks of a short URL in the bucket of a resolution,
+	maintained by `clicks.ClickRecorder`. Totals have empty `dimension`
+	and `value`; daily rows are also broken down by referrer host, user
+	agent family and country."""
+
+	__table_args__ = (
+		sa.UniqueConstraint(
+			"short_url_id", "resolution", "bucket", "dimension", "value",
+			name="uq_clickrollup_short_url_id_bucket",
+		),
+		# For pruning old rollups.
+		sa.Index("ix_clickrollup_resolution_bucket", "resolution", "bucket"),
+	)
+
+	short_url_id = sa.Column(
+		sa.Integer, sa.ForeignKey("shorturl.id", ondelete="CASCADE"),
+		nullable=False,
+	)
+	# One of `ROLLUP_RESOLUTIONS`.
+	resolution = sa.Column(sa.String(6), nullable=False)
+	bucket = sa.Column(sa.DateTime, nullable=False)
+	dimension = sa.Column(sa.String(16), nullable=False, default="")
+	value = sa.Column(
+		sa.String(ROLLUP_VALUE_MAX_LENGTH), nullable=False, default="",
+	)
+	clicks = sa.Column(sa.Integer, nullable=False, default=0)
+
+	@classmethod
+	def get_series(cls, short_url_id: int, resolution: str, /,
+ 				since: datetime) -> List[Tuple[datetime, int]]:
+		"""Returns total clicks of non-empty buckets starting at `since`."""
+
+		return cls.query \
+			.with_entities(cls.bucket, cls.clicks) \
+			.filter_by(short_url_id=short_url_id, resolution=resolution,
+ 					dimension="") \
+			.filter(cls.bucket >= since) \
+			.order_by(cls.bucket) \
+			.all()
+
+	@classmethod
+	def get_top_values(
+		cls,
+		short_url_id: int,
+		/,
+		since: datetime,
+		limit: int = 10,
+	) -> Dict[str, List[Tuple[str, int]]]:
+		"""Returns the most clicked values of every dimension in daily
+		rollups starting at `since`."""
+
+		rows = cls.query \
+			.with_entities(cls.dimension, cls.value, sa.func.sum(cls.clicks)) \
+			.filter_by(short_url_id=short_url_id, resolution="day") \
+			.filter(cls.dimension != "", cls.bucket >= since) \
+			.group_by(cls.dimension, cls.value) \
+			.all()
+
+		rv: Dict[str, List[Tuple[str, int]]] = {}
+		for dimension, value, clicks in sorted(rows, key=lambda r: -r[2]):
+			values = rv.setdefault(dimension, [])
+			if len(values) < limit:
+				values.append((value, clicks))
+		return rv
+
+
+class VisitorSketch(Model):
+	"""The `HyperLogLog` of visitors of a short URL in a day, maintained by
+	`clicks.ClickRecorder`."""
+
+	__table_args__ = (
+		sa.UniqueConstraint("short_url_id", "bucket",
+ 							name="uq_visitorsketch_short_url_id_bucket"),
+	)
+
+	short_url_id = sa.Column(
+		sa.Integer, sa.ForeignKey("shorturl.id", ondelete="CASCADE"),
+		nullable=False,
+	)
+	bucket = sa.Column(sa.DateTime, nullable=False)
+	registers = sa.Column(sa.LargeBinary, nullable=False)
+	unique_visitors = sa.Column(sa.Integer, nullable=False, default=0)
+
+	@classmethod
+	def get_series(cls, short_url_id: int, /,
+ 				since: datetime) -> List[Tuple[datetime, int]]:
+		return cls.query \
+			.with_entities(cls.bucket, cls.unique_visitors) \
+			.filter_by(short_url_id=short_url_id) \
+			.filter(cls.bucket >= since) \
+			.order_by(cls.bucket) \
+			.all()
@@ -0,0 +1,89 @@
+import logging
+from hashlib import sha1
+from time import time
+from urllib.parse import urlsplit
+from typing import Type
+from http.client import HTTPConnection, HTTPException
+
+from werkzeug.http import http_date, quote_etag
+from werkzeug.utils import redirect as make_redirect
+
+from .models import Redirect
+from .core.app import Response
+from .core.locals import current_app, request
+from .core.utils import url_for
+
+
+PURGE_HEADER = "X-Cache-Purge"
+PURGE_ENVIRON_KEY = "HTTP_X_CACHE_PURGE"
+
+logger = logging.getLogger(__name__)
+
+
+def make_redirect_response(
+	redirect: Redirect,
+	/,
+	response_class: Type[Response] = Response,
+) -> Response:
+	"""Redirects with the status of the short URL. With a positive max age
+	browsers and the proxy cache the redirect, otherwise they must
+	revalidate it with the `ETag` on every click."""
+
+	rv = make_redirect(redirect.full_url, redirect.status,
+  					Response=response_class)
+
+	# The headers are set directly, as `cache_control` and `expires` are
+	# slower and this is the hot path.
+	etag = sha1(b"%d %s" % (redirect.status, redirect.full_url.encode()))
+	rv.headers['ETag'] = quote_etag(etag.hexdigest())
+	if redirect.max_age > 0:
+		rv.headers['Cache-Control'] = "public, max-age=%d" % redirect.max_age
+		rv.headers['Expires'] = http_date(time() + redirect.max_age)
+	else:
+		rv.headers['Cache-Control'] = "no-cache"
+	return rv
+
+
+def is_purge_request() -> bool:
+	return PURGE_ENVIRON_KEY in request.environ
+
+
+def make_purge_response() -> Response:
+	"""The 404 response to `purge_proxy_cache`. The proxy caches it for
+	a second instead of the redirect, then it serves the requests with
+	the application again."""
+
+	rv = current_app.make_response("", 404, "text/plain")
+	rv.headers['X-Accel-Expires'] = "1"
+	return rv
+
+
+def purge_proxy_cache(slug: str, /) -> None:
+	"""Requests the redirect of the deleted slug from the caching proxy at
+	`SHORT_URLS_PURGE_URL` with the `X-Cache-Purge` header, which makes the
+	proxy bypass and replace its cached redirect. The proxy must accept
+	the header only from the application, e.g. on a port that is not
+	published. Browsers keep their cached redirects until their max age
+	passes."""
+
+	purge_url = current_app.config.get("SHORT_URLS_PURGE_URL")
+	if not purge_url:
+		return
+
+	parts = urlsplit(purge_url)
+	conn = HTTPConnection(
+		parts.netloc,
+		timeout=current_app.config.get("SHORT_URLS_PURGE_TIMEOUT", 1.0),
+	)
+	try:
+		conn.request(
+			"GET",
+			parts.path.rstrip("/") + url_for("follow", slug=slug),
+			headers={PURGE_HEADER: "1"},
+		)
+		conn.getresponse().read()
+	except (OSError, HTTPException):
+		logger.warning("Failed to purge %r from the proxy cache.", slug,
+  					exc_info=True)
+	finally:
+		conn.close()
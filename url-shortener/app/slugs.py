@@ -0,0 +1,422 @@
+import math
+import time
+import string
+import logging
+import secrets
+from threading import Lock, Thread
+from typing import Any, Set, Dict, List, Iterator, Optional
+
+import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
+
+from .models import ShortURL, SLUG_MAX_LENGTH, slug_sequence
+from .core.db import session
+from .core.app import Application
+from .core.bloom import BloomFilter
+
+
+BASE62_ALPHABET = string.digits + string.ascii_letters
+
+logger = logging.getLogger(__name__)
+
+
+class SlugAllocationError(RuntimeError):
+	pass
+
+
+def encode_number(number: int, /, alphabet: str, length: int) -> str:
+	"""Encodes the number in base `len(alphabet)`, padded to `length`."""
+
+	base = len(alphabet)
+	chars = []
+	while number:
+		number, rest = divmod(number, base)
+		chars.append(alphabet[rest])
+
+	if len(chars) > length:
+		raise ValueError("The number doesn't fit into the length.")
+	chars.extend(alphabet[0] * (length - len(chars)))
+	return "".join(reversed(chars))
+
+
+class SlugFilter:
+	"""A Bloom filter of existing slugs, so that requests for random slugs,
+	e.g. of bots, are answered without the database.
+
+	The filter is built in a background thread on the first use, so until
+	it is built all slugs may exist. Slugs allocated by this worker are
+	added right away. Slugs created by other workers are loaded when the
+	filter reports a slug missing, at most once in `sync_interval`
+	seconds: rows with ids above the last seen one minus `sync_overlap`,
+	which covers transactions that got lower ids but committed later.
+
+	Deleted slugs can't be removed from a Bloom filter and are checked in
+	the database like any "maybe". The filter is rebuilt in background
+	every `rebuild_interval` seconds, which drops them, and when it holds
+	more slugs than it was sized for.
+	"""
+
+	thread_name = "slug-filter"
+
+	def __init__(self) -> None:
+		self.engine: Optional[sa.engine.Engine] = None
+		self.false_positive_rate = 0.01
+		self.min_capacity = 100000
+		self.sync_interval = 1.0
+		self.sync_overlap = 2000
+		self.rebuild_interval = 3600.0
+		self.build_retry_interval = 30.0
+
+		self._lock = Lock()
+		self._sync_lock = Lock()
+		self._filter: Optional[BloomFilter] = None
+		self._is_building = False
+		# Slugs added while the filter is being built.
+		self._pending: List[str] = []
+		self._last_id = 0
+		self._build_started_at: Optional[float] = None
+		self._built_at = 0.0
+		self._synced_at = 0.0
+
+	def init_app(self, app: Application, /) -> None:
+		assert app.database_manager is not None, "No database configured."
+
+		config = app.config
+		self.engine = app.database_manager.engine
+		self.false_positive_rate = config.get(
+			"SLUG_FILTER_FALSE_POSITIVE_RATE", self.false_positive_rate,
+		)
+		self.sync_interval \
+			= config.get("SLUG_FILTER_SYNC_INTERVAL", self.sync_interval)
+		self.sync_overlap \
+			= config.get("SLUG_FILTER_SYNC_OVERLAP", self.sync_overlap)
+		self.rebuild_interval \
+			= config.get("SLUG_FILTER_REBUILD_INTERVAL", self.rebuild_interval)
+
+	def _start_build(self) -> None:
+		now = time.monotonic()
+		with self._lock:
+			if self._is_building or (
+				self._build_started_at is not None
+				and now - self._build_started_at < self.build_retry_interval
+			):
+				return
+			self._is_building = True
+			self._build_started_at = now
+		Thread(target=self._build, name=self.thread_name, daemon=True).start()
+
+	def _build(self) -> None:
+		assert self.engine is not None, "`init_app` was not called."
+		table = ShortURL.__table__  # type: ignore
+
+		try:
+			with self.engine.connect() as connection:
+				count = connection.execute(
+					sa.select(sa.func.count()).select_from(table),
+				).scalar()
+				rv = BloomFilter(max(self.min_capacity, count * 2),
+  								self.false_positive_rate)
+
+				last_id = 0
+				result = connection.execution_options(stream_results=True) \
+					.execute(sa.select(table.c.id, table.c.slug))
+				for id, slug in result:
+					rv.add(slug)
+					last_id = max(last_id, id)
+
+			with self._lock:
+				for slug in self._pending:
+					rv.add(slug)
+				self._filter = rv
+				self._last_id = last_id
+				self._built_at = self._synced_at = time.monotonic()
+		except Exception:
+			logger.exception("Failed to build the slug filter.")
+		finally:
+			with self._lock:
+				self._is_building = False
+				self._pending.clear()
+
+	def _sync(self) -> None:
+		assert self.engine is not None, "`init_app` was not called."
+		table = ShortURL.__table__  # type: ignore
+
+		statement = sa.select(table.c.id, table.c.slug) \
+			.where(table.c.id > self._last_id - self.sync_overlap)
+		with self.engine.connect() as connection:
+			rows = connection.execute(statement).all()
+
+		with self._lock:
+			assert self._filter is not None
+			for id, slug in rows:
+				self._filter.add(slug)
+				self._last_id = max(self._last_id, id)
+			self._synced_at = time.monotonic()
+
+	def add_many(self, slugs: List[str], /) -> None:
+		with self._lock:
+			if self._filter is not None:
+				for slug in slugs:
+					self._filter.add(slug)
+			if self._is_building:
+				self._pending.extend(slugs)
+
+	def might_exist(self, slug: str, /) -> bool:
+		"""Checks the filter only, so it doesn't block."""
+
+		bloom_filter = self._filter
+		if (
+			bloom_filter is None
+			or bloom_filter.is_full
+			or time.monotonic() - self._built_at > self.rebuild_interval
+		):
+			self._start_build()
+		return bloom_filter is None or slug in bloom_filter
+
+	def is_missing(self, slug: str, /) -> bool:
+		"""Returns `True` only if the slug definitely doesn't exist. May
+		load new slugs from the database before answering."""
+
+		if self.might_exist(slug):
+			return False
+
+		if (
+			time.monotonic() - self._synced_at >= self.sync_interval
+			and self._sync_lock.acquire(blocking=False)
+		):
+			try:
+				self._sync()
+			except sa.exc.DBAPIError:
+				logger.warning("Failed to sync the slug filter.",
+  							exc_info=True)
+				return False
+			finally:
+				self._sync_lock.release()
+			return not self.might_exist(slug)
+		return True
+
+
+class SlugAllocator:
+	"""Allocates slugs of short URLs. There are two modes:
+
+	Random (the default). The slug is a random string of the shortest
+	length at which the table occupies no more than `max_occupancy` of
+	all possible slugs, so the length grows together with the table and
+	a conflict is rare. The number of rows is estimated with `max(id)`
+	once in `occupancy_refresh_interval` seconds. On a conflict the slug
+	is regenerated, up to `max_attempts` times.
+
+	Sequence. Numbers are reserved in blocks from the `shorturl_slug_seq`
+	database sequence (PostgreSQL only), so a worker touches the sequence
+	once per block. The sequence increments by the block size, so its
+	value is the end of a block. The increment is read together with it,
+	so blocks don't overlap after the increment is altered. Every number is mapped
+	to a slug by a bijection, hashids-style, so slugs are unique without
+	checking the table and do not look sequential. Don't switch an
+	existing table from random to sequence mode unless `min_length`
+	exceeds the length of existing slugs.
+	"""
+
+	# Must be coprime with the alphabet length, so that multiplication
+	# by it modulo `len(alphabet) ** length` is a bijection.
+	sequence_multiplier = 1_000_000_007
+
+	def __init__(self) -> None:
+		self.alphabet = BASE62_ALPHABET
+		self.min_length = 5
+		self.max_occupancy = 0.01
+		self.max_attempts = 5
+		self.occupancy_refresh_interval = 60.0
+		self.use_sequence = False
+		self.sequence_salt = 0
+
+		self._lock = Lock()
+		self._rows_count = 0
+		self._rows_counted_at: Optional[float] = None
+		self._block: Iterator[int] = iter(())
+
+	def init_app(self, app: Application, /) -> None:
+		config = app.config
+
+		self.alphabet = config.get("SLUG_ALPHABET", self.alphabet)
+		self.min_length = config.get("SLUG_MIN_LENGTH", self.min_length)
+		self.max_occupancy \
+			= config.get("SLUG_MAX_OCCUPANCY", self.max_occupancy)
+		self.use_sequence = config.get("SLUG_USE_SEQUENCE", self.use_sequence)
+		self.sequence_salt \
+			= config.get("SLUG_SEQUENCE_SALT", self.sequence_salt)
+
+		if len(set(self.alphabet)) != len(self.alphabet):
+			raise ValueError("The slug alphabet has duplicate characters.")
+		if math.gcd(self.sequence_multiplier, len(self.alphabet)) != 1:
+			raise ValueError("The slug alphabet length is not supported.")
+		if not 0 < self.min_length <= SLUG_MAX_LENGTH:
+			raise ValueError(
+				f"The slug length must be from 1 to {SLUG_MAX_LENGTH}.",
+			)
+
+	def _get_rows_count(self) -> int:
+		now = time.monotonic()
+		if (
+			self._rows_counted_at is None
+			or now - self._rows_counted_at > self.occupancy_refresh_interval
+		):
+			with session.no_autoflush:
+				self._rows_count = session.query(
+					sa.func.max(ShortURL.id),
+				).scalar() or 0
+			self._rows_counted_at = now
+		return self._rows_count
+
+	def get_random_length(self, rows_count: int, /) -> int:
+		base = len(self.alphabet)
+		length = self.min_length
+		while (
+			length < SLUG_MAX_LENGTH
+			and rows_count > base ** length * self.max_occupancy
+		):
+			length += 1
+		return length
+
+	def _allocate_random(self, count: int, /) -> List[str]:
+		length = self.get_random_length(self._get_rows_count() + count)
+		capacity = len(self.alphabet) ** length
+
+		return [
+			encode_number(secrets.randbelow(capacity), self.alphabet, length)
+			for _ in range(count)
+		]
+
+	def encode_sequence_number(self, number: int, /) -> str:
+		base = len(self.alphabet)
+		length = self.min_length
+		while number >= base ** length:
+			number -= base ** length
+			length += 1
+		if length > SLUG_MAX_LENGTH:
+			raise SlugAllocationError("The slug sequence is exhausted.")
+
+		capacity = base ** length
+		number = (number * self.sequence_multiplier + self.sequence_salt) \
+			% capacity
+		return encode_number(number, self.alphabet, length)
+
+	def _reserve_block(self) -> Iterator[int]:
+		sequences = sa.table(
+			"pg_sequences", sa.column("schemaname"),
+			sa.column("sequencename"), sa.column("increment_by"),
+		)
+		statement = sa.select(
+			slug_sequence.next_value(), sequences.c.increment_by,
+		).where(
+			sequences.c.schemaname == sa.func.current_schema(),
+			sequences.c.sequencename == slug_sequence.name,
+		)
+		with session.no_autoflush:
+			end, size = session.execute(statement).one()
+		return iter(range(end - size, end))
+
+	def _allocate_sequential(self, count: int, /) -> List[str]:
+		rv = []
+		with self._lock:
+			while len(rv) < count:
+				number = next(self._block, None)
+				if number is None:
+					self._block = self._reserve_block()
+					continue
+				rv.append(self.encode_sequence_number(number))
+		return rv
+
+	def allocate(self, count: int = 1, /) -> List[str]:
+		"""Returns `count` new slugs. In random mode they can still conflict
+		with existing slugs, use `assign` to handle it."""
+
+		rv = (self._allocate_sequential(count) if self.use_sequence
+			else self._allocate_random(count))
+		# Before they are inserted, so that the filter never reports them
+		# missing. Slugs that are not inserted in the end are harmless.
+		slug_filter.add_many(rv)
+		return rv
+
+	def assign(self, short_url: ShortURL, /) -> None:
+		"""Sets the slug of the new short URL and adds it to the session.
+		In random mode the short URL is flushed inside a savepoint, so that
+		the slug can be regenerated on a conflict. So it must not be already
+		pending in the session, otherwise it will be flushed before the
+		savepoint."""
+
+		if self.use_sequence:
+			short_url.slug = self.allocate()[0]
+			session.add(short_url)
+			return
+
+		for _ in range(self.max_attempts):
+			short_url.slug = self.allocate()[0]
+			try:
+				with session.begin_nested():
+					session.add(short_url)
+			except IntegrityError:
+				continue
+			return
+
+		raise SlugAllocationError(
+			f"No free slug was found in {self.max_attempts} attempts.",
+		)
+
+	def _find_conflicting_slugs(self, slugs: List[str], /) -> Set[str]:
+		"""Returns slugs that are repeated or already exist."""
+
+		seen: Set[str] = set()
+		rv: Set[str] = set()
+		for slug in slugs:
+			(rv if slug in seen else seen).add(slug)
+
+		with session.no_autoflush:
+			rv.update(
+				slug for (slug,) in session.query(ShortURL.slug)
+				.filter(ShortURL.slug.in_(slugs))
+			)
+		return rv
+
+	def insert_many(self, rows: List[Dict[str, Any]], /) -> None:
+		"""Sets `'slug'` of every row of `shorturl` table and inserts them
+		with one multi-row `INSERT`. In random mode the insert is done inside
+		a savepoint, and on a conflict only conflicting slugs are
+		regenerated."""
+
+		table = ShortURL.__table__  # type: ignore
+
+		for row, slug in zip(rows, self.allocate(len(rows))):
+			row['slug'] = slug
+
+		if self.use_sequence:
+			session.execute(table.insert(), rows)
+			return
+
+		for _ in range(self.max_attempts):
+			try:
+				with session.begin_nested():
+					session.execute(table.insert(), rows)
+			except IntegrityError:
+				conflicting_slugs = self._find_conflicting_slugs(
+					[row['slug'] for row in rows],
+				)
+				conflicting_rows = [
+					row for row in rows if row['slug'] in conflicting_slugs
+				]
+				if not conflicting_rows:
+					raise
+
+				new_slugs = self.allocate(len(conflicting_rows))
+				for row, slug in zip(conflicting_rows, new_slugs):
+					row['slug'] = slug
+				continue
+			return
+
+		raise SlugAllocationError(
+			f"No free slugs were found in {self.max_attempts} attempts.",
+		)
+
+
+slug_filter = SlugFilter()
+slug_allocator = SlugAllocator()
@@ -1,13 +1,24 @@
-from typing import Union
+import asyncio
+from functools import lru_cache
+from datetime import datetime, timedelta
+from typing import Any, Dict, Type, Union, Optional
 
 from werkzeug.utils import redirect
+from werkzeug.datastructures import CombinedMultiDict
 from werkzeug.exceptions import abort, NotFound, MethodNotAllowed
 
-from .models import ShortURL
-from .forms import ShortURLForm
+from .slugs import slug_filter
+from .models import ShortURL, ClickRollup, VisitorSketch
+from .clicks import click_counter, click_recorder
+from .forms import ShortURLForm, BulkShortURLForm
+from .bulk import BulkFormatError, read_full_urls, write_csv, \
+	create_short_urls
+from .redirects import PURGE_ENVIRON_KEY, is_purge_request, \
+	make_purge_response, make_redirect_response, purge_proxy_cache
 from .decorators import logout_required
-from .core.db import session
-from .core.app import Response
+from .core.db import session, read_from_replica
+from .core.app import Application, Response
+from .core.wrappers import LightweightResponse
 from .core.decorators import login_required
 from .core.locals import current_app, request, current_user
 from .core.utils import flash, url_for, render_template, get_next_param
@@ -30,6 +41,8 @@ def login() -> Union[str, Response]:
 		bound_form = LoginForm(request.form)
 
 		if bound_form.validate():
+			# Saves the password if `check_password` rehashed it.
+			session.commit()
 			current_app.login_manager.login_user(bound_form.requested_user)
 			flash("You have successfully logged into your account.", "success")
 			return redirect(get_next_param() or url_for("profile"))
@@ -70,10 +83,13 @@ def deactivate() -> Union[str, Response]:
 		bound_form = DeactivateForm(request.form)
 
 		if bound_form.validate():
-			current_user.is_active = False  # type: ignore
+			login_manager = current_app.login_manager
+			user = login_manager.get_full_user()
+			user.is_active = False  # type: ignore
 			session.commit()
 
-			current_app.login_manager.logout_user()
+			login_manager.invalidate_user(user)
+			login_manager.logout_user()
 			flash("Your account has been deactivated.", "danger")
 			return redirect(url_for("index"))
 
@@ -84,9 +100,13 @@ def deactivate() -> Union[str, Response]:
 
 @login_required
 def list() -> str:
-	current_page = current_user.short_urls \
-		.order_by(ShortURL.created_at.desc()) \
-		.paginate(current_app.config['SHORT_URLS_PER_PAGE'])
+	owner_id = current_user.get_id()
+	with read_from_replica():
+		current_page = ShortURL.query.filter_by(owner_id=owner_id).paginate(
+			current_app.config['SHORT_URLS_PER_PAGE'],
+			count=ShortURL.get_count_by_owner(owner_id),
+			keyset=(ShortURL.created_at, ShortURL.id),
+		)
 	return render_template("short-urls/list.html", current_page=current_page)
 
 
@@ -96,8 +116,16 @@ def create() -> Union[str, Response]:
 		bound_form = ShortURLForm(request.form)
 
 		if bound_form.validate():
-			bound_form.populate()
+			new_short_url = bound_form.populate()
+			if bound_form.is_duplicate:
+				flash(
+					"This URL is already shortened as \"%s\"."
+					% new_short_url.slug,
+					"info",
+				)
+				return redirect(url_for("list"))
 			session.commit()
+			ShortURL.forget(new_short_url.slug, current_user.get_id())
 
 			flash("New shortened URL created successfully.", "success")
 			return redirect(url_for("list"))
@@ -107,24 +135,168 @@ def create() -> Union[str, Response]:
 	return render_template("short-urls/create.html", form=ShortURLForm())
 
 
+@login_required
+def bulk_create() -> Union[str, Response]:
+	if request.method == "POST":
+		bound_form = BulkShortURLForm(
+			CombinedMultiDict((request.files, request.form)),
+		)
+
+		if bound_form.validate():
+			try:
+				full_urls = read_full_urls(bound_form.file.data)
+			except BulkFormatError as exc:
+				bound_form.file.errors.append(str(exc))
+			else:
+				rows = create_short_urls(
+					current_user.get_id(), full_urls,
+					chunk_size=current_app.config.get(
+						"SHORT_URLS_BULK_CHUNK_SIZE", 1000,
+					),
+					max_rows=current_app.config.get("SHORT_URLS_BULK_MAX_ROWS"),
+					deduplicate=current_app.config.get(
+						"SHORT_URLS_DEDUPLICATE", False,
+					),
+				)
+				content = write_csv(rows, lambda slug: (
+					request.url_root[:-1] + url_for("follow", slug=slug)
+				))
+				return Response(content, mimetype="text/csv", headers={
+					'Content-Disposition':
+						"attachment; filename=\"short-urls.csv\"",
+				})
+
+		return render_template("short-urls/bulk.html", form=bound_form)
+
+	return render_template("short-urls/bulk.html", form=BulkShortURLForm())
+
+
+@lru_cache(maxsize=None)
+def _render_static_notfound(app: Application, /) -> str:
+	return app.template_lookup.get_template("exceptions/404-static.html") \
+		.render()
+
+
+def _make_static_notfound_response(
+	response_class: Type[Response] = Response,
+) -> Response:
+	"""The 404 response for slugs that definitely don't exist, which costs
+	neither the database nor rendering."""
+
+	return response_class(_render_static_notfound(current_app), 404,
+  						mimetype="text/html")
+
+
 def follow(slug: str) -> Response:
-	short_url = ShortURL.query.filter_by(slug=slug).first_or_404()
-	short_url.clicks += 1
-	session.commit()
+	if is_purge_request():
+		# The proxy caches the answer, so it must be fresh.
+		short_url_redirect = ShortURL.get_redirect(slug, fresh=True)
+		if short_url_redirect is None:
+			return make_purge_response()
+		return make_redirect_response(short_url_redirect)
+
+	if slug_filter.is_missing(slug):
+		return _make_static_notfound_response()
+
+	short_url_redirect = ShortURL.get_redirect(slug)
+	if short_url_redirect is None:
+		abort(404)
 
-	return redirect(short_url.full_url)
+	click_counter.incr(slug)
+	click_recorder.record(slug, request.environ)
+	return make_redirect_response(short_url_redirect) \
+		.make_conditional(request)
+
+
+def lightweight_follow(environ: Dict[str, Any],
+ 					slug: str) -> Optional[Response]:
+	if PURGE_ENVIRON_KEY in environ:
+		# `follow` answers purges.
+		return None
+	if slug_filter.is_missing(slug):
+		return _make_static_notfound_response(LightweightResponse)
+
+	short_url_redirect = ShortURL.get_redirect(slug)
+	if short_url_redirect is None:
+		# `follow` renders the page.
+		return None
+
+	click_counter.incr(slug)
+	click_recorder.record(slug, environ)
+	return make_redirect_response(short_url_redirect, LightweightResponse)
+
+
+async def async_follow(slug: str) -> Response:
+	if is_purge_request():
+		short_url_redirect = await ShortURL.get_redirect_async(
+			slug, fresh=True,
+		)
+		if short_url_redirect is None:
+			return make_purge_response()
+		return make_redirect_response(short_url_redirect)
+
+	# Only possible misses may load new slugs, so only they use a thread.
+	if (
+		not slug_filter.might_exist(slug)
+		and await asyncio.to_thread(slug_filter.is_missing, slug)
+	):
+		return _make_static_notfound_response()
+
+	short_url_redirect = await ShortURL.get_redirect_async(slug)
+	if short_url_redirect is None:
+		abort(404)
 
+	click_counter.incr(slug)
+	click_recorder.record(slug, request.environ)
+	return make_redirect_response(short_url_redirect) \
+		.make_conditional(request)
 
-@login_required
-def delete(slug: str) -> Union[str, Response]:
-	short_url = ShortURL.query.filter_by(slug=slug).first_or_404()
 
-	if short_url.owner != current_user and not current_user.is_staff:
+def _get_own_short_url_or_404(slug: str, /) -> ShortURL:
+	rv = ShortURL.query.filter_by(slug=slug).first_or_404()
+	if rv.owner_id != current_user.get_id() and not current_user.is_staff:
 		abort(404)
+	return rv
+
+
+@login_required
+def stats(slug: str) -> str:
+	short_url = _get_own_short_url_or_404(slug)
+
+	now = datetime.utcnow()
+	with read_from_replica():
+		series = {
+			resolution: ClickRollup.get_series(
+				short_url.id, resolution, since=now - period,
+			)
+			for resolution, period in (
+				("minute", timedelta(hours=1)),
+				("hour", timedelta(days=2)),
+				("day", timedelta(days=30)),
+			)
+		}
+		top_values = ClickRollup.get_top_values(
+			short_url.id, since=now - timedelta(days=30),
+		)
+		visitors = VisitorSketch.get_series(
+			short_url.id, since=now - timedelta(days=30),
+		)
+
+	return render_template("short-urls/stats.html", short_url=short_url,
+  						series=series, top_values=top_values,
+  						visitors=visitors)
+
+
+@login_required
+def delete(slug: str) -> Union[str, Response]:
+	short_url = _get_own_short_url_or_404(slug)
 
 	if request.method == "POST":
+		owner_id = short_url.owner_id
 		session.delete(short_url)
 		session.commit()
+		ShortURL.forget(slug, owner_id)
+		purge_proxy_cache(slug)
 
 		flash("Your short URL was deleted successfully", "success")
 		return redirect(url_for("list"))
@@ -132,6 +304,14 @@ def delete(slug: str) -> Union[str, Response]:
 	return render_template("short-urls/delete.html", short_url=short_url)
 
 
+def metrics() -> Response:
+	if current_app.metrics is None:
+		abort(404)
+	return current_app.make_response(
+		current_app.metrics.render(), mimetype="text/plain; version=0.0.4",
+	)
+
+
 def notfound_handler(_: NotFound) -> Response:
 	content = render_template("exceptions/404.html")
 	return current_app.make_response(content, 404)
@@ -0,0 +1,8 @@
+from app.app import create_app
+
+
+app = create_app()
+
+
+async def application(scope, receive, send):
+	await app.asgi_app(scope, receive, send)
@@ -0,0 +1,96 @@
+import os
+import sys
+import math
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Callable, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+for name in (
+	"SECRET_KEY", "POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_DB",
+):
+	os.environ.setdefault(name, "benchmark")
+
+from app.app import config, create_app
+from app.models import User, ShortURL
+from app.clicks import click_counter, click_recorder
+from app.core.app import Application
+from app.core.db import session
+
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+SLUG = "bench"
+
+
+def make_app(directory: str, /, database_uri: Optional[str] = None,
+ 			short_urls: int = 0) -> Application:
+	"""Creates the application with its production config, except that
+	the database is SQLite in `directory` or the empty `database_uri`
+	database, and there are no rate limits, which a single client would
+	hit. The database has the `USERNAME` user that owns the `SLUG` and
+	`short_urls` more short URLs."""
+
+	config.update({
+		'DATABASE_URI': database_uri or f"sqlite:///{directory}/db.sqlite",
+		'DATABASE_REPLICA_URIS': [],
+		'TEMPLATES_CACHE_DIR': f"{directory}/templates",
+		'METRICS_DIR': None,
+		'RATE_LIMITS': {},
+	})
+	app = create_app()
+	app.database_manager.create_tables()
+
+	user = User(username=USERNAME)
+	user.set_password(PASSWORD)
+	session.add(user)
+	session.flush()
+	session.add(ShortURL(owner_id=user.id, full_url="https://example.com/",
+ 						slug=SLUG))
+	session.add_all(
+		ShortURL(owner_id=user.id, full_url=f"https://example.com/{i}",
+ 				slug=f"{SLUG}{i}")
+		for i in range(short_urls)
+	)
+	session.commit()
+	session.remove()
+	return app
+
+
+def close_app(app: Application, /, drop_tables: bool = False) -> None:
+	"""Writes pending clicks before the database is removed."""
+
+	click_counter.flush()
+	click_recorder.flush()
+	if drop_tables:
+		app.database_manager.drop_tables()
+	app.database_manager.engine.dispose()
+
+
+def start_response(*args: Any) -> Callable[[bytes], None]:
+	return lambda data: None
+
+
+def call_wsgi_app(wsgi_app: Callable, environ: Dict[str, Any], /) -> None:
+	app_iter = wsgi_app(dict(environ), start_response)
+	for _ in app_iter:
+		pass
+	if hasattr(app_iter, "close"):
+		app_iter.close()
+
+
+def measure(wsgi_app: Callable, environ: Dict[str, Any], /,
+ 			requests: int) -> float:
+	"""Returns the mean time of one request in seconds."""
+
+	started_at = time.perf_counter()
+	for _ in range(requests):
+		call_wsgi_app(wsgi_app, environ)
+	return (time.perf_counter() - started_at) / requests
+
+
+def get_percentile(sorted_values: List[float], percent: float, /) -> float:
+	"""The nearest-rank percentile of the sorted values."""
+
+	index = max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)
+	return sorted_values[index]
@@ -0,0 +1,38 @@
+import argparse
+import tempfile
+
+from werkzeug.test import EnvironBuilder
+
+from common import make_app, close_app, measure
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=(
+		"Compares the time of serving a redirect by the full middleware"
+		" stack (`Application.wsgi_app`) and by the lightweight route"
+		" (`Application.__call__`)."
+	))
+	parser.add_argument("-n", "--requests", type=int, default=20000)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		app = make_app(directory)
+
+		for path in ("/s/bench/", "/s/missing/"):
+			environ = EnvironBuilder(path).get_environ()
+			# Warms up the cache and templates.
+			measure(app, environ, 100)
+
+			full_time = measure(app.wsgi_app, environ, args.requests)
+			lightweight_time = measure(app, environ, args.requests)
+			print(
+				f"{path:<12} full stack: {full_time * 1e6:7.1f} us,"
+				f" lightweight: {lightweight_time * 1e6:7.1f} us,"
+				f" {full_time / lightweight_time:.1f}x",
+			)
+
+		close_app(app)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,371 @@
+import re
+import json
+import time
+import argparse
+import tempfile
+import threading
+from queue import Queue
+from datetime import datetime
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Tuple, Iterator, Optional, NamedTuple
+
+import sqlalchemy as sa
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import BaseResponse
+from werkzeug.exceptions import HTTPException
+
+from common import USERNAME, PASSWORD, make_app, close_app, get_percentile
+from app.models import User, ShortURL
+from app.core.app import Application
+from app.core.db import session
+
+
+# The default format of gunicorn access logs, e.g.:
+# 10.0.0.1 - - [18/Oct/2026:10:00:00 +0000] "GET /s/abc/ HTTP/1.0" 302 0 "-"
+# "curl/8.0"
+ACCESS_LOG_RE = re.compile(
+	r'\S+ \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<path>\S+)'
+	r' [^"]*" (?P<status>\d+) \S+'
+	r'(?: "(?P<referrer>[^"]*)" "(?P<user_agent>[^"]*)")?',
+)
+ACCESS_LOG_TIME_FORMAT = "%d/%b/%Y:%H:%M:%S %z"
+SLUG_PATH_RE = re.compile(r"^/s/([^/?]+)/")
+
+
+class LoggedRequest(NamedTuple):
+	time: Optional[float]
+	method: str
+	path: str
+	headers: Dict[str, str]
+	body: Optional[str]
+	# The status that was logged, if any.
+	status: Optional[int]
+
+
+class Result(NamedTuple):
+	endpoint: str
+	status: int
+	latency: float
+	queries: int
+
+
+def _parse_json_line(line: str, /) -> LoggedRequest:
+	"""Parses `{"method": ..., "path": ..., "headers": {...}, "body": ...,
+	"time": ..., "status": ...}`, where only the path is required and the
+	time is in Unix seconds."""
+
+	data = json.loads(line)
+	return LoggedRequest(
+		data.get("time"), data.get("method", "GET"), data['path'],
+		data.get("headers") or {}, data.get("body"), data.get("status"),
+	)
+
+
+def _parse_access_log_line(line: str, /) -> Optional[LoggedRequest]:
+	match = ACCESS_LOG_RE.match(line)
+	if match is None:
+		return None
+
+	headers = {}
+	if match['referrer'] not in {None, "-"}:
+		headers['Referer'] = match['referrer']
+	if match['user_agent'] not in {None, "-"}:
+		headers['User-Agent'] = match['user_agent']
+	return LoggedRequest(
+		datetime.strptime(match['time'], ACCESS_LOG_TIME_FORMAT).timestamp(),
+		match['method'], match['path'], headers, None, int(match['status']),
+	)
+
+
+def read_log(path: str, /) -> Iterator[LoggedRequest]:
+	"""Streams the requests of a JSONL log or of a gunicorn access log,
+	skipping lines that aren't requests."""
+
+	with open(path, encoding="utf-8") as f:
+		for line in f:
+			line = line.strip()
+			if not line:
+				continue
+			request = (
+				_parse_json_line(line) if line.startswith("{")
+				else _parse_access_log_line(line)
+			)
+			if request is not None:
+				yield request
+
+
+def seed_short_urls(path: str, /) -> int:
+	"""Creates short URLs for the slugs that the log follows, except those
+	that were logged with an error status, so that the replayed redirects
+	and 404s match the log. Returns the number of created ones."""
+
+	slugs = set()
+	for request in read_log(path):
+		match = SLUG_PATH_RE.match(request.path)
+		if (
+			match is not None and match[1] not in {"create", "bulk"}
+			and (request.status is None or request.status < 400)
+		):
+			slugs.add(match[1])
+
+	owner_id = User.query.filter_by(username=USERNAME).one().id
+	existing_slugs = {slug for slug, in session.query(ShortURL.slug)}
+	slugs -= existing_slugs
+	session.bulk_insert_mappings(ShortURL, [
+		{
+			'owner_id': owner_id,
+			'full_url': f"https://example.com/{slug}",
+			'slug': slug,
+		}
+		for slug in slugs
+	])
+	session.commit()
+	session.remove()
+	return len(slugs)
+
+
+def _get_user_cookie(app: Application, /) -> str:
+	client = Client(app, BaseResponse, use_cookies=True)
+	page = client.get("/accounts/login/", buffered=True).data.decode()
+	token = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', page) \
+		or re.search(r'value="([^"]+)"[^>]*name="csrf_token"', page)
+	assert token is not None
+	client.post("/accounts/login/", data={
+		'csrf_token': token[1], 'username': USERNAME, 'password': PASSWORD,
+	})
+	return "session=" + next(
+		cookie.value for cookie in client.cookie_jar  # type: ignore
+		if cookie.name == "session"
+	)
+
+
+class Replayer:
+	"""Sends logged requests to the application from `concurrency`
+	threads. With a positive `speed`, requests are sent at the times of
+	the log divided by `speed`, e.g. twice as fast with 2, otherwise as
+	fast as the threads manage. Database queries are counted per request
+	by the thread that serves it."""
+
+	def __init__(
+		self,
+		app: Application,
+		/,
+		*,
+		concurrency: int = 1,
+		speed: float = 0.0,
+		lightweight: bool = False,
+		cookie: Optional[str] = None,
+	) -> None:
+		self.app = app
+		self.wsgi_app = app if lightweight else app.wsgi_app
+		self.concurrency = concurrency
+		self.speed = speed
+		self.cookie = cookie
+
+		self.results: List[Result] = []
+		self.late_requests = 0
+		self._results_lock = threading.Lock()
+		self._queue: Queue[Optional[LoggedRequest]] = Queue(concurrency * 4)
+		self._local = threading.local()
+		self._url_adapter = app.url_map.bind("localhost")
+
+		for engine in app.database_manager.get_engines():
+			sa.event.listen(engine, "before_cursor_execute",
+  							self._count_query)
+
+	def _count_query(self, *args: Any) -> None:
+		self._local.queries = getattr(self._local, "queries", 0) + 1
+
+	def _get_endpoint(self, request: LoggedRequest, /) -> str:
+		try:
+			endpoint, _ = self._url_adapter.match(
+				request.path.split("?", 1)[0], request.method,
+			)
+		except HTTPException:
+			return "unmatched"
+		return endpoint
+
+	def _send(self, request: LoggedRequest, /) -> Result:
+		path, _, query_string = request.path.partition("?")
+		headers = dict(request.headers)
+		if self.cookie is not None:
+			headers.setdefault("Cookie", self.cookie)
+		environ = EnvironBuilder(
+			path, method=request.method, query_string=query_string,
+			headers=headers, data=request.body,
+		).get_environ()
+
+		self._local.queries = 0
+		status = []
+
+		def start_response(status_line: str, *args: Any) -> Any:
+			status.append(int(status_line.split(None, 1)[0]))
+			return lambda data: None
+
+		started_at = time.perf_counter()
+		app_iter = self.wsgi_app(environ, start_response)
+		try:
+			for _ in app_iter:
+				pass
+		finally:
+			if hasattr(app_iter, "close"):
+				app_iter.close()
+		latency = time.perf_counter() - started_at
+
+		return Result(self._get_endpoint(request), status[0], latency,
+  					self._local.queries)
+
+	def _work(self) -> None:
+		while True:
+			request = self._queue.get()
+			if request is None:
+				return
+			result = self._send(request)
+			with self._results_lock:
+				self.results.append(result)
+
+	def run(self, requests: Iterator[LoggedRequest], /) -> float:
+		"""Returns the time of the replay in seconds."""
+
+		threads = [
+			threading.Thread(target=self._work, daemon=True)
+			for _ in range(self.concurrency)
+		]
+		for thread in threads:
+			thread.start()
+
+		started_at = time.perf_counter()
+		first_time = None
+		for request in requests:
+			if self.speed > 0 and request.time is not None:
+				if first_time is None:
+					first_time = request.time
+				delay = (
+					(request.time - first_time) / self.speed
+					- (time.perf_counter() - started_at)
+				)
+				if delay > 0:
+					time.sleep(delay)
+				elif delay < -0.1:
+					# The threads can't keep up with the logged load.
+					self.late_requests += 1
+			self._queue.put(request)
+
+		for _ in threads:
+			self._queue.put(None)
+		for thread in threads:
+			thread.join()
+		return time.perf_counter() - started_at
+
+
+def report(results: List[Result], total_time: float, /) -> Dict[str, Any]:
+	by_endpoint: Dict[str, List[Result]] = defaultdict(list)
+	for result in results:
+		by_endpoint[result.endpoint].append(result)
+
+	def summarize(results: List[Result], /) -> Dict[str, Any]:
+		latencies = sorted(result.latency for result in results)
+		return {
+			'requests': len(results),
+			'rps': len(results) / total_time,
+			'p50_ms': get_percentile(latencies, 50) * 1000,
+			'p90_ms': get_percentile(latencies, 90) * 1000,
+			'p99_ms': get_percentile(latencies, 99) * 1000,
+			'max_ms': latencies[-1] * 1000,
+			'queries_per_request':
+				sum(result.queries for result in results) / len(results),
+			'statuses': dict(sorted(
+				Counter(result.status for result in results).items(),
+			)),
+		}
+
+	return {
+		'total': summarize(results),
+		'endpoints': {
+			endpoint: summarize(endpoint_results)
+			for endpoint, endpoint_results in sorted(by_endpoint.items())
+		},
+	}
+
+
+def _print_report(data: Dict[str, Any], /) -> None:
+	rows: List[Tuple[str, Dict[str, Any]]] = [("total", data['total'])]
+	rows += data['endpoints'].items()
+
+	print(
+		f"{'endpoint':<20} {'requests':>8} {'req/s':>8} {'p50 ms':>8}"
+		f" {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'queries':>8}"
+		"  statuses",
+	)
+	for name, row in rows:
+		statuses = " ".join(
+			f"{status}:{count}" for status, count in row['statuses'].items()
+		)
+		print(
+			f"{name:<20} {row['requests']:>8} {row['rps']:>8.1f}"
+			f" {row['p50_ms']:>8.2f} {row['p90_ms']:>8.2f}"
+			f" {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f}"
+			f" {row['queries_per_request']:>8.2f}  {statuses}",
+		)
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=(
+		"Replays a request log against the application in-process and"
+		" reports throughput, latency and database queries per endpoint."
+		" The log is JSONL, one {\"method\", \"path\", \"headers\", \"body\","
+		" \"time\", \"status\"} object per line, or a gunicorn access log."
+	))
+	parser.add_argument("log")
+	parser.add_argument("-c", "--concurrency", type=int, default=12,
+ 						help="threads, like gunicorn `--threads`")
+	parser.add_argument("--speed", type=float, default=0.0, help=(
+		"replay the logged times this many times faster; by default"
+		" requests are sent as fast as possible"
+	))
+	parser.add_argument("--lightweight", action="store_true", help=(
+		"send requests to `Application.__call__`, which serves redirects"
+		" by the lightweight route, instead of `Application.wsgi_app`"
+	))
+	parser.add_argument("--as-user", action="store_true",
+ 						help="send the session cookie of a logged in user")
+	parser.add_argument("--database-uri", help=(
+		"an empty database to use instead of SQLite, e.g. a local"
+		" PostgreSQL; its tables are created and dropped"
+	))
+	parser.add_argument("--json", action="store_true",
+ 						help="print the report as JSON")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		app = make_app(directory, args.database_uri)
+		try:
+			seeded = seed_short_urls(args.log)
+			replayer = Replayer(
+				app,
+				concurrency=args.concurrency,
+				speed=args.speed,
+				lightweight=args.lightweight,
+				cookie=_get_user_cookie(app) if args.as_user else None,
+			)
+			total_time = replayer.run(read_log(args.log))
+		finally:
+			close_app(app, drop_tables=args.database_uri is not None)
+
+	if not replayer.results:
+		parser.error("The log has no requests.")
+	data = report(replayer.results, total_time)
+	if args.json:
+		print(json.dumps(data, indent="\t"))
+		return
+
+	print(f"Seeded {seeded} short URLs, replayed {len(replayer.results)}"
+ 		f" requests in {total_time:.2f}s.")
+	if replayer.late_requests:
+		print(f"{replayer.late_requests} requests were sent late, the"
+ 			" replay is slower than the log.")
+	_print_report(data)
+
+
+if __name__ == "__main__":
+	main()
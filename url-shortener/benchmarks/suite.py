@@ -0,0 +1,316 @@
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from functools import partial
+from typing import Any, Dict, List, Tuple, Callable
+
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import BaseResponse
+
+from common import USERNAME, PASSWORD, SLUG, make_app, close_app, \
+	get_percentile
+from app.core.app import Application
+from app.core.locals import local
+from app.core.csrf import CSRF_SIGNERS, generate_csrf_token
+from app.core.utils import render_template
+from app.core.wrappers import Request
+
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent.joinpath("baseline.json")
+
+Results = Dict[str, Dict[str, float]]
+
+
+def _get_csrf_token(client: Client, path: str, /) -> str:
+	data = client.get(path, buffered=True).data.decode()
+	match = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', data) \
+		or re.search(r'value="([^"]+)"[^>]*name="csrf_token"', data)
+	if match is None:
+		raise RuntimeError(f"No CSRF token at {path}.")
+	return match.group(1)
+
+
+def _log_in(client: Client, /) -> None:
+	response = client.post("/accounts/login/", data={
+		'csrf_token': _get_csrf_token(client, "/accounts/login/"),
+		'username': USERNAME,
+		'password': PASSWORD,
+	})
+	if response.status_code != 302:
+		raise RuntimeError("Failed to log in.")
+
+
+def _get_session_cookie(client: Client, /) -> str:
+	return "session=" + next(
+		cookie.value for cookie in client.cookie_jar  # type: ignore
+		if cookie.name == "session"
+	)
+
+
+def _make_scenarios(app: Application, /) -> Dict[str, Callable[[int], Any]]:
+	"""Returns functions that make the `i`th request of every scenario and
+	check its status. Requests go through `Application.__call__`, as in
+	production."""
+
+	# Requests send the same session cookie, so that they don't depend on
+	# each other, e.g. don't pile up flashed messages in the session.
+	user_client = Client(app, BaseResponse, use_cookies=True)
+	_log_in(user_client)
+	create_token = _get_csrf_token(user_client, "/s/create/")
+	user_cookie = _get_session_cookie(user_client)
+
+	anonymous_client = Client(app, BaseResponse, use_cookies=True)
+	login_token = _get_csrf_token(anonymous_client, "/accounts/login/")
+	anonymous_cookie = _get_session_cookie(anonymous_client)
+	client = Client(app, BaseResponse, use_cookies=False)
+
+	def request(client: Client, method: str, path: str, status: int,
+  				**kwargs: Any) -> Callable[[int], None]:
+		def make_request(i: int) -> None:
+			response = client.open(
+				path.format(i=i), method=method, buffered=True,
+				data=kwargs['data'](i) if "data" in kwargs else None,
+				headers=kwargs.get("headers"),
+			)
+			if response.status_code != status:
+				raise RuntimeError(
+					f"{method} {path} returned {response.status_code}.",
+				)
+		return make_request
+
+	return {
+		'follow': request(client, "GET", f"/s/{SLUG}/", 302),
+		'follow_missing': request(client, "GET", "/s/missing{i}/", 404),
+		'notfound': request(client, "GET", "/missing/{i}/", 404),
+		'list': request(
+			client, "GET", "/s/", 200,
+			headers={'Cookie': user_cookie},
+		),
+		'create': request(
+			client, "POST", "/s/create/", 302,
+			data=lambda i: {
+				'csrf_token': create_token,
+				'full_url': f"https://example.com/created/{i}",
+			},
+			headers={'Cookie': user_cookie},
+		),
+		'login': request(
+			client, "POST", "/accounts/login/", 302,
+			data=lambda i: {
+				'csrf_token': login_token,
+				'username': USERNAME,
+				'password': PASSWORD,
+			},
+			headers={'Cookie': anonymous_cookie},
+		),
+	}
+
+
+def run_scenario(make_request: Callable[[int], Any], /,
+ 				requests: int, warmup: int) -> Dict[str, float]:
+	"""Makes the requests one after another and returns the throughput and
+	the latency percentiles in microseconds."""
+
+	for i in range(warmup):
+		make_request(-i - 1)
+
+	timings: List[float] = []
+	started_at = time.perf_counter()
+	for i in range(requests):
+		request_started_at = time.perf_counter()
+		make_request(i)
+		timings.append(time.perf_counter() - request_started_at)
+	total_time = time.perf_counter() - started_at
+
+	timings.sort()
+	return {
+		'rps': requests / total_time,
+		'p50_us': get_percentile(timings, 50) * 1e6,
+		'p99_us': get_percentile(timings, 99) * 1e6,
+	}
+
+
+def _start_request(app: Application, environ: Dict[str, Any], /) -> None:
+	app._set_locals(environ)
+	# Marks the request as matched, like `dispatch_request`.
+	request = local.request
+	request.endpoint, request.view_args = local.url_adapter.match()
+
+
+def _make_microbenchmarks(
+	app: Application,
+	/,
+) -> Dict[str, Tuple[Dict[str, Any], Callable[[], Any]]]:
+	"""Returns functions whose calls are timed and the environ of the
+	request in whose context they are called. The request of the user is
+	logged in."""
+
+	client = Client(app, BaseResponse, use_cookies=True)
+	_log_in(client)
+	session_cookie = _get_session_cookie(client)
+	follow_environ = EnvironBuilder(f"/s/{SLUG}/").get_environ()
+	index_environ = EnvironBuilder(
+		"/", headers={'Cookie': session_cookie},
+	).get_environ()
+
+	def dispatch_request() -> None:
+		_start_request(app, follow_environ)
+		app.dispatch_request()
+		app.run_teardown_request_funcs()
+
+	def csrf_token() -> None:
+		local.d = {}
+		generate_csrf_token()
+
+	def session_load() -> None:
+		Request(index_environ).session
+
+	def session_save() -> None:
+		request = Request(index_environ)
+		request.session['benchmark'] = True
+		request.save_session(app.response_class())
+
+	def template() -> None:
+		render_template("index.html")
+
+	rv = {
+		'dispatch_request': (follow_environ, dispatch_request),
+		'generate_csrf_token': (index_environ, csrf_token),
+		'session_load': (index_environ, session_load),
+		'session_save': (index_environ, session_save),
+		'render_template': (index_environ, template),
+	}
+
+	# The signers of `generate_csrf_token` and `CSRFProtect` alone.
+	session_token = "0" * 40
+	for name, signer_class in CSRF_SIGNERS.items():
+		signer = signer_class.from_config(app.config)
+		token = signer.sign(session_token)
+		rv[f"csrf_sign_{name}"] = (
+			index_environ, partial(signer.sign, session_token),
+		)
+		rv[f"csrf_verify_{name}"] = (
+			index_environ, partial(signer.verify, token, session_token),
+		)
+	return rv
+
+
+def run_microbenchmark(f: Callable[[], Any], /, number: int,
+ 						repeat: int = 5) -> Dict[str, float]:
+	"""Returns the mean time of a call in microseconds, the best of
+	`repeat` runs of `number` calls, as the slower runs were disturbed."""
+
+	best_time = float("inf")
+	for _ in range(repeat):
+		started_at = time.perf_counter()
+		for _ in range(number):
+			f()
+		best_time = min(best_time, time.perf_counter() - started_at)
+	return {'mean_us': best_time / number * 1e6}
+
+
+def compare(results: Results, baseline: Results, /,
+ 			tolerance: float) -> List[str]:
+	"""Prints the changes against the baseline and returns the names of
+	benchmarks whose median or mean time grew by more than `tolerance`."""
+
+	rv = []
+	for name, result in results.items():
+		if name not in baseline:
+			print(f"{name:<20} no baseline")
+			continue
+
+		changes = []
+		for metric, value in result.items():
+			baseline_value = baseline[name].get(metric)
+			if not baseline_value:
+				continue
+			change = value / baseline_value - 1
+			changes.append(f"{metric} {change:+7.1%}")
+			# Throughput and p99 follow the median and are too noisy.
+			if metric in {"p50_us", "mean_us"} and change > tolerance:
+				rv.append(name)
+		if name in rv:
+			changes.append("REGRESSION")
+		print(f"{name:<20}", ", ".join(changes))
+	return rv
+
+
+def _format_result(result: Dict[str, float], /) -> str:
+	return ", ".join(
+		f"{metric} {value:10.1f}" for metric, value in result.items()
+	)
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=(
+		"Measures the throughput and latency of the main pages and the time"
+		" of the core request machinery in-process, and compares them with"
+		" a stored baseline. Baselines depend on the machine, so compare"
+		" only runs made on one machine: the committed baseline.json is a"
+		" run with the defaults on SQLite, make your own with `--save` on"
+		" the commit to compare with before measuring a change."
+	))
+	parser.add_argument("-n", "--requests", type=int, default=2000)
+	parser.add_argument("--warmup", type=int, default=100)
+	parser.add_argument("--number", type=int, default=2000,
+ 						help="calls of every microbenchmark per run")
+	parser.add_argument("--database-uri", help=(
+		"an empty database to use instead of SQLite, e.g. a local"
+		" PostgreSQL; its tables are created and dropped"
+	))
+	parser.add_argument("-k", "--select", default="",
+ 						help="only benchmarks whose names contain this")
+	parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+	parser.add_argument("--save", action="store_true",
+ 						help="store the results as the baseline")
+	parser.add_argument("--tolerance", type=float, default=0.1,
+ 						help="the slowdown that is a regression")
+	args = parser.parse_args()
+
+	results: Results = {}
+	with tempfile.TemporaryDirectory() as directory:
+		app = make_app(directory, args.database_uri, short_urls=100)
+		try:
+			for name, make_request in _make_scenarios(app).items():
+				if args.select in name:
+					results[name] = run_scenario(
+						make_request, args.requests, args.warmup,
+					)
+					print(f"{name:<20}", _format_result(results[name]))
+
+			microbenchmarks = _make_microbenchmarks(app)
+			for name, (environ, f) in microbenchmarks.items():
+				if args.select not in name:
+					continue
+				_start_request(app, environ)
+				try:
+					results[name] = run_microbenchmark(f, args.number)
+				finally:
+					app.run_teardown_request_funcs()
+				print(f"{name:<20}", _format_result(results[name]))
+		finally:
+			close_app(app, drop_tables=args.database_uri is not None)
+
+	if args.save:
+		rounded = {
+			name: {metric: round(value, 1) for metric, value in result.items()}
+			for name, result in results.items()
+		}
+		args.baseline.write_text(json.dumps(rounded, indent="\t") + "\n")
+		print(f"Saved the baseline to {args.baseline}.")
+	elif args.baseline.exists():
+		print(f"\nCompared with {args.baseline}:")
+		regressions = compare(
+			results, json.loads(args.baseline.read_text()), args.tolerance,
+		)
+		if regressions:
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,32 @@
+"""Widen shorturl.slug and add the slug sequence
+
+Revision ID: 3c1d7e2a9f40
+Revises: b5c90ac69982
+Create Date: 2026-10-18 10:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1d7e2a9f40'
+down_revision = 'b5c90ac69982'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+	op.alter_column('shorturl', 'slug',
+		existing_type=sa.String(length=4),
+		type_=sa.String(length=16),
+		existing_nullable=False)
+	op.execute(sa.schema.CreateSequence(sa.Sequence('shorturl_slug_seq')))
+
+
+def downgrade():
+	op.execute(sa.schema.DropSequence(sa.Sequence('shorturl_slug_seq')))
+	op.alter_column('shorturl', 'slug',
+		existing_type=sa.String(length=16),
+		type_=sa.String(length=4),
+		existing_nullable=False)
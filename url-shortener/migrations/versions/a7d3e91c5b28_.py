@@ -0,0 +1,39 @@
+"""Increment the slug sequence by the block size
+
+Revision ID: a7d3e91c5b28
+Revises: f3b86d1e2c95
+Create Date: 2026-10-19 10:41:27.630518
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3e91c5b28'
+down_revision = 'f3b86d1e2c95'
+branch_labels = None
+depends_on = None
+
+# The former `SLUG_SEQUENCE_BLOCK_SIZE` default.
+BLOCK_SIZE = 100
+
+
+def upgrade():
+	# The sequence counted blocks, of which numbers below
+	# `last_value * BLOCK_SIZE` were issued. Now its value is the end of
+	# the last issued block.
+	op.execute(f"ALTER SEQUENCE shorturl_slug_seq INCREMENT BY {BLOCK_SIZE}")
+	op.execute(
+		"SELECT setval('shorturl_slug_seq',"
+		f" GREATEST(last_value * {BLOCK_SIZE}, {BLOCK_SIZE}))"
+		" FROM shorturl_slug_seq"
+	)
+
+
+def downgrade():
+	op.execute(
+		"SELECT setval('shorturl_slug_seq',"
+		f" (last_value + {BLOCK_SIZE} - 1) / {BLOCK_SIZE})"
+		" FROM shorturl_slug_seq"
+	)
+	op.execute("ALTER SEQUENCE shorturl_slug_seq INCREMENT BY 1")
@@ -0,0 +1,92 @@
+"""Index hashes of full URLs instead of full URLs
+
+Revision ID: f3b86d1e2c95
+Revises: 0c9d3e6f4a18
+Create Date: 2026-10-18 22:14:09.381274
+
+"""
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b86d1e2c95'
+down_revision = '0c9d3e6f4a18'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+# Copies of `app.models.DEFAULT_PORTS`, `normalize_full_url` and
+# `hash_full_url` at this revision, so that it fills the same hashes
+# whatever they become.
+DEFAULT_PORTS = {'http': "80", 'https': "443", 'ftp': "21"}
+
+
+def _normalize_full_url(full_url):
+	parts = urlsplit(full_url.strip())
+	scheme = parts.scheme.lower()
+	userinfo, at, host = parts.netloc.rpartition("@")
+	host = host.lower()
+	default_port = DEFAULT_PORTS.get(scheme)
+	if default_port is not None and host.endswith(":" + default_port):
+		host = host[:-len(default_port) - 1]
+	host = host.rstrip(":")
+	return urlunsplit((
+		scheme, userinfo + at + host, parts.path or "/", parts.query,
+		parts.fragment,
+	))
+
+
+def _hash_full_url(full_url):
+	return hashlib.blake2b(
+		_normalize_full_url(full_url).encode(), digest_size=16,
+	).hexdigest()
+
+
+def _fill_full_url_hashes():
+	connection = op.get_bind()
+	shorturl = sa.table(
+		'shorturl',
+		sa.column('id', sa.Integer()),
+		sa.column('full_url', sa.Text()),
+		sa.column('full_url_hash', sa.String()),
+	)
+	update = shorturl.update() \
+		.where(shorturl.c.id == sa.bindparam('row_id')) \
+		.values(full_url_hash=sa.bindparam('hash'))
+
+	last_id = 0
+	while True:
+		rows = connection.execute(
+			sa.select(shorturl.c.id, shorturl.c.full_url)
+			.where(shorturl.c.id > last_id)
+			.order_by(shorturl.c.id)
+			.limit(BATCH_SIZE)
+		).all()
+		if not rows:
+			break
+		connection.execute(update, [
+			{'row_id': id_, 'hash': _hash_full_url(full_url)}
+			for id_, full_url in rows
+		])
+		last_id = rows[-1][0]
+
+
+def upgrade():
+	op.add_column('shorturl', sa.Column('full_url_hash', sa.String(length=32), nullable=True))
+	_fill_full_url_hashes()
+	with op.batch_alter_table('shorturl') as batch_op:
+		batch_op.alter_column('full_url_hash',
+			existing_type=sa.String(length=32),
+			nullable=False)
+	op.drop_index('ix_shorturl_full_url', table_name='shorturl')
+	op.create_index('ix_shorturl_owner_id_full_url_hash', 'shorturl', ['owner_id', 'full_url_hash'], unique=False)
+
+
+def downgrade():
+	op.drop_index('ix_shorturl_owner_id_full_url_hash', table_name='shorturl')
+	op.create_index('ix_shorturl_full_url', 'shorturl', ['full_url'], unique=False)
+	op.drop_column('shorturl', 'full_url_hash')